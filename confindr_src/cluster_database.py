@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+from confindr_src.database_setup import index_database, find_temporary_path
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio import Align
+import multiprocessing
+import numpy as np
+import argparse
+import logging
+import shutil
+import os
+
+# Length of the words used to rule out alleles that can't be similar enough to be worth aligning, same as CD-HIT uses
+# for identities of 0.8 and up.
+WORD_LENGTH = 8
+
+
+def read_gene_alleles(fasta_file):
+    """
+    :param fasta_file: Path to a cgMLST database, with headers in format >genename_allelenumber
+    :return: Dictionary with genes as keys, and a list of (allele, sequence) tuples for each gene, in the order they
+    were in the file.
+    """
+    gene_alleles = dict()
+    with open(fasta_file) as f:
+        for title, sequence in SimpleFastaParser(f):
+            allele = title.split(None, 1)[0]
+            gene = allele.rsplit('_', 1)[0]
+            if gene not in gene_alleles:
+                gene_alleles[gene] = list()
+            gene_alleles[gene].append((allele, sequence.upper()))
+    return gene_alleles
+
+
+def find_words(sequence):
+    """
+    :param sequence: Sequence, as a string.
+    :return: Set of every word of length WORD_LENGTH in the sequence.
+    """
+    return set(sequence[i:i + WORD_LENGTH] for i in range(len(sequence) - WORD_LENGTH + 1))
+
+
+def find_min_shared_words(length, identity):
+    """
+    Every difference between two sequences can break at most WORD_LENGTH of the words they share, so sequences can
+    only be at least identity similar if they share at least this many words (the short word filter from CD-HIT).
+    :param length: Length of the shorter sequence.
+    :param identity: Identity, as a fraction.
+    :return: Minimum number of words two sequences need to share to be worth aligning.
+    """
+    return length - WORD_LENGTH + 1 - int((1 - identity) * length) * WORD_LENGTH
+
+
+def create_aligner():
+    """
+    :return: Aligner for finding identity between alleles. Gaps at the ends are free, so an allele that's a truncated
+    version of another one still counts as identical.
+    """
+    aligner = Align.PairwiseAligner()
+    aligner.mode = 'global'
+    aligner.match_score = 1
+    aligner.mismatch_score = -1
+    aligner.open_gap_score = -2
+    aligner.extend_gap_score = -1
+    aligner.end_gap_score = 0
+    return aligner
+
+
+def is_similar(sequence, representative, identity, aligner):
+    """
+    Finds identity the same way CD-HIT does - identical bases in the alignment over the length of the shorter sequence.
+    :param sequence: Sequence, as a string.
+    :param representative: Sequence to compare it to, as a string.
+    :param identity: Identity (as a fraction) the sequences need to share.
+    :param aligner: Aligner created by create_aligner.
+    :return: True if the sequences share at least identity, False otherwise.
+    """
+    shorter_length = min(len(sequence), len(representative))
+    if len(sequence) == len(representative):
+        # Alleles of a gene are usually the same length and differ only by substitutions, so comparing them base by
+        # base is usually enough without aligning them.
+        identities = np.count_nonzero(np.frombuffer(sequence.encode(), dtype=np.uint8) ==
+                                      np.frombuffer(representative.encode(), dtype=np.uint8))
+        if identities >= identity * shorter_length:
+            return True
+    alignment = aligner.align(representative, sequence)[0]
+    identities = 0
+    for (target_start, target_end), (query_start, query_end) in zip(*alignment.aligned):
+        identities += sum(a == b for a, b in zip(representative[target_start:target_end],
+                                                 sequence[query_start:query_end]))
+    return identities >= identity * shorter_length
+
+
+def cluster_gene(alleles, identity=0.9):
+    """
+    Clusters the alleles of one gene greedily, the same way CD-HIT does - the longest allele is the first
+    representative, and each allele after that (from longest to shortest, in file order for alleles the same length)
+    joins the first representative it's at least identity similar to, or becomes a representative itself.
+    :param alleles: List of (allele, sequence) tuples for a gene.
+    :param identity: Identity (as a fraction) an allele needs to have with a representative to join its cluster.
+    :return: Dictionary with representative alleles as keys, and a list of alleles in each one's cluster (including
+    itself) as values. Representatives are in the order they were in alleles.
+    """
+    aligner = create_aligner()
+    order = {allele: i for i, (allele, _) in enumerate(alleles)}
+    representatives = list()
+    clusters = dict()
+    sequence_representatives = dict()
+    for allele, sequence in sorted(alleles, key=lambda allele_sequence: -len(allele_sequence[1])):
+        if sequence in sequence_representatives:
+            clusters[sequence_representatives[sequence]].append(allele)
+            continue
+        words = find_words(sequence)
+        candidates = list()
+        for representative, representative_sequence, representative_words in representatives:
+            shared_words = len(words & representative_words)
+            if shared_words >= find_min_shared_words(min(len(sequence), len(representative_sequence)), identity):
+                candidates.append((-shared_words, order[representative], representative, representative_sequence))
+        for _, _, representative, representative_sequence in sorted(candidates):
+            if is_similar(sequence, representative_sequence, identity, aligner):
+                clusters[representative].append(allele)
+                sequence_representatives[sequence] = representative
+                break
+        else:
+            representatives.append((allele, sequence, words))
+            clusters[allele] = [allele]
+            sequence_representatives[sequence] = allele
+    return {representative: clusters[representative] for representative in sorted(clusters, key=order.get)}
+
+
+def cluster_alleles(gene_alleles, identity=0.9, threads=1):
+    """
+    :param gene_alleles: Dictionary created by read_gene_alleles.
+    :param identity: Identity (as a fraction) alleles need to be clustered together.
+    :param threads: Number of genes to cluster at once.
+    :return: Dictionary with genes as keys, and the clusters for each gene (see cluster_gene) as values.
+    """
+    genes = list(gene_alleles)
+    if threads > 1:
+        with multiprocessing.Pool(processes=threads) as p:
+            gene_clusters = p.starmap(cluster_gene, [(gene_alleles[gene], identity) for gene in genes])
+    else:
+        gene_clusters = [cluster_gene(gene_alleles[gene], identity) for gene in genes]
+    return dict(zip(genes, gene_clusters))
+
+
+def write_clustered_database(gene_alleles, gene_clusters, output_file):
+    """
+    Writes the representative alleles for every gene, with their original headers, along with a table of which alleles
+    each representative stands in for (output_file with _clusters.tsv in place of .fasta).
+    :param gene_alleles: Dictionary created by read_gene_alleles.
+    :param gene_clusters: Dictionary created by cluster_alleles.
+    :param output_file: Path to FASTA file to write.
+    :return: Path to the cluster table.
+    """
+    cluster_file = output_file.replace('.fasta', '') + '_clusters.tsv'
+    tmp_file = find_temporary_path(output_file)
+    with open(tmp_file, 'w') as f:
+        for gene in gene_alleles:
+            sequences = dict(gene_alleles[gene])
+            for representative in gene_clusters[gene]:
+                sequence = sequences[representative]
+                f.write('>{}\n'.format(representative))
+                f.write(''.join(sequence[i:i + 60] + '\n' for i in range(0, len(sequence), 60)))
+    with open(cluster_file, 'w') as f:
+        f.write('Gene\tRepresentative\tAllele\n')
+        for gene in gene_clusters:
+            for representative in gene_clusters[gene]:
+                for allele in gene_clusters[gene][representative]:
+                    f.write('{}\t{}\t{}\n'.format(gene, representative, allele))
+    os.replace(tmp_file, output_file)
+    return cluster_file
+
+
+def summarize_clustering(gene_alleles, gene_clusters):
+    """
+    :param gene_alleles: Dictionary created by read_gene_alleles.
+    :param gene_clusters: Dictionary created by cluster_alleles.
+    :return: Dictionary with the number of genes, and the number of alleles and bases before and after clustering.
+    """
+    summary = {'genes': len(gene_alleles),
+               'alleles_before': 0,
+               'alleles_after': 0,
+               'bases_before': 0,
+               'bases_after': 0}
+    for gene in gene_alleles:
+        sequences = dict(gene_alleles[gene])
+        summary['alleles_before'] += len(sequences)
+        summary['bases_before'] += sum(len(sequence) for sequence in sequences.values())
+        summary['alleles_after'] += len(gene_clusters[gene])
+        summary['bases_after'] += sum(len(sequences[representative]) for representative in gene_clusters[gene])
+    return summary
+
+
+def report_clustering(summary):
+    """
+    Logs how much smaller clustering made a database, and roughly how much faster that should make ConFindr. Baiting
+    and KMA (indexing and typing) both scale with the number of k-mers in the database, which is close to the number of
+    bases in it, so that's what the speedup is estimated from.
+    :param summary: Dictionary created by summarize_clustering.
+    """
+    logging.info('Clustered {alleles_before} alleles of {genes} genes into {alleles_after} representatives'
+                 .format(**summary))
+    if summary['bases_before'] == 0 or summary['bases_after'] == 0:
+        return
+    logging.info('Database went from {} to {} bases ({:.1f}% smaller)'
+                 .format(summary['bases_before'], summary['bases_after'],
+                         100 * (1 - summary['bases_after'] / summary['bases_before'])))
+    logging.info('Expect baiting and KMA indexing/typing with this database to be roughly {:.1f}x faster'
+                 .format(summary['bases_before'] / summary['bases_after']))
+
+
+def main():
+    logging.basicConfig(format='\033[92m \033[1m %(asctime)s \033[0m %(message)s ',
+                        level=logging.INFO,
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    parser = argparse.ArgumentParser(description='Clusters the alleles of each gene in a cgMLST database and keeps one '
+                                                 'representative per cluster, which makes ConFindr runs with --cgmlst '
+                                                 'faster. Representatives keep their >genename_allelenumber headers.')
+    parser.add_argument('-i', '--input',
+                        type=str,
+                        required=True,
+                        help='cgMLST database to cluster. Sequences should have headers in format '
+                             '>genename_allelenumber.')
+    parser.add_argument('-o', '--output',
+                        type=str,
+                        required=True,
+                        help='Path to write the clustered database to. Should end in .fasta. A table of which alleles '
+                             'each representative stands in for is written next to it, ending in _clusters.tsv.')
+    parser.add_argument('-id', '--identity',
+                        type=float,
+                        default=0.9,
+                        help='Identity alleles need to share to be clustered together, from 0.8 to 1. Defaults to '
+                             '0.9, which is what CD-HIT uses by default.')
+    parser.add_argument('-t', '--threads',
+                        type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Number of genes to cluster at once. Defaults to all threads available.')
+    parser.add_argument('-b', '--bait_engine',
+                        choices=['bbduk', 'numpy'],
+                        default='bbduk',
+                        help='Bait engine the database is going to be used with. If numpy, the k-mer file it needs is '
+                             'made along with the other indexes.')
+    parser.add_argument('-n', '--no_index',
+                        default=False,
+                        action='store_true',
+                        help='Don\'t index the clustered database. ConFindr will index it the first time it\'s used.')
+    args = parser.parse_args()
+
+    if not 0.8 <= args.identity <= 1:
+        logging.error('ERROR: Identity must be between 0.8 and 1.')
+        quit(code=1)
+    if not args.output.endswith('.fasta'):
+        logging.error('ERROR: Output file should end in .fasta, so that ConFindr can find its indexes.')
+        quit(code=1)
+    if os.path.dirname(args.output) and not os.path.isdir(os.path.dirname(args.output)):
+        os.makedirs(os.path.dirname(args.output))
+    logging.info('Reading {}...'.format(args.input))
+    gene_alleles = read_gene_alleles(args.input)
+    logging.info('Clustering alleles at {}% identity...'.format(100 * args.identity))
+    gene_clusters = cluster_alleles(gene_alleles, identity=args.identity, threads=args.threads)
+    write_clustered_database(gene_alleles, gene_clusters, args.output)
+    report_clustering(summarize_clustering(gene_alleles, gene_clusters))
+    if not args.no_index:
+        if shutil.which('kma') is None:
+            logging.warning('Could not find KMA, so the clustered database was not indexed. ConFindr will index it the '
+                            'first time it\'s used.')
+        else:
+            index_database(args.output, bait_engine=args.bait_engine)
+    logging.info('Clustered database written to {}. Use it with confindr -cgmlst {}'.format(args.output, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,51 +1,93 @@
 #!/usr/bin/env python
 from pysam.utils import SamtoolsError
+from multiprocessing.pool import ThreadPool
 import multiprocessing
 import pkg_resources
 import numpy as np
 import subprocess
 import traceback
 import argparse
+import hashlib
+import atexit
+import time
 import logging
+import json
 import shutil
 import glob
+import gzip
 import csv
 import os
 import pysam
 from Bio import SeqIO
-from confindr_src.database_setup import download_cgmlst_derived_data, download_mash_sketch
+from confindr_src.database_setup import download_cgmlst_derived_data, download_mash_sketch, create_species_allele_file
+from confindr_src.database_setup import find_genusspecific_allele_list, setup_allelespecific_database, index_database
+from confindr_src.database_setup import index_fasta, is_complete_fasta, find_writable_database, find_kma_database
+from confindr_src.database_setup import build_lock, find_temporary_path
+from confindr_src.database_setup import is_downloaded, read_manifest, write_manifest, invalidate_derived_databases
+from confindr_src.database_setup import PREBUILT_FINGERPRINT
 from confindr_src.wrappers import mash
+from confindr_src.wrappers import runner
 from confindr_src.wrappers import bbtools
+from confindr_src import kmer_bait
+from confindr_src import database_cache
+from confindr_src import kma_shm
 
+# Separates the sample tag from read names when reads from several samples are mapped together.
+BATCH_TAG_SEPARATOR = '|'
+# Reported as the genus of samples that couldn't be analysed.
+ERROR_GENUS = 'Error processing sample'
+# Number of mapping references found in (hits) or added to (misses) the reference cache during a run.
+reference_cache_stats = {'hits': 0, 'misses': 0}
 
-def run_cmd(cmd):
+
+def run_cmd(cmd, log=None, stdout_file=None):
     """
-    Runs a command using subprocess, and returns both the stdout and stderr from that command
+    Runs a command (without a shell), and returns both the stdout and stderr from that command
     If exit code from command is non-zero, raises subproess.CalledProcessError
     :param cmd: command to run as a string, as it would be called on the command line
-    :return: out, err: Strings that are the stdout and stderr from the command called.
+    :param log: Logfile to stream stdout and stderr to as the command runs. If None, output isn't logged.
+    :param stdout_file: File to write stdout to, in place of redirecting with >
+    :return: out, err: Strings that are the stdout and stderr from the command called (only the last 1000 lines
+    of each are kept).
+    """
+    return runner.run(cmd, log=log, stdout_file=stdout_file)
+
+
+def create_process_pool(processes):
+    """
+    Process pools get their workers from a fork server rather than by forking this process, since other threads (the
+    runner's event loop, and samples being typed and mapped at the same time) are usually running, and forking a
+    process with more than one thread can leave the child stuck on a lock one of the other threads was holding.
+    :param processes: Number of worker processes.
+    :return: multiprocessing Pool.
     """
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = p.communicate()
-    out = out.decode('utf-8')
-    err = err.decode('utf-8')
-    if p.returncode != 0:
-        raise subprocess.CalledProcessError(p.returncode, cmd=cmd)
-    return out, err
+    context = multiprocessing.get_context('forkserver')
+    # Workers get forked from a server that has already imported ConFindr, so they don't each have to.
+    context.set_forkserver_preload([__name__])
+    return context.Pool(processes=processes)
 
 
-def write_to_logfile(logfile, out, err, cmd):
+def map_samples(function, samples, parallel_samples=1):
     """
-    Writes stdout, stderr, and a command to a logfile
-    :param logfile: Path to file to write output to.
-    :param out: Stdout of program called, as a string
-    :param err: Stderr of program called, as a string
-    :param cmd: command that was used
+    Runs a function on each of a list of samples, working on up to parallel_samples of them at once in threads. Each
+    sample's external programs run on the runner's shared event loop, so programs for different samples run side by
+    side.
+    :param function: Function that takes a sample.
+    :param samples: List of samples.
+    :param parallel_samples: Number of samples to work on at once. If 1, samples are done one at a time in this
+    thread.
+    :return: Iterator over what function returned for each sample, in the same order as samples. Later samples keep
+    being worked on while earlier results are being used.
     """
-    with open(logfile, 'a+') as outfile:
-        outfile.write('Command used: {}\n\n'.format(cmd))
-        outfile.write('STDOUT: {}\n\n'.format(out))
-        outfile.write('STDERR: {}\n\n'.format(err))
+    if parallel_samples <= 1:
+        yield from map(function, samples)
+        return
+    p = ThreadPool(processes=parallel_samples)
+    try:
+        yield from p.imap(function, samples)
+    finally:
+        p.terminate()
+        p.join()
 
 
 def dependency_check(dependency):
@@ -106,42 +148,184 @@ def find_unpaired_reads(fastq_directory, forward_id='_R1', reverse_id='_R2', fin
     return read_list
 
 
-def find_genusspecific_allele_list(profiles_file, target_genus):
+def find_alignment_files(input_directory):
     """
-    A new way of making our specific databases: Make our profiles file have lists of every gene/allele present for
-    each genus instead of just excluding a few genes for each. This way, should have much smaller databases
-    while managing to make ConFindr a decent bit faster (maybe)
-    :param profiles_file: Path to profiles file.
-    :param target_genus: Genus you want to make a custom database for (STR)
-    :return: List of gene/allele combinations that should be part of species-specific database.
+    Looks at a directory to find reads stored as BAM or CRAM files.
+    :param input_directory: Complete path to directory containing BAM/CRAM files.
+    :return: List of alignment files, each in a list of length one so they can be treated like unpaired reads.
     """
-    alleles = list()
-    with open(profiles_file) as f:
-        lines = f.readlines()
-    for line in lines:
-        line = line.rstrip()
-        genus = line.split(':')[0]
-        if genus == target_genus:
-            alleles = line.split(':')[1].split(',')[:-1]
-    return alleles
+    alignment_files = glob.glob(os.path.join(input_directory, '*.bam')) + \
+        glob.glob(os.path.join(input_directory, '*.cram'))
+    return [[name] for name in sorted(alignment_files)]
 
 
-def setup_allelespecific_database(fasta_file, database_folder, allele_list):
+def is_alignment_file(filename):
     """
-    Since some genera have some rMLST genes missing, or two copies of some genes, genus-specific databases are needed.
-    This will take only the alleles known to be part of each genus and write them to a genus-specific file.
-    :param database_folder: Path to folder where rMLST_combined is stored.
-    :param fasta_file: Path to fasta file to write allele-specific database to.
-    :param allele_list: allele list generated by find_genusspecific_allele_list
+    :param filename: Path to input file.
+    :return: True if the file is a BAM or CRAM file, False otherwise.
     """
-    index = SeqIO.index(os.path.join(database_folder, 'rMLST_combined.fasta'), 'fasta')
-    seqs = list()
-    for s in allele_list:
-        try:
-            seqs.append(index[s])
-        except KeyError:
-            logging.warning('Tried to add {} to allele-specific database, but could not find it.'.format(s))
-    SeqIO.write(seqs, fasta_file, 'fasta')
+    return filename.endswith('.bam') or filename.endswith('.cram')
+
+
+def read_regions(regions_file):
+    """
+    Reads a BED file of regions (i.e. where each core gene is in a reference genome).
+    :param regions_file: Path to BED file. Only the first three columns (contig, start, end) are used.
+    :return: List of (contig, start, end) tuples.
+    """
+    regions = list()
+    with open(regions_file) as f:
+        for line in f:
+            if line.startswith('#') or line.startswith('track') or line.startswith('browser') or not line.strip():
+                continue
+            x = line.rstrip().split('\t')
+            regions.append((x[0], int(x[1]), int(x[2])))
+    return regions
+
+
+def alignment_to_fastq(read):
+    """
+    :param read: pysam AlignedSegment
+    :return: The read as a FASTQ record, in the orientation it was sequenced in.
+    """
+    qualities = read.get_forward_qualities()
+    if qualities is None:
+        quality_string = 'I' * read.query_length
+    else:
+        quality_string = pysam.qualities_to_qualitystring(qualities)
+    return '@{}\n{}\n+\n{}\n'.format(read.query_name, read.get_forward_sequence(), quality_string)
+
+
+def find_mates(bam, reads, max_gap=10000):
+    """
+    Finds the mates of reads in a coordinate sorted and indexed BAM/CRAM file. Rather than looking each mate up on
+    its own, mates are looked up in order of where they're placed, with mates that are close together all found by
+    one fetch.
+    :param bam: Open pysam AlignmentFile.
+    :param reads: Dictionary of reads to find mates for, where keys are read names and values are
+    (is_read1, mate contig, mate position) tuples.
+    :param max_gap: Mates this close to each other (in bp) get found with the same fetch.
+    :return: Generator of the mates found, as pysam AlignedSegments.
+    """
+    mate_positions = sorted((contig, position) for is_read1, contig, position in reads.values() if contig is not None)
+    intervals = list()
+    for contig, position in mate_positions:
+        if intervals and intervals[-1][0] == contig and position <= intervals[-1][2] + max_gap:
+            intervals[-1][2] = position
+        else:
+            intervals.append([contig, position, position])
+    for contig, start, end in intervals:
+        for read in bam.fetch(contig, start, end + 1):
+            if read.is_secondary or read.is_supplementary or read.query_name not in reads:
+                continue
+            if read.is_read1 != reads[read.query_name][0]:
+                yield read
+
+
+def extract_reads_from_alignment(alignment, sample_tmp_dir, sample_name, forward_id='_R1', reverse_id='_R2',
+                                 regions=None, cram_reference=None):
+    """
+    Turns a BAM or CRAM file back into FASTQ so it can go through the rest of ConFindr. If regions are given, only
+    reads in those regions (and their mates) are pulled out through the index, rather than going through the whole
+    file. Secondary and supplementary alignments are skipped, so each read is only written once. Reads are written
+    as they're found, with reads that are waiting on their mate the only ones held on to.
+    :param alignment: Path to BAM/CRAM file. Must be coordinate sorted and indexed if regions are given.
+    :param sample_tmp_dir: Folder to write FASTQ files to.
+    :param sample_name: Name of sample, used for naming FASTQ files.
+    :param forward_id: Identifier for forward reads.
+    :param reverse_id: Identifier for reverse reads.
+    :param regions: List of (contig, start, end) tuples, as created by read_regions. If None, every read is used.
+    :param cram_reference: Reference FASTA the CRAM file was compressed against. Not needed for BAM files.
+    :return: List with paths to forward and reverse FASTQ files for paired reads, or a list with a single FASTQ file
+    for unpaired reads.
+    """
+    if not os.path.isdir(sample_tmp_dir):
+        os.makedirs(sample_tmp_dir)
+    pair = [os.path.join(sample_tmp_dir, sample_name + forward_id + '.fastq.gz'),
+            os.path.join(sample_tmp_dir, sample_name + reverse_id + '.fastq.gz')]
+    unpaired = [os.path.join(sample_tmp_dir, sample_name + '.fastq.gz')]
+    # Reads waiting for their mate, as FASTQ, with where their mate is in case it has to be looked up.
+    waiting_reads = dict()
+    # Regions can overlap, so reads fetched through them are tracked to make sure none get written twice.
+    fetched_reads = set()
+    pairs_written = 0
+    unpaired_written = 0
+    with pysam.AlignmentFile(alignment, reference_filename=cram_reference) as bam, \
+            gzip.open(pair[0], 'wt') as forward, gzip.open(pair[1], 'wt') as reverse, \
+            gzip.open(unpaired[0], 'wt') as unpaired_file:
+
+        def add_read(read):
+            nonlocal pairs_written, unpaired_written
+            if read.is_secondary or read.is_supplementary:
+                return
+            if regions is not None:
+                if (read.query_name, read.is_read1) in fetched_reads:
+                    return
+                fetched_reads.add((read.query_name, read.is_read1))
+            if not read.is_paired:
+                unpaired_file.write(alignment_to_fastq(read))
+                unpaired_written += 1
+            elif read.query_name in waiting_reads:
+                mate = waiting_reads.pop(read.query_name)[1]
+                forward.write(alignment_to_fastq(read) if read.is_read1 else mate)
+                reverse.write(mate if read.is_read1 else alignment_to_fastq(read))
+                pairs_written += 1
+            else:
+                mate_contig = read.next_reference_name if read.next_reference_id >= 0 else None
+                waiting_reads[read.query_name] = (read.is_read1, alignment_to_fastq(read), mate_contig,
+                                                  read.next_reference_start)
+
+        if regions is None:
+            for read in bam.fetch(until_eof=True):
+                add_read(read)
+        else:
+            for contig, start, end in regions:
+                for read in bam.fetch(contig, start, end):
+                    add_read(read)
+            # Mates of reads in our regions can be placed anywhere, so go and find any that weren't picked up.
+            mates = {read_name: (is_read1, mate_contig, mate_position)
+                     for read_name, (is_read1, _, mate_contig, mate_position) in waiting_reads.items()}
+            for mate in find_mates(bam, mates):
+                if mate.query_name in waiting_reads:
+                    add_read(mate)
+        if not pairs_written:
+            # Without any pairs, reads whose mate is missing are still of use as unpaired reads.
+            for _, fastq, _, _ in waiting_reads.values():
+                unpaired_file.write(fastq)
+                unpaired_written += 1
+            waiting_reads = dict()
+    if pairs_written and (waiting_reads or unpaired_written):
+        logging.warning('Left {} reads whose mate could not be found and {} unpaired reads out of the reads extracted '
+                        'from {}, since it has paired reads'.format(len(waiting_reads), unpaired_written, alignment))
+    # Keep whichever of the paired and unpaired reads are going to be used.
+    for filename in (unpaired if pairs_written else pair):
+        os.remove(filename)
+    return pair if pairs_written else unpaired
+
+
+def prepare_sample_reads(pair, output_folder, forward_id='_R1', reverse_id='_R2', regions=None, cram_reference=None):
+    """
+    Gets reads for a sample ready for analysis. FASTQ/FASTA input is used as is, while BAM/CRAM input gets turned
+    into FASTQ by extract_reads_from_alignment.
+    :param pair: Input for the sample, as for find_contamination.
+    :param output_folder: Folder where outputs are stored. Extracted reads go in the sample's folder here.
+    :param forward_id: Identifier for forward reads.
+    :param reverse_id: Identifier for reverse reads.
+    :param regions: List of (contig, start, end) tuples to extract reads from, or None to extract every read.
+    :param cram_reference: Reference FASTA the CRAM file was compressed against.
+    :return: Reads for the sample, in the same format as pair.
+    """
+    if not is_alignment_file(pair[0]):
+        return pair
+    sample_name = os.path.split(pair[0])[-1].split('.')[0]
+    logging.info('Extracting reads from {}...'.format(os.path.split(pair[0])[-1]))
+    return extract_reads_from_alignment(alignment=pair[0],
+                                        sample_tmp_dir=os.path.join(output_folder, sample_name),
+                                        sample_name=sample_name,
+                                        forward_id=forward_id,
+                                        reverse_id=reverse_id,
+                                        regions=regions,
+                                        cram_reference=cram_reference)
 
 
 def extract_rmlst_genes(pair, database, forward_out, reverse_out, threads=12, logfile=None):
@@ -155,9 +339,260 @@ def extract_rmlst_genes(pair, database, forward_out, reverse_out, threads=12, lo
     :param logfile: Logfile to write command/stdout/stderr to. If None, nothing will be written.
     """
     out, err, cmd = bbtools.bbduk_bait(database, pair[0], forward_out, reverse_in=pair[1],
-                                       reverse_out=reverse_out, threads=str(threads), returncmd=True)
-    if logfile:
-        write_to_logfile(logfile, out, err, cmd)
+                                       reverse_out=reverse_out, threads=str(threads), returncmd=True, log=logfile)
+
+
+def find_predominant_species(screen_file, genus, min_matching_hashes=40):
+    """
+    Uses the results of a mash screen to find which species of a genus a sample best matches. Species are taken from
+    the description of the best matching RefSeq genome for the genus.
+    :param screen_file: Sorted mash screen output created by find_cross_contamination
+    :param genus: Genus to find species for.
+    :param min_matching_hashes: Minimum number of matching hashes for a genome to be considered.
+    :return: Species as genus and species (i.e. Escherichia coli), or None if no species could be found.
+    """
+    for item in mash.read_mash_screen(screen_file):
+        query_genus = item.query_id.split('/')[-3]
+        mash_genus = 'Escherichia' if query_genus == 'Shigella' else query_genus
+        if mash_genus != genus or int(item.shared_hashes.split('/')[0]) < min_matching_hashes:
+            continue
+        # Comment looks something like [3 seqs] NZ_CP009072.1 Escherichia coli ATCC 25922, complete genome [...]
+        words = item.query_comment.split()
+        for i in range(len(words) - 1):
+            if words[i] == query_genus and words[i + 1].isalpha() and words[i + 1].islower():
+                return '{} {}'.format(query_genus, words[i + 1])
+        return None
+    return None
+
+
+def find_sample_species(sample_tmp_dir, genus, species_db, min_matching_hashes=40):
+    """
+    Looks up the species to use for a sample's database from the mash screen done by find_cross_contamination.
+    :param sample_tmp_dir: Sample folder that mash screen results were written to.
+    :param genus: Genus to find species for.
+    :param species_db: Boolean - if False, species-specific databases aren't being used and None is returned.
+    :param min_matching_hashes: Minimum number of matching hashes for a genome to be considered.
+    :return: Species as genus and species (i.e. Escherichia coli), or None
+    """
+    screen_file = os.path.join(sample_tmp_dir, 'screen.tab')
+    if species_db is False or genus == 'ND' or not os.path.isfile(screen_file):
+        return None
+    species = find_predominant_species(screen_file, genus, min_matching_hashes=min_matching_hashes)
+    if species is not None:
+        logging.info('Sample appears to be {}'.format(species))
+    return species
+
+
+def merge_overlapping_reads(forward_in, reverse_in, merged_out, forward_out, reverse_out, threads=1, xmx=None,
+                            log=None):
+    """
+    Uses bbmerge to collapse read pairs whose mates overlap into single reads, so that overlapping bases only get
+    counted once when the pileup is done. Pairs that can't be merged are written out separately.
+    :param forward_in: Path to forward reads.
+    :param reverse_in: Path to reverse reads.
+    :param merged_out: Path to write merged reads to.
+    :param forward_out: Path to write forward reads of pairs that couldn't be merged to.
+    :param reverse_out: Path to write reverse reads of pairs that couldn't be merged to.
+    :param threads: Number of threads to run bbmerge with.
+    :param xmx: if None, bbmerge will use auto memory detection. If string, will use what's specified.
+    :param log: Logfile to stream bbmerge output to.
+    :return: out, err, cmd: stdout, stderr, and the command used.
+    """
+    if xmx is None:
+        out, err, cmd = bbtools.bbmerge(forward_in=forward_in,
+                                        reverse_in=reverse_in,
+                                        merged_reads=merged_out,
+                                        outu=forward_out,
+                                        outu2=reverse_out,
+                                        threads=threads,
+                                        returncmd=True,
+                                        log=log)
+    else:
+        out, err, cmd = bbtools.bbmerge(forward_in=forward_in,
+                                        reverse_in=reverse_in,
+                                        merged_reads=merged_out,
+                                        outu=forward_out,
+                                        outu2=reverse_out,
+                                        threads=threads,
+                                        Xmx=xmx,
+                                        returncmd=True,
+                                        log=log)
+    return out, err, cmd
+
+
+def remove_duplicate_reads(forward_in, forward_out, reverse_in='NA', reverse_out='NA', threads=1, xmx=None,
+                           log=None):
+    """
+    Removes exact duplicate reads (or pairs, if reverse reads are given) using clumpify's dedupe mode.
+    :param forward_in: Path to forward (or unpaired) reads.
+    :param forward_out: Path to write deduplicated forward (or unpaired) reads to.
+    :param reverse_in: Path to reverse reads. Leave as NA for unpaired reads.
+    :param reverse_out: Path to write deduplicated reverse reads to. Leave as NA for unpaired reads.
+    :param threads: Number of threads to run clumpify with.
+    :param xmx: if None, clumpify will use auto memory detection. If string, will use what's specified.
+    :param log: Logfile to stream clumpify output to.
+    :return: out, err, cmd: stdout, stderr, and the command used.
+    """
+    if xmx is None:
+        out, err, cmd = bbtools.clumpify(forward_in=forward_in,
+                                         forward_out=forward_out,
+                                         reverse_in=reverse_in,
+                                         reverse_out=reverse_out,
+                                         dedupe='t',
+                                         subs=0,
+                                         threads=threads,
+                                         returncmd=True,
+                                         log=log)
+    else:
+        out, err, cmd = bbtools.clumpify(forward_in=forward_in,
+                                         forward_out=forward_out,
+                                         reverse_in=reverse_in,
+                                         reverse_out=reverse_out,
+                                         dedupe='t',
+                                         subs=0,
+                                         threads=threads,
+                                         Xmx=xmx,
+                                         returncmd=True,
+                                         log=log)
+    return out, err, cmd
+
+
+def find_number_duplicates_removed(clumpify_stderr):
+    """
+    Parses the stderr of a clumpify run to find how many duplicate reads were removed.
+    :param clumpify_stderr: Stderr from clumpify, as a string.
+    :return: Number of duplicate reads removed as an int, or 'ND' if the count could not be found.
+    """
+    for line in clumpify_stderr.split('\n'):
+        if line.startswith('Duplicates Found:'):
+            return int(line.split()[-1])
+    return 'ND'
+
+
+def find_baited_read_stats(bbduk_stderr):
+    """
+    Parses the stderr of a bbduk baiting run to find how many reads and bases were baited out.
+    :param bbduk_stderr: Stderr from bbduk, as a string.
+    :return: reads, bases: Number of reads and bases that matched the reference, as ints. Both are None if the counts
+    could not be found.
+    """
+    for line in bbduk_stderr.split('\n'):
+        # Line looks like: Contaminants:   150 reads (7.50%)   22500 bases (7.50%)
+        if line.startswith('Contaminants:'):
+            x = line.split()
+            return int(x[1]), int(x[x.index('bases') - 1])
+    return None, None
+
+
+def find_database_gene_length(database):
+    """
+    Finds the combined length of the genes in a database, using the longest allele of each gene. Needs the database
+    to have been indexed with samtools faidx.
+    :param database: Path to fasta-formatted database, with headers in format >genename_allelenumber
+    :return: Total length of genes in the database, as an int.
+    """
+    gene_lengths = dict()
+    with open(database + '.fai') as f:
+        for line in f:
+            x = line.split('\t')
+            gene = x[0].rsplit('_', 1)[0]
+            gene_lengths[gene] = max(gene_lengths.get(gene, 0), int(x[1]))
+    return sum(gene_lengths.values())
+
+
+def write_core_gene_reference(database, gene_alleles, reference):
+    """
+    Writes out the alleles a sample was typed as to use as its mapping reference. Alleles are fetched through the
+    database's .fai rather than reading through the whole database, and are written in the same order they're in in
+    the database.
+    :param database: Path to fasta-formatted database.
+    :param gene_alleles: List of alleles to write, in format gene_allele, as created by find_rmlst_type.
+    :param reference: Path to fasta file to write.
+    :return: Total length of the alleles written, as an int.
+    """
+    index_fasta(database)
+    wanted = set(gene_alleles)
+    total_length = 0
+    with pysam.FastaFile(database) as fasta, open(reference, 'w') as f:
+        for name, length in zip(fasta.references, fasta.lengths):
+            if name in wanted:
+                f.write('>{}\n'.format(name))
+                f.write(fasta.fetch(name) + '\n')
+                total_length += length
+    return total_length
+
+
+def find_reference_key(database, gene_alleles):
+    """
+    :param database: Path to database the alleles come from.
+    :param gene_alleles: List of alleles, in format gene_allele.
+    :return: Key that's the same for any set of the same alleles from the same version of a database.
+    """
+    database = os.path.abspath(database)
+    key = json.dumps([database, os.path.getsize(database), os.path.getmtime(database), sorted(gene_alleles)])
+    return hashlib.sha256(key.encode()).hexdigest()[:24]
+
+
+def build_aligner_index(reference, aligner='bbmap', log=None):
+    """
+    Builds an index for a reference ahead of mapping, if there isn't one already. Indexes are built somewhere else and
+    moved into place, so one that exists is complete.
+    :param reference: Path to reference fasta.
+    :param aligner: Either bbmap or minimap2.
+    :param log: Logfile to write commands, stdout and stderr to.
+    :return: Path to the index - a folder for bbmap (passed as path=), or a .mmi file for minimap2.
+    """
+    if aligner == 'bbmap':
+        index = reference.replace('.fasta', '') + '_bbmap'
+        cmd = 'bbmap.sh ref={reference} path={index}'
+    else:
+        index = reference.replace('.fasta', '') + '.mmi'
+        cmd = 'minimap2 -x map-ont -d {index} {reference}'
+    if not os.path.exists(index):
+        with build_lock(index):
+            if not os.path.exists(index):
+                tmp_index = find_temporary_path(index)
+                run_cmd(cmd.format(reference=reference, index=tmp_index), log=log)
+                os.replace(tmp_index, index)
+    return index
+
+
+def find_cached_reference(database, gene_alleles, reference_cache, aligner='bbmap', log=None):
+    """
+    Finds the mapping reference for a set of alleles in the reference cache, making it (along with its .fai and aligner
+    index) if this set of alleles hasn't been seen before. Hits and misses are counted in reference_cache_stats.
+    :param database: Path to database the alleles come from.
+    :param gene_alleles: List of alleles, in format gene_allele, as created by find_rmlst_type.
+    :param reference_cache: Folder to keep references in, as created by database_cache.find_reference_cache
+    :param aligner: Either bbmap or minimap2 - which aligner the index is needed for.
+    :param log: Logfile to write commands, stdout and stderr to.
+    :return: reference, index: Paths to the reference fasta and the aligner index.
+    """
+    reference = os.path.join(reference_cache, find_reference_key(database, gene_alleles) + '.fasta')
+    with build_lock(reference):
+        hit = is_complete_fasta(reference)
+        if not hit:
+            tmp_reference = find_temporary_path(reference)
+            write_core_gene_reference(database=database,
+                                      gene_alleles=gene_alleles,
+                                      reference=tmp_reference)
+            os.replace(tmp_reference, reference)
+    # Both of these take their own locks, so they can't be done while holding the lock on the reference.
+    index_fasta(reference)
+    index = build_aligner_index(reference, aligner=aligner, log=log)
+    reference_cache_stats['hits' if hit else 'misses'] += 1
+    database_cache.mark_used(reference)
+    return reference, index
+
+
+def log_reference_cache_stats():
+    """
+    Writes how often samples were able to use a reference that was already in the reference cache to the log.
+    """
+    total = reference_cache_stats['hits'] + reference_cache_stats['misses']
+    if total > 0:
+        logging.info('Reference cache: {} of {} mapping references ({:.1f}%) were already cached'
+                     .format(reference_cache_stats['hits'], total, 100 * reference_cache_stats['hits'] / total))
 
 
 def find_cross_contamination(databases, reads, tmpdir='tmp', log='log.txt', threads=1, min_matching_hashes=40):
@@ -184,7 +619,8 @@ def find_cross_contamination(databases, reads, tmpdir='tmp', log='log.txt', thre
                                     # i='0.95',
                                     i='0.85',
                                     output_file=os.path.join(tmpdir, 'screen.tab'),
-                                    returncmd=True)
+                                    returncmd=True,
+                                    log=log)
     else:
         out, err, cmd = mash.screen('{database}/refseq.msh'.format(database=databases), reads[0],
                                     reads[1],
@@ -193,8 +629,8 @@ def find_cross_contamination(databases, reads, tmpdir='tmp', log='log.txt', thre
                                     # i='0.95',
                                     i='0.85',
                                     output_file=os.path.join(tmpdir, 'screen.tab'),
-                                    returncmd=True)
-    write_to_logfile(log, out, err, cmd)
+                                    returncmd=True,
+                                    log=log)
     screen_output = mash.read_mash_screen(os.path.join(tmpdir, 'screen.tab'))
     for item in screen_output:
         mash_genus = item.query_id.split('/')[-3]
@@ -454,90 +890,71 @@ def estimate_percent_contamination(contamination_report_file):
     return '%.2f' % (np.mean(contam_levels)), '%.2f' % np.std(contam_levels)
 
 
-def find_contamination(pair, output_folder, databases_folder, forward_id='_R1', threads=1, keep_files=False,
-                       quality_cutoff=20, base_cutoff=2, base_fraction_cutoff=0.05, cgmlst_db=None, xmx=None,
-                       tmpdir=None, data_type='Illumina', use_rmlst=False, cross_details=False, min_matching_hashes=40,
-                       fasta=False):
+def find_species_database(species, db_folder, source_folder=None):
     """
-    This needs some documentation fairly badly, so here we go.
-    :param pair: This has become a misnomer. If the input reads are actually paired, needs to be a list
-    with the full filepath to forward reads at index 0 and full path to reverse reads at index 1.
-    If reads are unpaired, should be a list of length 1 with the only entry being the full filepath to read set.
-    :param output_folder: Folder where outputs (confindr log and report, and other stuff) will be stored.
-    This will be created if it does not exist. (I think - should write a test that double checks this).
-    :param databases_folder: Full path to folder where ConFindr's databases live. These files can be
-    downloaded from figshare in .tar.gz format (https://ndownloader.figshare.com/files/11864267), and
-    will be automatically downloaded if the script is run from the command line.
-    :param forward_id: Identifier that marks reads as being in the forward direction for paired reads.
-    Defaults to _R1
-    :param threads: Number of threads to run analyses with. All parts of this pipeline scale pretty well,
-    so more is better.
-    :param keep_files: Boolean that says whether or not to keep temporary files.
-    :param quality_cutoff: Integer of the phred score required to have a base count towards a multiallelic site.
-    :param base_cutoff: Integer of number of bases needed to have a base be part of a multiallelic site.
-    :param base_fraction_cutoff: Float of fraction of bases needed to have a base be part of a multiallelic site.
-    If specified will be used in parallel with base_cutoff
-    :param cgmlst_db: if None, we're using rMLST, if True, using some sort of custom cgMLST database. This requires some
-    custom parameters.
-    :param xmx: if None, BBTools will use auto memory detection. If string, BBTools will use what's specified as their
-    memory request.
+    Finds a species-specific rMLST database, creating it if it doesn't exist yet. These only contain the alleles
+    known to be part of one species, so are smaller than the genus databases.
+    :param species: Species to find a database for, as genus and species (i.e. Escherichia coli)
+    :param db_folder: Path to folder to put the species-specific database in.
+    :param source_folder: Path to folder where rMLST_combined.fasta and species_allele.txt (or profiles.txt) are
+    stored. If None, same as db_folder.
+    :return: Path to the species-specific database, or None if one couldn't be made.
+    """
+    if source_folder is None:
+        source_folder = db_folder
+    species_database = os.path.join(db_folder, '{}_db.fasta'.format(species.replace(' ', '_')))
+    if is_complete_fasta(species_database):
+        return species_database
+    species_allele_file = os.path.join(source_folder, 'species_allele.txt')
+    # Databases downloaded by older versions of ConFindr won't have species information, but it can be made from the
+    # rMLST profiles.
+    if not os.path.isfile(species_allele_file) and os.path.isfile(os.path.join(source_folder, 'profiles.txt')):
+        species_allele_file = os.path.join(db_folder, 'species_allele.txt')
+        if not os.path.isfile(species_allele_file):
+            create_species_allele_file(profiles_file=os.path.join(source_folder, 'profiles.txt'),
+                                       species_allele_file=species_allele_file)
+    if not os.path.isfile(species_allele_file) or \
+            not os.path.isfile(os.path.join(source_folder, 'rMLST_combined.fasta')):
+        return None
+    allele_list = find_genusspecific_allele_list(species_allele_file, species)
+    if len(allele_list) == 0:
+        logging.debug('No alleles found for species {}, using genus database instead.'.format(species))
+        return None
+    logging.info('Setting up rMLST species-specific database for {}...'.format(species))
+    setup_allelespecific_database(fasta_file=species_database,
+                                  database_folder=source_folder,
+                                  allele_list=allele_list)
+    return species_database
+
+
+def find_prebuilt_databases(databases_folder):
+    """
+    :param databases_folder: Full path to folder where ConFindr's databases live.
+    :return: Set of the names of databases that were prebuilt, along with their indexes, by
+    database_setup.prebuild_databases. Empty if nothing was prebuilt.
+    """
+    fingerprint_file = os.path.join(databases_folder, PREBUILT_FINGERPRINT)
+    if not os.path.isfile(fingerprint_file):
+        return set()
+    with open(fingerprint_file) as f:
+        return set(json.load(f)['databases'])
+
+
+def find_genus_database(genus, databases_folder, tmpdir=None, use_rmlst=False, cgmlst_db=None, species=None):
+    """
+    Figures out which database should be used for a genus, creating a genus-specific rMLST database if one is needed
+    and doesn't exist yet.
+    :param genus: Genus to find a database for (STR). If ND, the full rMLST database will be used.
+    :param databases_folder: Full path to folder where ConFindr's databases live.
     :param tmpdir: if None, any genus-specifc databases that need to be created will be written to ConFindr DB location.
-    :param data_type: Either Illumina or Nanopore, depending on what type your reads are. (STR)
+    Otherwise, they get written here (this can also be a cache folder, see database_cache.find_cache_folder), and
+    databases from ConFindr's DB location that haven't been indexed yet get copied here to be indexed.
     :param use_rmlst: If False, use cgderived data instead of rMLST where possible. If True, always use rMLST. (BOOL)
-    :param cross_details: If False, stop workflow when cross contamination is detected. If True, continue so estimates
-    of percent contamination can be found (BOOL)
-    :param min_matching_hashes: Minimum number of matching hashes in a MASH screen in order for a genus to be
-    considered present in a sample. Default is 40
-    :param fasta: Boolean on whether the samples are in FASTA format. Default is False
+    :param cgmlst_db: Path to a cgMLST database. If specified, this is always used.
+    :param species: If specified (as genus and species, i.e. Escherichia coli), a species-specific rMLST database will
+    be used instead of the genus database when possible.
+    :return: Path to the database to use. Note that this file may not exist if no database is available for the genus.
     """
-    if os.path.isfile(os.path.join(databases_folder, 'download_date.txt')):
-        with open(os.path.join(databases_folder, 'download_date.txt')) as f:
-            database_download_date = f.readline().rstrip()
-    else:
-        database_download_date = 'ND'
-    log = os.path.join(output_folder, 'confindr_log.txt')
-    if len(pair) == 2:
-        sample_name = os.path.split(pair[0])[-1].split(forward_id)[0]
-        paired = True
-        logging.debug('Sample is paired. Sample name is {}'.format(sample_name))
-    else:
-        sample_name = os.path.split(pair[0])[-1].split('.')[0]
-        paired = False
-        logging.debug('Sample is unpaired. Sample name is {}'.format(sample_name))
-    sample_tmp_dir = os.path.join(output_folder, sample_name)
-    if not os.path.isdir(sample_tmp_dir):
-        os.makedirs(sample_tmp_dir)
-
-    logging.info('Checking for cross-species contamination...')
-    if paired:
-        genus = find_cross_contamination(databases_folder,
-                                         reads=pair,
-                                         tmpdir=sample_tmp_dir,
-                                         log=log,
-                                         threads=threads,
-                                         min_matching_hashes=min_matching_hashes)
-    else:
-        genus = find_cross_contamination(databases_folder,
-                                         reads=pair[0],
-                                         tmpdir=sample_tmp_dir,
-                                         log=log,
-                                         threads=threads,
-                                         min_matching_hashes=min_matching_hashes)
-    if len(genus.split(':')) > 1:
-        if not cross_details:
-            write_output(output_report=os.path.join(output_folder, 'confindr_report.csv'),
-                         sample_name=sample_name,
-                         multi_positions=0,
-                         genus=genus,
-                         percent_contam='ND',
-                         contam_stddev='ND',
-                         total_gene_length=0,
-                         database_download_date=database_download_date)
-            logging.info('Found cross-contamination! Skipping rest of analysis...\n')
-            if keep_files is False:
-                shutil.rmtree(sample_tmp_dir)
-            return
-    # Setup genus-specific databases, if necessary.
     if cgmlst_db is not None:
         # Sanity check that the DB specified is actually a file, otherwise, quit with appropriate error message.
         if not os.path.isfile(cgmlst_db):
@@ -546,9 +963,17 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
             quit(code=1)
         sample_database = cgmlst_db
     else:
-        db_folder = databases_folder if tmpdir is None else tmpdir
+        # Prebuilt databases (see database_setup.prebuild_databases) already have everything they need, so get used
+        # straight from the database folder even if a tmpdir was given because it can't be written to.
+        prebuilt = find_prebuilt_databases(databases_folder)
+        use_prebuilt = tmpdir is not None and any(name in prebuilt for name in ['{}_db_cgderived.fasta'.format(genus),
+                                                                                '{}_db.fasta'.format(genus)])
+        db_folder = databases_folder if tmpdir is None or use_prebuilt else tmpdir
         if not os.path.isdir(db_folder):
             os.makedirs(db_folder)
+        # Everything that databases get made from is in the database folder, wherever they get written to.
+        gene_allele_file = os.path.join(databases_folder, 'gene_allele.txt')
+        rmlst_file = os.path.join(databases_folder, 'rMLST_combined.fasta')
         if genus != 'ND':
             # Logic here is as follows: users can either have both rMLST databases, which cover all of bacteria,
             # cgmlst-derived databases, which cover only Escherichia, Salmonella, and Listeria (may add more at some
@@ -556,69 +981,299 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
             # core-genome derived stuff and fall back on rMLST if they're trying to look at a genus I haven't created
             # a scheme for.
             #
-            if len(genus.split(':')) > 1:
-                predominant_genus = genus.split(':')[0]
-            else:
-                predominant_genus = genus
+            # Species-level databases are a subset of the rMLST genus database, so only try them when we would
+            # otherwise be using rMLST. If one can't be made, fall back on the genus database.
+            species_database = None
+            cgderived_database = os.path.join(databases_folder, '{}_db_cgderived.fasta'.format(genus))
+            if species is not None and not use_prebuilt and (use_rmlst is True or
+                                                             not os.path.isfile(cgderived_database)):
+                species_database = find_species_database(species, db_folder, source_folder=databases_folder)
+            if species_database is not None:
+                sample_database = species_database
             # In the event rmlst databases have priority, always use them.
-            if use_rmlst is True:
-                sample_database = os.path.join(db_folder, '{}_db.fasta'.format(predominant_genus))
-                if not os.path.isfile(sample_database):
+            elif use_rmlst is True:
+                sample_database = os.path.join(db_folder, '{}_db.fasta'.format(genus))
+                if not is_complete_fasta(sample_database):
 
-                    if os.path.isfile(os.path.join(db_folder, 'gene_allele.txt')) and \
-                            os.path.isfile(os.path.join(db_folder, 'rMLST_combined.fasta')):
+                    if os.path.isfile(gene_allele_file) and os.path.isfile(rmlst_file):
                         logging.info('Setting up rMLST genus-specific database for genus {}...'
-                                     .format(predominant_genus))
-                        allele_list = find_genusspecific_allele_list(os.path.join(db_folder, 'gene_allele.txt'),
-                                                                     predominant_genus)
+                                     .format(genus))
+                        allele_list = find_genusspecific_allele_list(gene_allele_file, genus)
                         # Create the allele-specific database
                         setup_allelespecific_database(fasta_file=sample_database,
-                                                      database_folder=db_folder,
+                                                      database_folder=databases_folder,
                                                       allele_list=allele_list)
+            # Check if a cgderived database is available. If not, try to use rMLST database.
+            elif os.path.isfile(cgderived_database):
+                sample_database = cgderived_database
+                if db_folder != databases_folder:
+                    sample_database = find_writable_database(cgderived_database, db_folder)
             else:
-                # Check if a cgderived database is available. If not, try to use rMLST database.
-                sample_database = os.path.join(db_folder, '{}_db_cgderived.fasta'.format(predominant_genus))
-                if not os.path.isfile(sample_database):
-                    sample_database = os.path.join(db_folder, '{}_db.fasta'.format(predominant_genus))
-                    # Create genus specific database if it doesn't already exist and we have the necessary rMLST files.
-                    if os.path.isfile(os.path.join(db_folder, 'rMLST_combined.fasta')) and \
-                            os.path.isfile(os.path.join(db_folder, 'gene_allele.txt')) and not \
-                            os.path.isfile(sample_database):
-                        logging.info('Setting up core genome genus-specific database for genus {}...'
-                                     .format(predominant_genus))
-                        allele_list = find_genusspecific_allele_list(os.path.join(db_folder, 'gene_allele.txt'),
-                                                                     predominant_genus)
-                        setup_allelespecific_database(fasta_file=sample_database,
-                                                      database_folder=db_folder,
-                                                      allele_list=allele_list)
-
+                sample_database = os.path.join(db_folder, '{}_db.fasta'.format(genus))
+                # Create genus specific database if it doesn't already exist and we have the necessary rMLST files.
+                if os.path.isfile(rmlst_file) and os.path.isfile(gene_allele_file) and not \
+                        is_complete_fasta(sample_database):
+                    logging.info('Setting up core genome genus-specific database for genus {}...'
+                                 .format(genus))
+                    allele_list = find_genusspecific_allele_list(gene_allele_file, genus)
+                    setup_allelespecific_database(fasta_file=sample_database,
+                                                  database_folder=databases_folder,
+                                                  allele_list=allele_list)
+
+        elif db_folder != databases_folder and os.path.isfile(rmlst_file):
+            sample_database = find_writable_database(rmlst_file, db_folder)
         else:
             sample_database = os.path.join(db_folder, 'rMLST_combined.fasta')
+        database_cache.mark_used(sample_database)
+    return sample_database
+
+
+def find_core_gene_loci(paf_file, min_coverage=0.9, min_identity=0.9):
+    """
+    Parses alignments of core gene alleles to an assembly to find where in the assembly each core gene is.
+    :param paf_file: PAF file created by minimap2, with core gene alleles as queries and contigs as targets.
+    :param min_coverage: Minimum fraction of an allele that has to be aligned for a hit to count.
+    :param min_identity: Minimum identity over the aligned part of an allele for a hit to count.
+    :return: Dictionary with genes as keys, and a list of loci for each gene. Each locus is a dictionary with the
+    contig, start and end of the locus, along with the allele that best matches it and the number of differences
+    (mismatches and gap positions) between the two.
+    """
+    gene_loci = dict()
+    with open(paf_file) as f:
+        for line in f:
+            x = line.rstrip().split('\t')
+            allele, allele_length, allele_start, allele_end = x[0], int(x[1]), int(x[2]), int(x[3])
+            contig, start, end = x[5], int(x[7]), int(x[8])
+            matches, alignment_length = int(x[9]), int(x[10])
+            if (allele_end - allele_start) / allele_length < min_coverage or matches / alignment_length < min_identity:
+                continue
+            gene = allele.rsplit('_', 1)[0]
+            if gene not in gene_loci:
+                gene_loci[gene] = list()
+            differences = alignment_length - matches
+            for locus in gene_loci[gene]:
+                if locus['contig'] == contig and start < locus['end'] and end > locus['start']:
+                    locus['start'] = min(start, locus['start'])
+                    locus['end'] = max(end, locus['end'])
+                    if differences < locus['differences']:
+                        locus['allele'] = allele
+                        locus['differences'] = differences
+                    break
+            else:
+                gene_loci[gene].append({'contig': contig,
+                                        'start': start,
+                                        'end': end,
+                                        'allele': allele,
+                                        'differences': differences})
+    return gene_loci
+
+
+def find_divergent_genes(gene_loci):
+    """
+    Finds core genes that are present more than once in an assembly, with copies that aren't the same. Copies are
+    considered different when they don't have the same best matching allele, or don't have the same number of
+    differences from it. Identical copies (true duplicates, or assembly artifacts) are not counted.
+    :param gene_loci: Dictionary created by find_core_gene_loci
+    :return: Sorted list of genes with divergent copies.
+    """
+    divergent_genes = list()
+    for gene in gene_loci:
+        copies = set((locus['allele'], locus['differences']) for locus in gene_loci[gene])
+        if len(copies) > 1:
+            divergent_genes.append(gene)
+    return sorted(divergent_genes)
+
+
+def find_contamination_in_assembly(assembly, genus, sample_tmp_dir, output_folder, databases_folder, report_name, log,
+                                   threads=1, cgmlst_db=None, tmpdir=None, use_rmlst=False, species=None):
+    """
+    Assembly version of type_and_map_genus and find_contamination_from_bam. Instead of baiting, typing, and looking
+    through a pileup, every core gene allele is aligned against the contigs once with minimap2, and the sample is
+    called contaminated if core genes show up at more than one locus with different sequences.
+    :param assembly: Path to assembly, in FASTA format.
+    See type_and_map_genus for all other parameters.
+    :return: Dictionary of values that should be passed to write_output for this genus. The number of core genes with
+    divergent copies is reported in place of the number of contaminating SNVs.
+    """
+    if not os.path.isdir(sample_tmp_dir):
+        os.makedirs(sample_tmp_dir)
+    sample_database = find_genus_database(genus=genus,
+                                          databases_folder=databases_folder,
+                                          tmpdir=tmpdir,
+                                          use_rmlst=use_rmlst,
+                                          cgmlst_db=cgmlst_db,
+                                          species=species)
+    if not os.path.isfile(sample_database):
+        logging.info('Did not find databases for genus {genus}.\n'.format(genus=genus))
+        return {'multi_positions': 0,
+                'percent_contam': 'ND',
+                'contam_stddev': 'ND',
+                'total_gene_length': 0}
+    logging.info('Finding core genes in assembly...')
+    paf_file = os.path.join(sample_tmp_dir, 'core_genes.paf')
+    cmd = 'minimap2 -c -x asm20 -N 50 -t {threads} {assembly} {database}'.format(threads=threads,
+                                                                                 assembly=assembly,
+                                                                                 database=sample_database)
+    out, err = run_cmd(cmd, log=log, stdout_file=paf_file)
+    gene_loci = find_core_gene_loci(paf_file)
+    divergent_genes = find_divergent_genes(gene_loci)
+
+    with open(os.path.join(output_folder, report_name + '_rmlst.csv'), 'w') as f:
+        f.write('Gene,Allele\n')
+        for gene in sorted(gene_loci):
+            for locus in gene_loci[gene]:
+                f.write('{},{}\n'.format(gene, locus['allele'].rsplit('_', 1)[-1]))
+    with open(os.path.join(output_folder, report_name + '_contamination.csv'), 'w') as f:
+        f.write('Gene,Contig,Start,End,Allele,Differences\n')
+        for gene in divergent_genes:
+            for locus in gene_loci[gene]:
+                f.write('{gene},{contig},{start},{end},{allele},{differences}\n'.format(gene=gene, **locus))
+    total_gene_length = sum(gene_loci[gene][0]['end'] - gene_loci[gene][0]['start'] for gene in gene_loci)
+    logging.info('Done! Number of core genes with divergent copies found: {}\n'.format(len(divergent_genes)))
+    # A single divergent gene could be a real paralog, so need at least two before calling contamination.
+    return {'multi_positions': len(divergent_genes),
+            'percent_contam': 'ND',
+            'contam_stddev': 'ND',
+            'total_gene_length': total_gene_length,
+            'snp_cutoff': 2}
+
+
+def type_and_map_genus(pair, genus, sample_tmp_dir, output_folder, databases_folder, report_name, log, threads=1,
+                       cgmlst_db=None, xmx=None, tmpdir=None, data_type='Illumina', use_rmlst=False, fasta=False,
+                       merge_reads=False, dedupe=False, min_coverage=2, species=None, bait_engine='bbduk',
+                       assembly_mode=False, reference_cache=None):
+    """
+    Runs the part of the workflow that comes after the genus is known, up to the pileup: baiting out core gene reads,
+    trimming, typing with KMA, and mapping. The pileup gets looked through afterwards by find_contamination_from_bam.
+    :param pair: List with the full filepath to forward reads at index 0 and reverse reads at index 1 for paired
+    reads, or a list of length 1 with the full filepath to the read set for unpaired reads.
+    :param genus: Genus to run the analysis for (STR). If ND, the full rMLST database is used.
+    :param sample_tmp_dir: Folder to store intermediate files in. Will be created if it does not exist.
+    :param output_folder: Folder where the sample's rMLST and contamination reports will be written.
+    :param databases_folder: Full path to folder where ConFindr's databases live.
+    :param report_name: Name that rMLST and contamination reports get written to, as report_name_rmlst.csv and
+    report_name_contamination.csv
+    :param log: Logfile to write commands, stdout and stderr to.
+    :param species: Species of the sample (i.e. Escherichia coli). If given, a species-specific rMLST database is used
+    where possible.
+    :param bait_engine: Either bbduk or numpy - what to use to bait out core gene reads.
+    :param assembly_mode: If True and fasta is True, find_contamination_in_assembly is used instead.
+    :param reference_cache: Folder to keep mapping references and their aligner indexes in, so samples that type as
+    the same alleles can reuse them. If None, every sample makes its own.
+    See find_contamination for all other parameters.
+    :return: Dictionary created by type_core_genes, with pysam_pass added to say whether or not mapping worked. If
+    analysis can't continue (or the sample was an assembly analysed with find_contamination_in_assembly), the
+    dictionary instead has a single key, result, with what should be passed to write_output.
+    """
+    if fasta and assembly_mode:
+        return {'result': find_contamination_in_assembly(assembly=pair[0],
+                                                         genus=genus,
+                                                         sample_tmp_dir=sample_tmp_dir,
+                                                         output_folder=output_folder,
+                                                         databases_folder=databases_folder,
+                                                         report_name=report_name,
+                                                         log=log,
+                                                         threads=threads,
+                                                         cgmlst_db=cgmlst_db,
+                                                         tmpdir=tmpdir,
+                                                         use_rmlst=use_rmlst,
+                                                         species=species)}
+    typing = type_core_genes(pair=pair,
+                             genus=genus,
+                             sample_tmp_dir=sample_tmp_dir,
+                             output_folder=output_folder,
+                             databases_folder=databases_folder,
+                             report_name=report_name,
+                             log=log,
+                             threads=threads,
+                             cgmlst_db=cgmlst_db,
+                             xmx=xmx,
+                             tmpdir=tmpdir,
+                             data_type=data_type,
+                             use_rmlst=use_rmlst,
+                             fasta=fasta,
+                             merge_reads=merge_reads,
+                             dedupe=dedupe,
+                             min_coverage=min_coverage,
+                             species=species,
+                             bait_engine=bait_engine,
+                             reference_cache=reference_cache)
+    if 'result' in typing:
+        return typing
+    typing['pysam_pass'] = True
+    try:
+        map_to_core_genes(typing=typing,
+                          log=log,
+                          threads=threads,
+                          cgmlst_db=cgmlst_db,
+                          xmx=xmx,
+                          data_type=data_type,
+                          fasta=fasta)
+    except SamtoolsError:
+        typing['pysam_pass'] = False
+    return typing
+
+
+def type_core_genes(pair, genus, sample_tmp_dir, output_folder, databases_folder, report_name, log, threads=1,
+                    cgmlst_db=None, xmx=None, tmpdir=None, data_type='Illumina', use_rmlst=False, fasta=False,
+                    merge_reads=False, dedupe=False, min_coverage=2, species=None, bait_engine='bbduk',
+                    reference_cache=None):
+    """
+    First part of type_and_map_genus - bait out core gene reads, trim them (and dedupe/merge them if
+    requested), and type them with KMA to make a reference (rmlst.fasta) that has the best allele for each gene.
+    Parameters are the same as for type_and_map_genus.
+    :return: Dictionary describing the reads and reference for map_to_core_genes and find_contamination_from_bam.
+    If analysis can't continue, the dictionary instead has a single key, result, with what should be passed to
+    write_output.
+    """
+    paired = len(pair) == 2
+    if not os.path.isdir(sample_tmp_dir):
+        os.makedirs(sample_tmp_dir)
+    sample_database = find_genus_database(genus=genus,
+                                          databases_folder=databases_folder,
+                                          tmpdir=tmpdir,
+                                          use_rmlst=use_rmlst,
+                                          cgmlst_db=cgmlst_db,
+                                          species=species)
 
     # If a user has gotten to this point and they don't have any database available to do analysis because
     # they don't have rMLST downloaded and we don't have a cg-derived database available, boot them with a helpful
     # message.
     if not os.path.isfile(sample_database):
-        write_output(output_report=os.path.join(output_folder, 'confindr_report.csv'),
-                     sample_name=sample_name,
-                     multi_positions=0,
-                     genus=genus,
-                     percent_contam='ND',
-                     contam_stddev='ND',
-                     total_gene_length=0,
-                     database_download_date=database_download_date)
         logging.info('Did not find databases for genus {genus}. You can download the rMLST database to get access to '
                      'all genera (see https://olc-bioinformatics.github.io/ConFindr/install/). Alternatively, if you '
                      'have a high-quality core-genome derived database for your genome of interest, we would be happy '
                      'to add it - open an issue at https://github.com/OLC-Bioinformatics/ConFindr/issues with the '
                      'title "Add genus-specific database: {genus}"\n'.format(genus=genus))
-        if keep_files is False:
-            shutil.rmtree(sample_tmp_dir)
-        return
+        return {'result': {'multi_positions': 0,
+                           'percent_contam': 'ND',
+                           'contam_stddev': 'ND',
+                           'total_gene_length': 0}}
 
     # Extract rMLST reads and quality trim.
     logging.info('Extracting conserved core genes...')
-    if paired:
+    baited_reads, baited_bases = None, None
+    if bait_engine == 'numpy' and not fasta:
+        if paired:
+            baited_reads, baited_bases = kmer_bait.bait_reads(reference=sample_database,
+                                                              forward_in=pair[0],
+                                                              reverse_in=pair[1],
+                                                              forward_out=os.path.join(sample_tmp_dir,
+                                                                                       'rmlst_R1.fastq.gz'),
+                                                              reverse_out=os.path.join(sample_tmp_dir,
+                                                                                       'rmlst_R2.fastq.gz'),
+                                                              threads=threads,
+                                                              kmer_folder=tmpdir)
+        else:
+            baited_reads, baited_bases = kmer_bait.bait_reads(reference=sample_database,
+                                                              forward_in=pair[0],
+                                                              forward_out=os.path.join(sample_tmp_dir,
+                                                                                       'trimmed.fastq.gz'
+                                                                                       if data_type == 'Nanopore'
+                                                                                       else 'rmlst.fastq.gz'),
+                                                              threads=threads,
+                                                              kmer_folder=tmpdir)
+    elif paired:
         if xmx is None:
             out, err, cmd = bbtools.bbduk_bait(reference=sample_database,
                                                forward_in=pair[0],
@@ -626,7 +1281,8 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
                                                forward_out=os.path.join(sample_tmp_dir, 'rmlst_R1.fastq.gz'),
                                                reverse_out=os.path.join(sample_tmp_dir, 'rmlst_R2.fastq.gz'),
                                                threads=threads,
-                                               returncmd=True)
+                                               returncmd=True,
+                                               log=log)
         else:
             out, err, cmd = bbtools.bbduk_bait(reference=sample_database,
                                                forward_in=pair[0],
@@ -635,7 +1291,8 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
                                                reverse_out=os.path.join(sample_tmp_dir, 'rmlst_R2.fastq.gz'),
                                                threads=threads,
                                                Xmx=xmx,
-                                               returncmd=True)
+                                               returncmd=True,
+                                               log=log)
     else:
         if data_type == 'Nanopore' or fasta:
             forward_out = os.path.join(sample_tmp_dir, 'trimmed.fastq.gz')
@@ -644,12 +1301,32 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
         if xmx is None:
             out, err, cmd = bbtools.bbduk_bait(reference=sample_database, forward_in=pair[0],
                                                forward_out=forward_out,
-                                               returncmd=True, threads=threads)
+                                               returncmd=True, threads=threads,
+                                               log=log)
         else:
             out, err, cmd = bbtools.bbduk_bait(reference=sample_database, forward_in=pair[0],
                                                forward_out=forward_out, Xmx=xmx,
-                                               returncmd=True, threads=threads)
-    write_to_logfile(log, out, err, cmd)
+                                               returncmd=True, threads=threads,
+                                               log=log)
+    if baited_reads is None:
+        baited_reads, baited_bases = find_baited_read_stats(err)
+    # If hardly anything got baited out (wrong organism, empty library, failed run), there's no point in running the
+    # rest of the pipeline - report the sample as is and move on.
+    if not fasta:
+        index_fasta(sample_database)
+        database_gene_length = find_database_gene_length(sample_database)
+        if baited_bases is not None and database_gene_length > 0:
+            core_coverage = baited_bases / database_gene_length
+            logging.debug('Baited {} reads ({} bases), estimated core gene coverage is {:.2f}X'
+                          .format(baited_reads, baited_bases, core_coverage))
+            if core_coverage < min_coverage:
+                logging.info('Estimated core gene coverage ({:.2f}X) is below the minimum of {}X. Skipping rest of '
+                             'analysis...\n'.format(core_coverage, min_coverage))
+                return {'result': {'multi_positions': 'ND',
+                                   'percent_contam': 'ND',
+                                   'contam_stddev': 'ND',
+                                   'total_gene_length': 0,
+                                   'status': 'Low core gene coverage'}}
     logging.info('Quality trimming...')
     if data_type == 'Illumina':
         if paired:
@@ -658,7 +1335,7 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
                                                    reverse_in=os.path.join(sample_tmp_dir, 'rmlst_R2.fastq.gz'),
                                                    forward_out=os.path.join(sample_tmp_dir, 'trimmed_R1.fastq.gz'),
                                                    reverse_out=os.path.join(sample_tmp_dir, 'trimmed_R2.fastq.gz'),
-                                                   threads=str(threads), returncmd=True)
+                                                   threads=str(threads), returncmd=True, log=log)
             else:
                 out, err, cmd = bbtools.bbduk_trim(forward_in=os.path.join(sample_tmp_dir, 'rmlst_R1.fastq.gz'),
                                                    reverse_in=os.path.join(sample_tmp_dir, 'rmlst_R2.fastq.gz'),
@@ -666,7 +1343,8 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
                                                    reverse_out=os.path.join(sample_tmp_dir, 'trimmed_R2.fastq.gz'),
                                                    Xmx=xmx,
                                                    threads=str(threads),
-                                                   returncmd=True)
+                                                   returncmd=True,
+                                                   log=log)
 
         else:
             if not fasta:
@@ -674,40 +1352,78 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
                     out, err, cmd = bbtools.bbduk_trim(forward_in=os.path.join(sample_tmp_dir, 'rmlst.fastq.gz'),
                                                        forward_out=os.path.join(sample_tmp_dir, 'trimmed.fastq.gz'),
                                                        returncmd=True,
-                                                       threads=threads)
+                                                       threads=threads,
+                                                       log=log)
                 else:
                     out, err, cmd = bbtools.bbduk_trim(forward_in=os.path.join(sample_tmp_dir, 'rmlst.fastq.gz'),
                                                        forward_out=os.path.join(sample_tmp_dir, 'trimmed.fastq.gz'),
                                                        returncmd=True,
                                                        threads=threads,
-                                                       Xmx=xmx)
-        write_to_logfile(log, out, err, cmd)
+                                                       Xmx=xmx,
+                                                       log=log)
+
+    forward_reads = os.path.join(sample_tmp_dir, 'trimmed_R1.fastq.gz')
+    reverse_reads = os.path.join(sample_tmp_dir, 'trimmed_R2.fastq.gz')
+    unpaired_reads = os.path.join(sample_tmp_dir, 'trimmed.fastq.gz')
+    # PCR duplicates add depth without adding evidence. Since we only have the baited reads at this point, removing
+    # them is cheap.
+    duplicates_removed = 'ND'
+    if dedupe and data_type == 'Illumina' and not fasta:
+        logging.info('Removing duplicate reads...')
+        if paired:
+            out, err, cmd = remove_duplicate_reads(forward_in=forward_reads,
+                                                   forward_out=os.path.join(sample_tmp_dir, 'dedupe_R1.fastq.gz'),
+                                                   reverse_in=reverse_reads,
+                                                   reverse_out=os.path.join(sample_tmp_dir, 'dedupe_R2.fastq.gz'),
+                                                   threads=threads,
+                                                   xmx=xmx,
+                                                   log=log)
+            forward_reads = os.path.join(sample_tmp_dir, 'dedupe_R1.fastq.gz')
+            reverse_reads = os.path.join(sample_tmp_dir, 'dedupe_R2.fastq.gz')
+        else:
+            out, err, cmd = remove_duplicate_reads(forward_in=unpaired_reads,
+                                                   forward_out=os.path.join(sample_tmp_dir, 'dedupe.fastq.gz'),
+                                                   threads=threads,
+                                                   xmx=xmx,
+                                                   log=log)
+            unpaired_reads = os.path.join(sample_tmp_dir, 'dedupe.fastq.gz')
+        duplicates_removed = find_number_duplicates_removed(err)
+        logging.debug('Removed {} duplicate reads'.format(duplicates_removed))
+
+    # Overlapping mates cover the same bases twice in the pileup. If requested, merge them into single reads and
+    # carry the unmerged pairs alongside them through KMA and mapping.
+    merged = paired and merge_reads and data_type == 'Illumina'
+    if merged:
+        logging.info('Merging overlapping read pairs...')
+        out, err, cmd = merge_overlapping_reads(forward_in=forward_reads,
+                                                reverse_in=reverse_reads,
+                                                merged_out=os.path.join(sample_tmp_dir, 'merged.fastq.gz'),
+                                                forward_out=os.path.join(sample_tmp_dir, 'unmerged_R1.fastq.gz'),
+                                                reverse_out=os.path.join(sample_tmp_dir, 'unmerged_R2.fastq.gz'),
+                                                threads=threads,
+                                                xmx=xmx,
+                                                log=log)
+        forward_reads = os.path.join(sample_tmp_dir, 'unmerged_R1.fastq.gz')
+        reverse_reads = os.path.join(sample_tmp_dir, 'unmerged_R2.fastq.gz')
 
     logging.info('Detecting contamination...')
     # Now do mapping in two steps - first, map reads back to database with ambiguous reads matching all - this
     # will be used to get a count of number of reads aligned to each gene/allele so we can create a custom rmlst file
     # with only the most likely allele for each gene.
-    if not os.path.isfile(sample_database + '.fai'):  # Don't bother re-indexing, this only needs to happen once.
-        pysam.faidx(sample_database)
-    kma_database = sample_database.replace('.fasta', '') + '_kma'
+    kma_database = index_database(sample_database, log=log)
     kma_report = os.path.join(sample_tmp_dir, 'kma_rmlst')
-    if not os.path.isfile(kma_database + '.name'):  # The .name is one of the files KMA creates when making a database.
-        logging.info('Since this is the first time you are using this database, it needs to be indexed by KMA. '
-                     'This might take a while')
-        cmd = 'kma index -i {} -o {}'.format(sample_database, kma_database)  # NOTE: Need KMA >=1.2.0 for this to work.
-        out, err = run_cmd(cmd)
-        write_to_logfile(log, out, err, cmd)
 
     # Run KMA.
     if paired:
         cmd = 'kma -ipe {forward_in} {reverse_in} -t_db {kma_database} -o {kma_report} ' \
-              '-t {threads}'.format(forward_in=os.path.join(sample_tmp_dir, 'trimmed_R1.fastq.gz'),
-                                    reverse_in=os.path.join(sample_tmp_dir, 'trimmed_R2.fastq.gz'),
+              '-t {threads}'.format(forward_in=forward_reads,
+                                    reverse_in=reverse_reads,
                                     kma_database=kma_database,
                                     kma_report=kma_report,
                                     threads=threads)
-        out, err = run_cmd(cmd)
-        write_to_logfile(log, out, err, cmd)
+        if merged:
+            cmd += ' -i {}'.format(os.path.join(sample_tmp_dir, 'merged.fastq.gz'))
+        out, err = kma_shm.run_kma(cmd, kma_database, log=log)
     else:
         if data_type == 'Illumina':
             # Use the FASTA file (rather than the readsd) as the input
@@ -720,114 +1436,200 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
                             threads=threads)
             else:
                 cmd = 'kma -i {input_reads} -t_db {kma_database} -o {kma_report} ' \
-                      '-t {threads}'.format(input_reads=os.path.join(sample_tmp_dir, 'trimmed.fastq.gz'),
+                      '-t {threads}'.format(input_reads=unpaired_reads,
                                             kma_database=kma_database,
                                             kma_report=kma_report,
                                             threads=threads)
         else:
             # Recommended Nanopore settings from KMA repo: https://bitbucket.org/genomicepidemiology/kma
             cmd = 'kma -i {input_reads} -t_db {kma_database} -o {kma_report} -mem_mode -mp 20 -mrs 0.0 -bcNano ' \
-                  '-t {threads}'.format(input_reads=os.path.join(sample_tmp_dir, 'trimmed.fastq.gz'),
+                  '-t {threads}'.format(input_reads=unpaired_reads,
                                         kma_database=kma_database,
                                         kma_report=kma_report,
                                         threads=threads)
-        out, err = run_cmd(cmd)
-        write_to_logfile(log, out, err, cmd)
+        out, err = kma_shm.run_kma(cmd, kma_database, log=log)
 
-    rmlst_report = os.path.join(output_folder, sample_name + '_rmlst.csv')
+    rmlst_report = os.path.join(output_folder, report_name + '_rmlst.csv')
     gene_alleles = find_rmlst_type(kma_report=kma_report + '.res',
                                    rmlst_report=rmlst_report)
 
-    with open(os.path.join(sample_tmp_dir, 'rmlst.fasta'), 'w') as f:
-        for contig in SeqIO.parse(sample_database, 'fasta'):
-            if contig.id in gene_alleles:
-                f.write('>{}\n'.format(contig.id))
-                f.write(str(contig.seq) + '\n')
-
-    rmlst_gene_length = find_total_sequence_length(os.path.join(sample_tmp_dir, 'rmlst.fasta'))
+    if reference_cache is None:
+        reference = os.path.join(sample_tmp_dir, 'rmlst.fasta')
+        rmlst_gene_length = write_core_gene_reference(database=sample_database,
+                                                      gene_alleles=gene_alleles,
+                                                      reference=reference)
+        aligner_index = None
+    else:
+        reference, aligner_index = find_cached_reference(database=sample_database,
+                                                         gene_alleles=gene_alleles,
+                                                         reference_cache=reference_cache,
+                                                         aligner='bbmap' if data_type == 'Illumina' and not fasta
+                                                         else 'minimap2',
+                                                         log=log)
+        with pysam.FastaFile(reference) as f:
+            rmlst_gene_length = sum(f.lengths)
     logging.debug('Total gene length is {}'.format(rmlst_gene_length))
-    pysam_pass = True
-    # Second step of mapping - Do a mapping of our baited reads against a fasta file that has only one allele per
-    # rMLST gene.
-    try:
-        pysam.faidx(os.path.join(sample_tmp_dir, 'rmlst.fasta'))
-        if paired:
-            cmd = 'bbmap.sh ref={ref} in={forward_in} in2={reverse_in} out={outbam} threads={threads} mdtag ' \
-                  'nodisk'.format(ref=os.path.join(sample_tmp_dir, 'rmlst.fasta'),
-                                  forward_in=os.path.join(sample_tmp_dir, 'trimmed_R1.fastq.gz'),
-                                  reverse_in=os.path.join(sample_tmp_dir, 'trimmed_R2.fastq.gz'),
-                                  outbam=os.path.join(sample_tmp_dir, 'out_2.bam'),
-                                  threads=threads)
-            if cgmlst_db is not None:
-                # Lots of core genes seem to have relatives within a genome that are at ~70 percent identity. This means
-                # that reads that shouldn't map do, and cause false positives. Adding in this sub-filter means that
-                # reads can only have one mismatch, so they actually have to be from the right gene for this to work.
-                cmd += ' subfilter=1'
-            if xmx:
-                cmd += ' -Xmx{}'.format(xmx)
-            out, err = run_cmd(cmd)
-            write_to_logfile(log, out, err, cmd)
-        else:
-            #
-            if data_type == 'Illumina' and not fasta:
-                cmd = 'bbmap.sh ref={ref} in={forward_in} out={outbam} threads={threads} mdtag ' \
-                      'nodisk'.format(ref=os.path.join(sample_tmp_dir, 'rmlst.fasta'),
-                                      forward_in=os.path.join(sample_tmp_dir, 'trimmed.fastq.gz'),
-                                      outbam=os.path.join(sample_tmp_dir, 'out_2.bam'),
-                                      threads=threads)
-                if cgmlst_db is not None:
-                    # Core genes can have relatives within a genome that are at ~70 percent identity. This means
-                    # that reads that shouldn't map do, and cause false positives. Adding in this sub-filter means that
-                    # reads can only have one mismatch, so they have to be from the right gene for this to work.
-                    cmd += ' subfilter=1'
-                if xmx:
-                    cmd += ' -Xmx{}'.format(xmx)
-                out, err = run_cmd(cmd)
-                write_to_logfile(log, out, err, cmd)
-            else:
-                cmd = 'minimap2 --MD -t {threads} -ax map-ont {ref} {reads} ' \
-                      '> {outsam}'.format(ref=os.path.join(sample_tmp_dir, 'rmlst.fasta'),
-                                          reads=os.path.join(sample_tmp_dir, 'trimmed.fastq.gz'),
-                                          outsam=os.path.join(sample_tmp_dir, 'out_2.sam'),
-                                          threads=threads)
-                out, err = run_cmd(cmd)
-                write_to_logfile(log, out, err, cmd)
-                outbam = os.path.join(sample_tmp_dir, 'out_2.bam')
-                # Apparently have to perform equivalent of a touch on this file for this to work.
-                fh = open(outbam, 'w')
-                fh.close()
-                pysam.view('-b', '-o', outbam, os.path.join(sample_tmp_dir, 'out_2.sam'), save_stdout=outbam)
-        pysam.sort('-o', os.path.join(sample_tmp_dir, 'contamination.bam'), os.path.join(sample_tmp_dir, 'out_2.bam'))
-        pysam.index(os.path.join(sample_tmp_dir, 'contamination.bam'))
-        # Now find number of multi-positions for each rMLST gene/allele combination
-        multi_positions = 0
-
-        # Run the BAM parsing in parallel! Some refactoring of the code would likely be a good idea so this
-        # isn't quite so ugly, but it works.
-        p = multiprocessing.Pool(processes=threads)
-        bamfile_list = [os.path.join(sample_tmp_dir, 'contamination.bam')] * len(gene_alleles)
-        # bamfile_list = [os.path.join(sample_tmp_dir, 'rmlst.bam')] * len(gene_alleles)
-        reference_fasta_list = [os.path.join(sample_tmp_dir, 'rmlst.fasta')] * len(gene_alleles)
-        fasta_list = [fasta] * len(gene_alleles)
-        quality_cutoff_list = [quality_cutoff] * len(gene_alleles)
-        base_cutoff_list = [base_cutoff] * len(gene_alleles)
-        base_fraction_list = [base_fraction_cutoff] * len(gene_alleles)
-        multibase_dict_list = list()
-        report_write_list = list()
-        for multibase_dict, report_write in p.starmap(read_contig, zip(gene_alleles, bamfile_list, reference_fasta_list,
-                                                                       quality_cutoff_list, base_cutoff_list,
-                                                                       base_fraction_list, fasta_list), chunksize=1):
-            multibase_dict_list.append(multibase_dict)
-            report_write_list.append(report_write)
-        p.close()
-        p.join()
-    except SamtoolsError:
-        pysam_pass = False
-        multi_positions = 0
-        multibase_dict_list = list()
-        report_write_list = list()
+    return {'sample_tmp_dir': sample_tmp_dir,
+            'report_name': report_name,
+            'paired': paired,
+            'merged': merged,
+            'forward_reads': forward_reads,
+            'reverse_reads': reverse_reads,
+            'unpaired_reads': unpaired_reads,
+            'merged_reads': os.path.join(sample_tmp_dir, 'merged.fastq.gz'),
+            'reference': reference,
+            'aligner_index': aligner_index,
+            'gene_alleles': gene_alleles,
+            'rmlst_gene_length': rmlst_gene_length,
+            'duplicates_removed': duplicates_removed}
+
+
+def build_bbmap_cmd(reference, forward_in, outbam, threads=1, reverse_in=None, cgmlst_db=None, xmx=None,
+                    index=None):
+    """
+    Creates the bbmap command used to map baited reads to their core gene reference.
+    :param reference: Path to reference fasta (rmlst.fasta)
+    :param index: Folder with an index already built for the reference (see build_aligner_index). If None, bbmap
+    builds one in memory.
+    :param forward_in: Path to forward (or unpaired) reads.
+    :param outbam: Path to BAM file to create.
+    :param threads: Number of threads to use.
+    :param reverse_in: Path to reverse reads, if reads are paired.
+    :param cgmlst_db: If not None, reads are only allowed a single mismatch.
+    :param xmx: Memory to give to bbmap, if not None.
+    :return: Command string.
+    """
+    if index is None:
+        cmd = 'bbmap.sh ref={ref} in={forward_in} '.format(ref=reference, forward_in=forward_in)
+    else:
+        cmd = 'bbmap.sh path={index} in={forward_in} '.format(index=index, forward_in=forward_in)
+    if reverse_in is not None:
+        cmd += 'in2={reverse_in} '.format(reverse_in=reverse_in)
+    cmd += 'out={outbam} threads={threads} mdtag'.format(outbam=outbam, threads=threads)
+    if index is None:
+        cmd += ' nodisk'
+    if cgmlst_db is not None:
+        # Lots of core genes seem to have relatives within a genome that are at ~70 percent identity. This means
+        # that reads that shouldn't map do, and cause false positives. Adding in this sub-filter means that
+        # reads can only have one mismatch, so they actually have to be from the right gene for this to work.
+        cmd += ' subfilter=1'
+    if xmx:
+        cmd += ' -Xmx{}'.format(xmx)
+    return cmd
+
+
+def map_to_core_genes(typing, log, threads=1, cgmlst_db=None, xmx=None, data_type='Illumina', fasta=False):
+    """
+    Second step of mapping - maps baited reads against a fasta file that has only one allele per core gene, creating
+    out_2.bam in the sample's temporary folder.
+    :param typing: Dictionary created by type_core_genes.
+    :param log: Logfile to write commands, stdout and stderr to.
+    See find_contamination for all other parameters.
+    """
+    sample_tmp_dir = typing['sample_tmp_dir']
+    reference = typing['reference']
+    index = typing.get('aligner_index')
+    index_fasta(reference)
+    if typing['paired']:
+        cmd = build_bbmap_cmd(reference=reference,
+                              forward_in=typing['forward_reads'],
+                              reverse_in=typing['reverse_reads'],
+                              outbam=os.path.join(sample_tmp_dir, 'out_pairs.bam' if typing['merged'] else 'out_2.bam'),
+                              threads=threads,
+                              cgmlst_db=cgmlst_db,
+                              xmx=xmx,
+                              index=index)
+        out, err = run_cmd(cmd, log=log)
+        if typing['merged']:
+            # bbmap can't take paired and single reads in one go, so map the merged reads separately and combine.
+            cmd = build_bbmap_cmd(reference=reference,
+                                  forward_in=typing['merged_reads'],
+                                  outbam=os.path.join(sample_tmp_dir, 'out_merged.bam'),
+                                  threads=threads,
+                                  cgmlst_db=cgmlst_db,
+                                  xmx=xmx,
+                                  index=index)
+            out, err = run_cmd(cmd, log=log)
+            # Merging only keeps reads in order if what's being merged is sorted.
+            for bam in ('out_pairs', 'out_merged'):
+                pysam.sort('-o', os.path.join(sample_tmp_dir, bam + '_sorted.bam'),
+                           os.path.join(sample_tmp_dir, bam + '.bam'))
+            pysam.merge('-f', os.path.join(sample_tmp_dir, 'out_2.bam'),
+                        os.path.join(sample_tmp_dir, 'out_pairs_sorted.bam'),
+                        os.path.join(sample_tmp_dir, 'out_merged_sorted.bam'))
+            pysam.index(os.path.join(sample_tmp_dir, 'out_2.bam'))
+    elif data_type == 'Illumina' and not fasta:
+        cmd = build_bbmap_cmd(reference=reference,
+                              forward_in=typing['unpaired_reads'],
+                              outbam=os.path.join(sample_tmp_dir, 'out_2.bam'),
+                              threads=threads,
+                              cgmlst_db=cgmlst_db,
+                              xmx=xmx,
+                              index=index)
+        out, err = run_cmd(cmd, log=log)
+    else:
+        # minimap2 takes a prebuilt index in place of the reference.
+        target = reference if index is None else index
+        cmd = 'minimap2 --MD -t {threads} -ax map-ont {ref} {reads}'.format(ref=target,
+                                                                            reads=typing['unpaired_reads'],
+                                                                            threads=threads)
+        out, err = run_cmd(cmd, log=log, stdout_file=os.path.join(sample_tmp_dir, 'out_2.sam'))
+        outbam = os.path.join(sample_tmp_dir, 'out_2.bam')
+        # Apparently have to perform equivalent of a touch on this file for this to work.
+        fh = open(outbam, 'w')
+        fh.close()
+        pysam.view('-b', '-o', outbam, os.path.join(sample_tmp_dir, 'out_2.sam'), save_stdout=outbam)
+
+
+def find_contamination_from_bam(typing, output_folder, pysam_pass=True, threads=1, quality_cutoff=20, base_cutoff=2,
+                                base_fraction_cutoff=0.05, cgmlst_db=None, fasta=False):
+    """
+    Last part of the analysis of a genus, after type_and_map_genus - looks through the pileup of out_2.bam for sites
+    with multiple alleles, and writes the sample's contamination report.
+    :param typing: Dictionary created by type_core_genes.
+    :param output_folder: Folder where the contamination report will be written.
+    :param pysam_pass: False if something already went wrong creating out_2.bam.
+    See find_contamination for all other parameters.
+    :return: Dictionary of values that should be passed to write_output.
+    """
+    sample_tmp_dir = typing['sample_tmp_dir']
+    gene_alleles = typing['gene_alleles']
+    rmlst_gene_length = typing['rmlst_gene_length']
+    multi_positions = 0
+    multibase_dict_list = list()
+    report_write_list = list()
+    if pysam_pass:
+        try:
+            pysam.sort('-o', os.path.join(sample_tmp_dir, 'contamination.bam'),
+                       os.path.join(sample_tmp_dir, 'out_2.bam'))
+            pysam.index(os.path.join(sample_tmp_dir, 'contamination.bam'))
+            # Now find number of multi-positions for each rMLST gene/allele combination
+            # Run the BAM parsing in parallel! Some refactoring of the code would likely be a good idea so this
+            # isn't quite so ugly, but it works.
+            p = create_process_pool(threads)
+            bamfile_list = [os.path.join(sample_tmp_dir, 'contamination.bam')] * len(gene_alleles)
+            # bamfile_list = [os.path.join(sample_tmp_dir, 'rmlst.bam')] * len(gene_alleles)
+            reference_fasta_list = [typing['reference']] * len(gene_alleles)
+            fasta_list = [fasta] * len(gene_alleles)
+            quality_cutoff_list = [quality_cutoff] * len(gene_alleles)
+            base_cutoff_list = [base_cutoff] * len(gene_alleles)
+            base_fraction_list = [base_fraction_cutoff] * len(gene_alleles)
+            for multibase_dict, report_write in p.starmap(read_contig, zip(gene_alleles, bamfile_list,
+                                                                           reference_fasta_list, quality_cutoff_list,
+                                                                           base_cutoff_list, base_fraction_list,
+                                                                           fasta_list), chunksize=1):
+                multibase_dict_list.append(multibase_dict)
+                report_write_list.append(report_write)
+            p.close()
+            p.join()
+        except SamtoolsError:
+            pysam_pass = False
+            multi_positions = 0
+            multibase_dict_list = list()
+            report_write_list = list()
+
     # Write out report info.
-    report_file = os.path.join(output_folder, sample_name + '_contamination.csv')
+    report_file = os.path.join(output_folder, typing['report_name'] + '_contamination.csv')
     with open(report_file, 'w') as r:
         r.write('{reference},{position},{bases},{coverage}\n'.format(reference='Gene',
                                                                      position='Position',
@@ -852,22 +1654,808 @@ def find_contamination(pair, output_folder, databases_folder, forward_id='_R1',
         percent_contam = 0
         contam_stddev = 0
     logging.info('Done! Number of contaminating SNVs found: {}\n'.format(multi_positions))
+    return {'multi_positions': multi_positions,
+            'percent_contam': percent_contam,
+            'contam_stddev': contam_stddev,
+            'total_gene_length': rmlst_gene_length,
+            'snp_cutoff': snp_cutoff,
+            'pysam_pass': pysam_pass,
+            'duplicates_removed': typing['duplicates_removed']}
+
+
+def find_database_download_date(databases_folder):
+    """
+    :param databases_folder: Full path to folder where ConFindr's databases live.
+    :return: Date rMLST databases were downloaded, or ND if they haven't been.
+    """
+    if os.path.isfile(os.path.join(databases_folder, 'download_date.txt')):
+        with open(os.path.join(databases_folder, 'download_date.txt')) as f:
+            return f.readline().rstrip()
+    return 'ND'
+
+
+def screen_sample(pair, output_folder, databases_folder, forward_id='_R1', threads=1, min_matching_hashes=40):
+    """
+    Works out a sample's name, creates its temporary folder, and checks what genera are present in it.
+    :param pair: Reads for the sample, as for find_contamination.
+    :param output_folder: Folder where outputs are stored. The sample's temporary folder is created here.
+    :param databases_folder: Full path to folder where ConFindr's databases live.
+    :param forward_id: Identifier that marks reads as being in the forward direction for paired reads.
+    :param threads: Number of threads to run mash with.
+    :param min_matching_hashes: Minimum number of matching hashes for a genus to be considered present.
+    :return: Sample name, path to the sample's temporary folder, and genus (genera separated by : if more than one).
+    """
+    log = os.path.join(output_folder, 'confindr_log.txt')
+    if len(pair) == 2:
+        sample_name = os.path.split(pair[0])[-1].split(forward_id)[0]
+        paired = True
+        logging.debug('Sample is paired. Sample name is {}'.format(sample_name))
+    else:
+        sample_name = os.path.split(pair[0])[-1].split('.')[0]
+        paired = False
+        logging.debug('Sample is unpaired. Sample name is {}'.format(sample_name))
+    sample_tmp_dir = os.path.join(output_folder, sample_name)
+    if not os.path.isdir(sample_tmp_dir):
+        os.makedirs(sample_tmp_dir)
+
+    logging.info('Checking for cross-species contamination...')
+    if paired:
+        genus = find_cross_contamination(databases_folder,
+                                         reads=pair,
+                                         tmpdir=sample_tmp_dir,
+                                         log=log,
+                                         threads=threads,
+                                         min_matching_hashes=min_matching_hashes)
+    else:
+        genus = find_cross_contamination(databases_folder,
+                                         reads=pair[0],
+                                         tmpdir=sample_tmp_dir,
+                                         log=log,
+                                         threads=threads,
+                                         min_matching_hashes=min_matching_hashes)
+    return sample_name, sample_tmp_dir, genus
+
+
+def prescreen_samples(pairs, output_folder, databases_folder, forward_id='_R1', threads=1, min_matching_hashes=40,
+                      regions=None, cram_reference=None, reverse_id='_R2'):
+    """
+    First phase of a run - gets every sample's reads ready and runs the mash genus screen on them, so that every
+    database that's going to be needed is known before any sample gets analysed.
+    :param pairs: List of reads for each sample, where each entry is what would be passed to find_contamination as
+    pair.
+    See find_contamination for all other parameters.
+    :return: List with a dictionary for each sample, in the same order as pairs. Each has the sample's name, reads
+    (pair), temporary folder, and genus. If screening the sample failed, error is the exception that was raised,
+    otherwise it's None.
+    """
+    samples = list()
+    for pair in pairs:
+        sample = {'sample_name': os.path.split(pair[0])[-1].split(forward_id)[0] if len(pair) == 2
+                  else os.path.split(pair[0])[-1].split('.')[0],
+                  'pair': pair,
+                  'sample_tmp_dir': None,
+                  'genus': None,
+                  'error': None}
+        samples.append(sample)
+        logging.info('Screening sample {}...'.format(sample['sample_name']))
+        try:
+            sample['pair'] = prepare_sample_reads(pair=pair,
+                                                  output_folder=output_folder,
+                                                  forward_id=forward_id,
+                                                  reverse_id=reverse_id,
+                                                  regions=regions,
+                                                  cram_reference=cram_reference)
+            _, sample['sample_tmp_dir'], sample['genus'] = screen_sample(pair=sample['pair'],
+                                                                         output_folder=output_folder,
+                                                                         databases_folder=databases_folder,
+                                                                         forward_id=forward_id,
+                                                                         threads=threads,
+                                                                         min_matching_hashes=min_matching_hashes)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            logging.warning('Could not screen sample {}. Error was:\n{}'.format(sample['sample_name'],
+                                                                               traceback.format_exc()))
+            sample['error'] = e
+    return samples
+
+
+def find_analysed_genera(genus, cross_details=False, all_genera=False):
+    """
+    :param genus: Genus found by the mash screen, with genera separated by : if more than one was found.
+    :param cross_details: If False, samples with more than one genus don't get analysed any further.
+    :param all_genera: If True (and cross_details is True), every genus found gets analysed.
+    :return: List of genera that will be analysed for a sample.
+    """
+    genera = genus.split(':')
+    if len(genera) > 1 and not cross_details:
+        return list()
+    if len(genera) > 1 and all_genera:
+        return genera
+    return genera[:1]
+
+
+def prepare_databases(samples, databases_folder, log, threads=1, tmpdir=None, use_rmlst=False, cgmlst_db=None,
+                      cross_details=False, all_genera=False, species_db=False, min_matching_hashes=40,
+                      bait_engine='bbduk', fasta=False, assembly_mode=False):
+    """
+    Second phase of a run - creates every database that the screened samples need, and indexes them all in parallel,
+    so that no sample has to wait on an index being built before it can be analysed.
+    :param samples: List of dictionaries created by prescreen_samples.
+    :param log: Logfile to write commands, stdout and stderr to.
+    See find_contamination for all other parameters.
+    :return: List of paths to the databases that were prepared. Each sample also gets a list of the databases it needs
+    added to it, as databases.
+    """
+    databases = list()
+    for sample in samples:
+        sample['databases'] = list()
+        if sample['error'] is not None:
+            continue
+        for genus in find_analysed_genera(sample['genus'], cross_details=cross_details, all_genera=all_genera):
+            # Writing out a database is done in python, so there's nothing to gain from doing these in parallel.
+            database = find_genus_database(genus=genus,
+                                           databases_folder=databases_folder,
+                                           tmpdir=tmpdir,
+                                           use_rmlst=use_rmlst,
+                                           cgmlst_db=cgmlst_db,
+                                           species=find_sample_species(sample['sample_tmp_dir'], genus, species_db,
+                                                                       min_matching_hashes))
+            if os.path.isfile(database):
+                sample['databases'].append(database)
+                if database not in databases:
+                    databases.append(database)
+    # Assemblies get aligned to with minimap2, which doesn't need any of the indexes.
+    if not databases or (fasta and assembly_mode):
+        return databases
+
+    def index_or_warn(database):
+        try:
+            index_database(database, log=log, bait_engine=bait_engine, fasta=fasta)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, SamtoolsError):
+            # Samples that use this database will try again, and be reported as errors if it still doesn't work.
+            logging.warning('Could not index {}. Error was:\n{}'.format(database, traceback.format_exc()))
+
+    logging.info('Preparing {} database(s)...'.format(len(databases)))
+    # Threads rather than processes, since indexing is mostly waiting on KMA.
+    p = ThreadPool(processes=max(1, min(threads, len(databases))))
+    p.map(index_or_warn, databases)
+    p.close()
+    p.join()
+    return databases
+
+
+def detach_unused_databases(samples, log):
+    """
+    Removes databases that none of samples need from shared memory (see kma_shm), so that they don't stay loaded for
+    the rest of the run once the last sample that needed them is done.
+    :param samples: Dictionaries created by prescreen_samples for the samples still to be analysed, with the databases
+    they need added by prepare_databases.
+    :param log: Logfile to write commands, stdout and stderr to.
+    """
+    kma_shm.detach_unused([find_kma_database(database) for sample in samples for database in sample['databases']],
+                          log=log)
+
+
+def find_error_result(sample_name, error):
+    """
+    Logs that a sample couldn't be analysed. Should be called while handling the error, so its traceback gets logged.
+    :param sample_name: Name of the sample.
+    :param error: CalledProcessError or TimeoutExpired that stopped the sample from being analysed.
+    :return: Dictionary of values that should be passed to write_output for the sample, along with ERROR_GENUS.
+    """
+    logging.warning('Encountered error when attempting to run ConFindr on sample '
+                    '{sample}. Skipping...'.format(sample=sample_name))
+    logging.warning('Error encounted was:\n{}'.format(traceback.format_exc()))
+    return {'multi_positions': 0,
+            'percent_contam': 'ND',
+            'contam_stddev': 'ND',
+            'total_gene_length': 0,
+            'status': 'Timed out' if isinstance(error, subprocess.TimeoutExpired) else None}
+
+
+def report_sample(output_folder, sample_name, genus, result, database_download_date, keep_files=False):
+    """
+    Writes a sample's row of the report, and removes its temporary folder if files aren't being kept.
+    :param output_folder: Folder the report is in.
+    :param sample_name: Name of the sample.
+    :param genus: Genus to report for the sample, or ERROR_GENUS if it couldn't be analysed.
+    :param result: Dictionary of values that should be passed to write_output for the sample.
+    :param database_download_date: Date the databases were downloaded. Not reported for samples that couldn't be
+    analysed.
+    :param keep_files: Boolean that says whether or not to keep temporary files.
+    """
     write_output(output_report=os.path.join(output_folder, 'confindr_report.csv'),
                  sample_name=sample_name,
-                 multi_positions=multi_positions,
                  genus=genus,
-                 percent_contam=percent_contam,
-                 contam_stddev=contam_stddev,
-                 total_gene_length=rmlst_gene_length,
-                 snp_cutoff=snp_cutoff,
-                 database_download_date=database_download_date,
-                 pysam_pass=pysam_pass)
-    if keep_files is False:
-        shutil.rmtree(sample_tmp_dir)
+                 database_download_date='ND' if genus == ERROR_GENUS else database_download_date,
+                 **result)
+    if keep_files is False and os.path.isdir(os.path.join(output_folder, sample_name)):
+        shutil.rmtree(os.path.join(output_folder, sample_name))
+
+
+def find_contamination(pair, output_folder, databases_folder, forward_id='_R1', threads=1, keep_files=False,
+                       quality_cutoff=20, base_cutoff=2, base_fraction_cutoff=0.05, cgmlst_db=None, xmx=None,
+                       tmpdir=None, data_type='Illumina', use_rmlst=False, cross_details=False, min_matching_hashes=40,
+                       fasta=False, merge_reads=False, dedupe=False, min_coverage=2, all_genera=False,
+                       species_db=False, bait_engine='bbduk', assembly_mode=False, regions=None, cram_reference=None,
+                       genus=None, reference_cache=None, reverse_id='_R2'):
+    """
+    This needs some documentation fairly badly, so here we go.
+    :param pair: This has become a misnomer. If the input reads are actually paired, needs to be a list
+    with the full filepath to forward reads at index 0 and full path to reverse reads at index 1.
+    If reads are unpaired, should be a list of length 1 with the only entry being the full filepath to read set.
+    :param output_folder: Folder where outputs (confindr log and report, and other stuff) will be stored.
+    This will be created if it does not exist. (I think - should write a test that double checks this).
+    :param databases_folder: Full path to folder where ConFindr's databases live. These files can be
+    downloaded from figshare in .tar.gz format (https://ndownloader.figshare.com/files/11864267), and
+    will be automatically downloaded if the script is run from the command line.
+    :param forward_id: Identifier that marks reads as being in the forward direction for paired reads.
+    Defaults to _R1
+    :param threads: Number of threads to run analyses with. All parts of this pipeline scale pretty well,
+    so more is better.
+    :param keep_files: Boolean that says whether or not to keep temporary files.
+    :param quality_cutoff: Integer of the phred score required to have a base count towards a multiallelic site.
+    :param base_cutoff: Integer of number of bases needed to have a base be part of a multiallelic site.
+    :param base_fraction_cutoff: Float of fraction of bases needed to have a base be part of a multiallelic site.
+    If specified will be used in parallel with base_cutoff
+    :param cgmlst_db: if None, we're using rMLST, if True, using some sort of custom cgMLST database. This requires some
+    custom parameters.
+    :param xmx: if None, BBTools will use auto memory detection. If string, BBTools will use what's specified as their
+    memory request.
+    :param tmpdir: if None, any genus-specifc databases that need to be created will be written to ConFindr DB location.
+    :param data_type: Either Illumina or Nanopore, depending on what type your reads are. (STR)
+    :param use_rmlst: If False, use cgderived data instead of rMLST where possible. If True, always use rMLST. (BOOL)
+    :param cross_details: If False, stop workflow when cross contamination is detected. If True, continue so estimates
+    of percent contamination can be found (BOOL)
+    :param min_matching_hashes: Minimum number of matching hashes in a MASH screen in order for a genus to be
+    considered present in a sample. Default is 40
+    :param fasta: Boolean on whether the samples are in FASTA format. Default is False
+    :param merge_reads: If True, overlapping read pairs are merged with bbmerge after trimming so that overlapping bases
+    aren't counted twice. Only used for paired Illumina reads. Default is False
+    :param dedupe: If True, duplicate reads are removed from the baited, trimmed reads before KMA and mapping. Only
+    used for Illumina reads. Default is False
+    :param min_coverage: Minimum estimated coverage of the core genes, based on the bases baited out by bbduk. Samples
+    below this are reported as having low coverage without any further analysis. Default is 2
+    :param all_genera: If True and cross_details is True, every genus found gets analysed in parallel instead of only
+    the predominant one, and each genus gets its own row in the report. Default is False
+    :param species_db: If True, the species of the sample is taken from the best mash screen hit for its genus, and a
+    database of only the rMLST alleles found in that species is used instead of the genus database. Default is False
+    :param bait_engine: Either bbduk or numpy. If numpy, core gene reads are baited out with kmer_bait instead of
+    BBDuk, which avoids starting up BBDuk for every sample. Not used for FASTA input. Default is bbduk
+    :param assembly_mode: If True and fasta is True, core gene alleles are aligned straight to the assembly and
+    contamination is called from core genes found more than once with different sequences. Default is False
+    :param regions: For BAM/CRAM input, list of (contig, start, end) tuples that core genes are found in. Only reads
+    in these regions (and their mates) are used. If None, every read in the file is used. Default is None
+    :param cram_reference: Reference FASTA that CRAM input was compressed against. Default is None
+    :param genus: Genus found for the sample by prescreen_samples (genera separated by : if more than one), in
+    which case pair should be the reads prescreen_samples got ready. If None, the sample gets screened here. Default
+    is None
+    :param reference_cache: Folder to keep mapping references (the typed allele for each core gene) and their aligner
+    indexes in, keyed by the alleles in them, so that samples with alleles that have been seen before can map straight
+    away. If None, every sample makes its own reference. Default is None
+    :param reverse_id: Identifier for reverse reads, used to name reads extracted from BAM/CRAM files. Defaults to _R2
+    """
+    sample = type_and_map_sample(pair=pair,
+                                 output_folder=output_folder,
+                                 databases_folder=databases_folder,
+                                 forward_id=forward_id,
+                                 reverse_id=reverse_id,
+                                 threads=threads,
+                                 cgmlst_db=cgmlst_db,
+                                 xmx=xmx,
+                                 tmpdir=tmpdir,
+                                 data_type=data_type,
+                                 use_rmlst=use_rmlst,
+                                 cross_details=cross_details,
+                                 min_matching_hashes=min_matching_hashes,
+                                 fasta=fasta,
+                                 merge_reads=merge_reads,
+                                 dedupe=dedupe,
+                                 min_coverage=min_coverage,
+                                 all_genera=all_genera,
+                                 species_db=species_db,
+                                 bait_engine=bait_engine,
+                                 assembly_mode=assembly_mode,
+                                 regions=regions,
+                                 cram_reference=cram_reference,
+                                 genus=genus,
+                                 reference_cache=reference_cache)
+    report_contamination(sample=sample,
+                         output_folder=output_folder,
+                         databases_folder=databases_folder,
+                         threads=threads,
+                         keep_files=keep_files,
+                         quality_cutoff=quality_cutoff,
+                         base_cutoff=base_cutoff,
+                         base_fraction_cutoff=base_fraction_cutoff,
+                         cgmlst_db=cgmlst_db,
+                         fasta=fasta)
+
+
+def type_and_map_sample(pair, output_folder, databases_folder, forward_id='_R1', threads=1, cgmlst_db=None, xmx=None,
+                        tmpdir=None, data_type='Illumina', use_rmlst=False, cross_details=False, min_matching_hashes=40,
+                        fasta=False, merge_reads=False, dedupe=False, min_coverage=2, all_genera=False,
+                        species_db=False, bait_engine='bbduk', assembly_mode=False, regions=None, cram_reference=None,
+                        genus=None, reference_cache=None, reverse_id='_R2'):
+    """
+    First part of find_contamination - gets the sample's reads ready, screens it if its genus isn't known yet, and
+    types and maps it for every genus that gets analysed. Only external programs and threads get started, so this
+    can be run from a worker thread (see find_contamination_parallel).
+    See find_contamination for parameters.
+    :return: Dictionary with the sample's name, temporary folder, and genus, along with the genera that were analysed
+    (an empty list if the sample was cross-contaminated and cross_details is False) and a dictionary created by
+    type_and_map_genus for each one, as typings.
+    """
+    log = os.path.join(output_folder, 'confindr_log.txt')
+    pair = prepare_sample_reads(pair=pair,
+                                output_folder=output_folder,
+                                forward_id=forward_id,
+                                reverse_id=reverse_id,
+                                regions=regions,
+                                cram_reference=cram_reference)
+    if genus is None:
+        sample_name, sample_tmp_dir, genus = screen_sample(pair=pair,
+                                                           output_folder=output_folder,
+                                                           databases_folder=databases_folder,
+                                                           forward_id=forward_id,
+                                                           threads=threads,
+                                                           min_matching_hashes=min_matching_hashes)
+    else:
+        sample_name = os.path.split(pair[0])[-1].split(forward_id)[0] if len(pair) == 2 \
+            else os.path.split(pair[0])[-1].split('.')[0]
+        sample_tmp_dir = os.path.join(output_folder, sample_name)
+    sample = {'sample_name': sample_name,
+              'sample_tmp_dir': sample_tmp_dir,
+              'genus': genus,
+              'genera': find_analysed_genera(genus, cross_details=cross_details, all_genera=all_genera),
+              'typings': list()}
+    if not sample['genera']:
+        logging.info('Found cross-contamination! Skipping rest of analysis...\n')
+        return sample
+    genus_arguments = list()
+    for sample_genus in sample['genera']:
+        genus_arguments.append({'pair': pair,
+                                'genus': sample_genus,
+                                'sample_tmp_dir': sample_tmp_dir,
+                                'output_folder': output_folder,
+                                'databases_folder': databases_folder,
+                                'report_name': sample_name,
+                                'log': log,
+                                'threads': threads,
+                                'cgmlst_db': cgmlst_db,
+                                'xmx': xmx,
+                                'tmpdir': tmpdir,
+                                'data_type': data_type,
+                                'use_rmlst': use_rmlst,
+                                'fasta': fasta,
+                                'merge_reads': merge_reads,
+                                'dedupe': dedupe,
+                                'min_coverage': min_coverage,
+                                'species': find_sample_species(sample_tmp_dir, sample_genus, species_db,
+                                                               min_matching_hashes),
+                                'bait_engine': bait_engine,
+                                'assembly_mode': assembly_mode,
+                                'reference_cache': reference_cache})
+    if len(genus_arguments) == 1:
+        # When cross-contamination was found, only the predominant genus gets analysed.
+        sample['typings'] = [type_and_map_genus(**genus_arguments[0])]
+        return sample
+    # Analyse every genus that was found at the same time, sharing our threads between them, so that getting a full
+    # report takes about as long as the slowest genus rather than all of them added up.
+    logging.info('Analysing genera {} in parallel...'.format(', '.join(sample['genera'])))
+    for genus_kwargs in genus_arguments:
+        genus_kwargs['sample_tmp_dir'] = os.path.join(sample_tmp_dir, genus_kwargs['genus'])
+        if not os.path.isdir(genus_kwargs['sample_tmp_dir']):
+            os.makedirs(genus_kwargs['sample_tmp_dir'])
+        genus_kwargs['report_name'] = '{}_{}'.format(sample_name, genus_kwargs['genus'])
+        # Each genus logs on its own, so output from different genera doesn't get mixed.
+        genus_kwargs['log'] = os.path.join(genus_kwargs['sample_tmp_dir'], 'confindr_log.txt')
+        genus_kwargs['threads'] = max(1, int(threads / len(genus_arguments)))
+    # Threads rather than processes here, since each genus spends its time waiting on external programs.
+    p = ThreadPool(processes=len(genus_arguments))
+    sample['typings'] = p.map(lambda kwargs: type_and_map_genus(**kwargs), genus_arguments)
+    p.close()
+    p.join()
+    with open(log, 'a') as log_handle:
+        for genus_kwargs in genus_arguments:
+            if os.path.isfile(genus_kwargs['log']):
+                with open(genus_kwargs['log']) as genus_log:
+                    shutil.copyfileobj(genus_log, log_handle)
+    return sample
+
+
+def report_contamination(sample, output_folder, databases_folder, threads=1, keep_files=False, quality_cutoff=20,
+                         base_cutoff=2, base_fraction_cutoff=0.05, cgmlst_db=None, fasta=False):
+    """
+    Last part of find_contamination - looks through the pileup for each genus typed by type_and_map_sample, and writes
+    the sample's rows of the report. Pileups are done one genus at a time, each using every thread.
+    :param sample: Dictionary created by type_and_map_sample.
+    See find_contamination for all other parameters.
+    """
+    database_download_date = find_database_download_date(databases_folder)
+    if not sample['genera']:
+        report_sample(output_folder=output_folder,
+                      sample_name=sample['sample_name'],
+                      genus=sample['genus'],
+                      result={'multi_positions': 0,
+                              'percent_contam': 'ND',
+                              'contam_stddev': 'ND',
+                              'total_gene_length': 0},
+                      database_download_date=database_download_date,
+                      keep_files=keep_files)
+        return
+    results = list()
+    for typing in sample['typings']:
+        if 'result' in typing:
+            results.append(typing['result'])
+            continue
+        results.append(find_contamination_from_bam(typing=typing,
+                                                   output_folder=output_folder,
+                                                   pysam_pass=typing['pysam_pass'],
+                                                   threads=threads,
+                                                   quality_cutoff=quality_cutoff,
+                                                   base_cutoff=base_cutoff,
+                                                   base_fraction_cutoff=base_fraction_cutoff,
+                                                   cgmlst_db=cgmlst_db,
+                                                   fasta=fasta))
+    if len(results) == 1:
+        report_sample(output_folder=output_folder,
+                      sample_name=sample['sample_name'],
+                      genus=sample['genus'],
+                      result=results[0],
+                      database_download_date=database_download_date,
+                      keep_files=keep_files)
+        return
+    for sample_genus, result in zip(sample['genera'], results):
+        # Each genus gets its own row. Finding more than one genus means the sample is contaminated no matter what the
+        # individual genera look like.
+        if result.get('pysam_pass', True) and result.get('status') is None:
+            result['status'] = True
+        write_output(output_report=os.path.join(output_folder, 'confindr_report.csv'),
+                     sample_name=sample['sample_name'],
+                     genus=sample_genus,
+                     database_download_date=database_download_date,
+                     **result)
+    if keep_files is False and os.path.isdir(sample['sample_tmp_dir']):
+        shutil.rmtree(sample['sample_tmp_dir'])
+
+
+def find_contamination_parallel(samples, output_folder, databases_folder, parallel_samples=1, forward_id='_R1',
+                                threads=1, keep_files=False, quality_cutoff=20, base_cutoff=2,
+                                base_fraction_cutoff=0.05, cgmlst_db=None, xmx=None, tmpdir=None,
+                                data_type='Illumina', use_rmlst=False, cross_details=False, min_matching_hashes=40,
+                                fasta=False, merge_reads=False, dedupe=False, min_coverage=2, all_genera=False,
+                                species_db=False, bait_engine='bbduk', assembly_mode=False, regions=None,
+                                cram_reference=None, reference_cache=None):
+    """
+    Runs find_contamination on samples that have been through prescreen_samples and prepare_databases. Up to
+    parallel_samples samples get typed and mapped at once (with threads split between them), while pileups get looked
+    through and reports written in this thread, one sample at a time in the same order as samples, with all threads.
+    :param samples: List of dictionaries created by prescreen_samples, with the databases they need added by
+    prepare_databases.
+    :param parallel_samples: Number of samples to type and map at once.
+    See find_contamination for all other parameters.
+    """
+    log = os.path.join(output_folder, 'confindr_log.txt')
+
+    def type_and_map(sample):
+        logging.info('Beginning analysis of sample {}...'.format(sample['sample_name']))
+        try:
+            if sample['error'] is not None:
+                raise sample['error']
+            return type_and_map_sample(pair=sample['pair'],
+                                       output_folder=output_folder,
+                                       databases_folder=databases_folder,
+                                       forward_id=forward_id,
+                                       threads=max(1, int(threads / parallel_samples)),
+                                       cgmlst_db=cgmlst_db,
+                                       xmx=xmx,
+                                       tmpdir=tmpdir,
+                                       data_type=data_type,
+                                       use_rmlst=use_rmlst,
+                                       cross_details=cross_details,
+                                       min_matching_hashes=min_matching_hashes,
+                                       fasta=fasta,
+                                       merge_reads=merge_reads,
+                                       dedupe=dedupe,
+                                       min_coverage=min_coverage,
+                                       all_genera=all_genera,
+                                       species_db=species_db,
+                                       bait_engine=bait_engine,
+                                       assembly_mode=assembly_mode,
+                                       regions=regions,
+                                       cram_reference=cram_reference,
+                                       genus=sample['genus'],
+                                       reference_cache=reference_cache)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            # If something unforeseen goes wrong, the sample gets added to the report with a note that it failed (or
+            # took too long).
+            return {'error_result': find_error_result(sample['sample_name'], e)}
+
+    for i, typed_sample in enumerate(map_samples(type_and_map, samples, parallel_samples=parallel_samples)):
+        try:
+            if 'error_result' in typed_sample:
+                report_sample(output_folder=output_folder,
+                              sample_name=samples[i]['sample_name'],
+                              genus=ERROR_GENUS,
+                              result=typed_sample['error_result'],
+                              database_download_date='ND',
+                              keep_files=keep_files)
+                continue
+            logging.info('Looking for multiple alleles in sample {}...'.format(typed_sample['sample_name']))
+            report_contamination(sample=typed_sample,
+                                 output_folder=output_folder,
+                                 databases_folder=databases_folder,
+                                 threads=threads,
+                                 keep_files=keep_files,
+                                 quality_cutoff=quality_cutoff,
+                                 base_cutoff=base_cutoff,
+                                 base_fraction_cutoff=base_fraction_cutoff,
+                                 cgmlst_db=cgmlst_db,
+                                 fasta=fasta)
+        finally:
+            # Samples still being typed are later in the list, so their databases are kept.
+            detach_unused_databases(samples[i + 1:], log=log)
+
+
+def find_batch_key(typing, data_type='Illumina', fasta=False):
+    """
+    Samples can only be mapped together when their reference (the best allele for each core gene) is exactly the
+    same, and their reads are of the same kind.
+    :param typing: Dictionary created by type_core_genes.
+    :param data_type: Either Illumina or Nanopore.
+    :param fasta: Boolean on whether the samples are in FASTA format.
+    :return: Key that is the same for all samples that can be mapped together, or None if the sample has to be
+    mapped on its own.
+    """
+    if data_type != 'Illumina' or fasta:
+        return None
+    with open(typing['reference'], 'rb') as f:
+        reference_hash = hashlib.md5(f.read()).hexdigest()
+    return reference_hash, typing['paired'], typing['merged']
+
+
+def tag_reads(reads_in, reads_out, tag):
+    """
+    Adds a tag to the start of every read name in a FASTQ file so that reads from different samples can be told
+    apart once they've been mapped together.
+    :param reads_in: Path to gzipped FASTQ file.
+    :param reads_out: Open file handle to write tagged reads to.
+    :param tag: Tag to add (STR). Separated from the read name by BATCH_TAG_SEPARATOR
+    """
+    with gzip.open(reads_in, 'rt') as f:
+        for i, line in enumerate(f):
+            if i % 4 == 0:
+                reads_out.write('@{}{}{}'.format(tag, BATCH_TAG_SEPARATOR, line[1:]))
+            else:
+                reads_out.write(line)
+
+
+def split_batch_bam(batch_bams, typings):
+    """
+    Splits reads that were mapped together by map_batch_to_core_genes back up by sample. Each sample's reads get the
+    tag removed from their names, are given a read group (RG) for that sample, and get written to out_2.bam in the
+    sample's temporary folder, so they can be used exactly as if the sample was mapped on its own.
+    :param batch_bams: List of BAM files created by map_batch_to_core_genes.
+    :param typings: List of dictionaries created by type_core_genes, in the same order as the tags used.
+    """
+    with pysam.AlignmentFile(batch_bams[0], 'rb') as bam:
+        header = bam.header.to_dict()
+    sample_bams = list()
+    for i, typing in enumerate(typings):
+        sample_header = dict(header)
+        sample_header['RG'] = [{'ID': str(i), 'SM': typing['report_name']}]
+        sample_bams.append(pysam.AlignmentFile(os.path.join(typing['sample_tmp_dir'], 'out_2.bam'), 'wb',
+                                               header=sample_header))
+    for batch_bam in batch_bams:
+        with pysam.AlignmentFile(batch_bam, 'rb') as bam:
+            for read in bam.fetch(until_eof=True):
+                tag, read.query_name = read.query_name.split(BATCH_TAG_SEPARATOR, 1)
+                read.set_tag('RG', tag)
+                sample_bams[int(tag)].write(read)
+    for sample_bam in sample_bams:
+        sample_bam.close()
+
+
+def map_batch_to_core_genes(typings, batch_dir, log, threads=1, cgmlst_db=None, xmx=None):
+    """
+    Does the same thing as map_to_core_genes, but for a group of samples that all have the same reference, and with
+    only one bbmap call for all of them. This avoids starting up bbmap and building its index over and over when there
+    are lots of samples of the same type.
+    :param typings: List of dictionaries created by type_core_genes. All must have the same batch key.
+    :param batch_dir: Folder to store the combined reads and BAM files in.
+    :param log: Logfile to write commands, stdout and stderr to.
+    See find_contamination for all other parameters.
+    """
+    if not os.path.isdir(batch_dir):
+        os.makedirs(batch_dir)
+    for typing in typings:
+        index_fasta(typing['reference'])
+    read_sets = [('forward_reads', 'reverse_reads')] if typings[0]['paired'] else [('unpaired_reads', None)]
+    if typings[0]['merged']:
+        # bbmap can't take paired and single reads in one go, so merged reads get mapped separately.
+        read_sets.append(('merged_reads', None))
+    batch_bams = list()
+    for forward_key, reverse_key in read_sets:
+        forward_out = os.path.join(batch_dir, forward_key + '_R1.fastq')
+        reverse_out = os.path.join(batch_dir, forward_key + '_R2.fastq')
+        with open(forward_out, 'w') as forward_handle:
+            for i, typing in enumerate(typings):
+                tag_reads(typing[forward_key], forward_handle, tag=str(i))
+        if reverse_key is not None:
+            with open(reverse_out, 'w') as reverse_handle:
+                for i, typing in enumerate(typings):
+                    tag_reads(typing[reverse_key], reverse_handle, tag=str(i))
+        batch_bam = os.path.join(batch_dir, forward_key + '.bam')
+        cmd = build_bbmap_cmd(reference=typings[0]['reference'],
+                              forward_in=forward_out,
+                              reverse_in=reverse_out if reverse_key is not None else None,
+                              outbam=batch_bam,
+                              threads=threads,
+                              cgmlst_db=cgmlst_db,
+                              xmx=xmx,
+                              index=typings[0].get('aligner_index'))
+        out, err = run_cmd(cmd, log=log)
+        batch_bams.append(batch_bam)
+    split_batch_bam(batch_bams, typings)
+
+
+def find_contamination_batch(pairs, output_folder, databases_folder, forward_id='_R1', threads=1, keep_files=False,
+                             quality_cutoff=20, base_cutoff=2, base_fraction_cutoff=0.05, cgmlst_db=None, xmx=None,
+                             tmpdir=None, data_type='Illumina', use_rmlst=False, cross_details=False,
+                             min_matching_hashes=40, fasta=False, merge_reads=False, dedupe=False, min_coverage=2,
+                             species_db=False, bait_engine='bbduk', regions=None, cram_reference=None,
+                             reference_cache=None, parallel_samples=1, reverse_id='_R2'):
+    """
+    Runs find_contamination on a whole set of samples, but with samples that end up with the same core gene
+    reference being mapped together in one bbmap call. Reports are the same as running each sample on its own.
+    :param pairs: List of reads for each sample, where each entry is what would be passed to find_contamination as
+    pair.
+    :param parallel_samples: Number of samples to type at once, with threads split between them.
+    See find_contamination for all other parameters.
+    """
+    database_download_date = find_database_download_date(databases_folder)
+    log = os.path.join(output_folder, 'confindr_log.txt')
+    # Screen every sample and get every database they need ready before analysing any of them.
+    samples = prescreen_samples(pairs=pairs,
+                                output_folder=output_folder,
+                                databases_folder=databases_folder,
+                                forward_id=forward_id,
+                                reverse_id=reverse_id,
+                                threads=threads,
+                                min_matching_hashes=min_matching_hashes,
+                                regions=regions,
+                                cram_reference=cram_reference)
+    prepare_databases(samples=samples,
+                      databases_folder=databases_folder,
+                      log=log,
+                      threads=threads,
+                      tmpdir=tmpdir,
+                      use_rmlst=use_rmlst,
+                      cgmlst_db=cgmlst_db,
+                      cross_details=cross_details,
+                      species_db=species_db,
+                      min_matching_hashes=min_matching_hashes,
+                      bait_engine=bait_engine,
+                      fasta=fasta)
+    # Then get everything up to mapping done for every sample.
+    def type_sample(sample):
+        sample['typing'] = None
+        logging.info('Beginning analysis of sample {}...'.format(sample['sample_name']))
+        try:
+            if sample['error'] is not None:
+                raise sample['error']
+            genus = sample['genus']
+            if len(genus.split(':')) > 1 and not cross_details:
+                logging.info('Found cross-contamination! Skipping rest of analysis...\n')
+                sample['result'] = {'multi_positions': 0,
+                                    'percent_contam': 'ND',
+                                    'contam_stddev': 'ND',
+                                    'total_gene_length': 0}
+                return
+            typing = type_core_genes(pair=sample['pair'],
+                                     genus=genus.split(':')[0],
+                                     sample_tmp_dir=sample['sample_tmp_dir'],
+                                     output_folder=output_folder,
+                                     databases_folder=databases_folder,
+                                     report_name=sample['sample_name'],
+                                     log=log,
+                                     threads=max(1, int(threads / parallel_samples)),
+                                     cgmlst_db=cgmlst_db,
+                                     xmx=xmx,
+                                     tmpdir=tmpdir,
+                                     data_type=data_type,
+                                     use_rmlst=use_rmlst,
+                                     fasta=fasta,
+                                     merge_reads=merge_reads,
+                                     dedupe=dedupe,
+                                     min_coverage=min_coverage,
+                                     species=find_sample_species(sample['sample_tmp_dir'], genus.split(':')[0],
+                                                                 species_db, min_matching_hashes),
+                                     bait_engine=bait_engine,
+                                     reference_cache=reference_cache)
+            if 'result' in typing:
+                sample['result'] = typing['result']
+            else:
+                sample['typing'] = typing
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            sample['genus'] = ERROR_GENUS
+            sample['result'] = find_error_result(sample['sample_name'], e)
+
+    for i, _ in enumerate(map_samples(type_sample, samples, parallel_samples=parallel_samples)):
+        # Mapping doesn't use KMA, so databases can be let go of as soon as the last sample that needs them is typed.
+        detach_unused_databases(samples[i + 1:], log=log)
+
+    # Group samples that can be mapped together.
+    batches = dict()
+    for sample in samples:
+        if sample['typing'] is not None:
+            key = find_batch_key(sample['typing'], data_type=data_type, fasta=fasta)
+            if key is None:
+                key = sample['sample_name']
+            if key not in batches:
+                batches[key] = list()
+            batches[key].append(sample)
+
+    for batch_number, batch in enumerate(batches.values()):
+        typings = [sample['typing'] for sample in batch]
+        mapped_together = False
+        if len(batch) > 1:
+            logging.info('Mapping {} samples with the same core gene alleles together: {}'
+                         .format(len(batch), ', '.join(sample['sample_name'] for sample in batch)))
+            try:
+                map_batch_to_core_genes(typings=typings,
+                                        batch_dir=os.path.join(output_folder, 'confindr_batch_{}'.format(batch_number)),
+                                        log=log,
+                                        threads=threads,
+                                        cgmlst_db=cgmlst_db,
+                                        xmx=xmx)
+                mapped_together = True
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired, SamtoolsError):
+                logging.warning('Could not map samples together, mapping them one at a time instead. Error was:\n{}'
+                                .format(traceback.format_exc()))
+            if keep_files is False and os.path.isdir(os.path.join(output_folder,
+                                                                  'confindr_batch_{}'.format(batch_number))):
+                shutil.rmtree(os.path.join(output_folder, 'confindr_batch_{}'.format(batch_number)))
+        for sample in batch:
+            pysam_pass = True
+            try:
+                if not mapped_together:
+                    map_to_core_genes(typing=sample['typing'],
+                                      log=log,
+                                      threads=threads,
+                                      cgmlst_db=cgmlst_db,
+                                      xmx=xmx,
+                                      data_type=data_type,
+                                      fasta=fasta)
+            except SamtoolsError:
+                pysam_pass = False
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                sample['genus'] = ERROR_GENUS
+                sample['result'] = find_error_result(sample['sample_name'], e)
+                continue
+            logging.info('Looking for multiple alleles in sample {}...'.format(sample['sample_name']))
+            sample['result'] = find_contamination_from_bam(typing=sample['typing'],
+                                                           output_folder=output_folder,
+                                                           pysam_pass=pysam_pass,
+                                                           threads=threads,
+                                                           quality_cutoff=quality_cutoff,
+                                                           base_cutoff=base_cutoff,
+                                                           base_fraction_cutoff=base_fraction_cutoff,
+                                                           cgmlst_db=cgmlst_db,
+                                                           fasta=fasta)
+
+    # Reports get written in the same order as samples were given, as they would be one at a time.
+    for sample in samples:
+        report_sample(output_folder=output_folder,
+                      sample_name=sample['sample_name'],
+                      genus=sample['genus'],
+                      result=sample['result'],
+                      database_download_date=database_download_date,
+                      keep_files=keep_files)
 
 
 def write_output(output_report, sample_name, multi_positions, genus, percent_contam, contam_stddev, total_gene_length,
-                 database_download_date, snp_cutoff=3, pysam_pass=True):
+                 database_download_date, snp_cutoff=3, pysam_pass=True, duplicates_removed='ND', status=None):
     """
     Function that writes the output generated by ConFindr to a report file. Appends to a file that already exists,
     or creates the file if it doesn't already exist.
@@ -882,13 +2470,17 @@ def write_output(output_report, sample_name, multi_positions, genus, percent_con
     :param database_download_date:
     :param snp_cutoff: Number of cSNVs to use to call a sample contaminated. Default 3. (INT)
     :param pysam_pass: Boolean of whether pysam encountered an error
+    :param duplicates_removed: Number of duplicate reads removed before mapping, or ND if deduplication wasn't done.
+    :param status: If specified, written to the ContamStatus column instead of a contamination call. (STR)
     """
     # If the report file hasn't been created, make it, with appropriate header.
     if not os.path.isfile(output_report):
         with open(os.path.join(output_report), 'w') as f:
             f.write('Sample,Genus,NumContamSNVs,ContamStatus,PercentContam,PercentContamStandardDeviation,'
-                    'BasesExamined,DatabaseDownloadDate\n')
-    if pysam_pass:
+                    'BasesExamined,DatabaseDownloadDate,DuplicatesRemoved\n')
+    if status is not None:
+        contaminated = status
+    elif pysam_pass:
         if multi_positions >= snp_cutoff or len(genus.split(':')) > 1:
             contaminated = True
         else:
@@ -901,14 +2493,16 @@ def write_output(output_report, sample_name, multi_positions, genus, percent_con
     with open(output_report, 'a+') as f:
         f.write('{samplename},{genus},{numcontamsnvs},'
                 '{contamstatus},{percent_contam},{contam_stddev},'
-                '{gene_length},{database_download_date}\n'.format(samplename=sample_name,
-                                                                  genus=genus,
-                                                                  numcontamsnvs=multi_positions,
-                                                                  contamstatus=contaminated,
-                                                                  percent_contam=percent_contam,
-                                                                  contam_stddev=contam_stddev,
-                                                                  gene_length=total_gene_length,
-                                                                  database_download_date=database_download_date))
+                '{gene_length},{database_download_date},'
+                '{duplicates_removed}\n'.format(samplename=sample_name,
+                                                genus=genus,
+                                                numcontamsnvs=multi_positions,
+                                                contamstatus=contaminated,
+                                                percent_contam=percent_contam,
+                                                contam_stddev=contam_stddev,
+                                                gene_length=total_gene_length,
+                                                database_download_date=database_download_date,
+                                                duplicates_removed=duplicates_removed))
 
 
 def check_for_databases_and_download(database_location):
@@ -916,18 +2510,32 @@ def check_for_databases_and_download(database_location):
     necessary_files = ['Escherichia_db_cgderived.fasta', 'Listeria_db_cgderived.fasta',
                        'Salmonella_db_cgderived.fasta', 'refseq.msh']
     optional_files = ['rMLST_combined.fasta', 'gene_allele.txt', 'profiles.txt']
-    all_files_present = True
-    for necessary_file in necessary_files:
-        if not os.path.isfile(os.path.join(database_location, necessary_file)):
-            logging.warning('Could not find {}'.format(necessary_file))
-            all_files_present = False
 
-    if not all_files_present:
+    def find_missing_files(manifest):
+        missing_files = list()
+        for necessary_file in necessary_files:
+            if not is_downloaded(os.path.join(database_location, necessary_file),
+                                 manifest['files'].get(necessary_file)):
+                missing_files.append(necessary_file)
+        return missing_files
+
+    missing_files = find_missing_files(read_manifest(database_location))
+    for missing_file in missing_files:
+        logging.warning('Could not find {}'.format(missing_file))
+
+    if missing_files:
         logging.warning('Databases not present - downloading basic databases now...')
         if not os.path.isdir(database_location):
-            os.makedirs(database_location)
-        download_mash_sketch(database_location)
-        download_cgmlst_derived_data(database_location)
+            os.makedirs(database_location, exist_ok=True)
+        # Jobs started at the same time on an empty database folder wait for the first one to download everything.
+        with build_lock(os.path.join(database_location, 'download')):
+            manifest = read_manifest(database_location)
+            if find_missing_files(manifest):
+                download_mash_sketch(database_location, manifest=manifest)
+                changed_files = download_cgmlst_derived_data(database_location, manifest=manifest)
+                invalidate_derived_databases(database_location, changed_loci=list(), old_allele_lists=dict(),
+                                             changed_files=changed_files)
+                write_manifest(manifest, database_location)
 
     optional_files_present = True
     for optional_file in optional_files:
@@ -1017,6 +2625,20 @@ def confindr(args):
                         '10 contaminating SNVs. Even then, results may be wonky. In particular, samples with lots of '
                         'depth will probably always show up as contaminated.')
 
+    # Every external program gets killed if it runs for too long, and gets tried again if it fails.
+    if args.timeout is not None and args.timeout <= 0:
+        logging.error('Timeout must be greater than 0 if specified. Input value was: {}'.format(args.timeout))
+        quit(code=1)
+    if args.parallel_samples < 1:
+        logging.error('Number of samples to work on at once must be at least 1. Input value was: {}'
+                      .format(args.parallel_samples))
+        quit(code=1)
+    runner.configure(timeout=args.timeout * 60 if args.timeout is not None else None,
+                     retries=args.retries)
+    kma_shm.configure(enabled=args.kma_shm)
+    # Shared databases have to be let go of however the run ends, or they stay loaded until another job cleans up.
+    atexit.register(kma_shm.detach_all, log=os.path.join(args.output_name, 'confindr_log.txt'))
+
     # Make the output directory.
     if not os.path.isdir(args.output_name):
         os.makedirs(args.output_name)
@@ -1029,6 +2651,14 @@ def confindr(args):
     min_matching_hashes = args.min_matching_hashes
     # Check if databases necessary to run are present, and download them if they aren't
     check_for_databases_and_download(database_location=args.databases)
+    # Databases derived from the ones in the database folder go in the cache if there is one, so later runs can use
+    # them, rather than in the tmpdir that gets deleted at the end of the run.
+    run_start = time.time()
+    database_tmpdir = args.tmp
+    reference_cache = None
+    if args.cache is not None:
+        database_tmpdir = database_cache.find_cache_folder(args.cache, args.databases)
+        reference_cache = database_cache.find_reference_cache(args.cache)
 
     # Figure out what pairs of reads, as well as unpaired reads, are present.
     paired_reads = find_paired_reads(args.input_directory,
@@ -1038,53 +2668,110 @@ def confindr(args):
                                          forward_id=args.forward_id,
                                          reverse_id=args.reverse_id,
                                          find_fasta=args.fasta)
+    # Reads archived as BAM/CRAM get turned back into FASTQ as they're analysed.
+    alignment_files = list() if args.fasta else find_alignment_files(args.input_directory)
+    regions = read_regions(args.regions) if args.regions is not None else None
     # Consolidate read lists
-    reads = sorted(paired_reads + unpaired_reads)
-    # Process paired reads, one sample at a time.
-    for fastq in reads:
-        if len(fastq) == 1:
-            sample_name = os.path.split(fastq[0])[-1].split('.')[0]
-        else:
-            sample_name = os.path.split(fastq[0])[-1].split(args.forward_id)[0]
-        logging.info('Beginning analysis of sample {}...'.format(sample_name))
-        try:
-            find_contamination(pair=fastq,
-                               forward_id=args.forward_id,
-                               threads=args.threads,
-                               output_folder=args.output_name,
-                               databases_folder=args.databases,
-                               keep_files=args.keep_files,
-                               quality_cutoff=args.quality_cutoff,
-                               base_cutoff=args.base_cutoff,
-                               base_fraction_cutoff=args.base_fraction_cutoff,
-                               cgmlst_db=args.cgmlst,
-                               xmx=args.Xmx,
-                               tmpdir=args.tmp,
-                               data_type=args.data_type,
-                               use_rmlst=args.rmlst,
-                               cross_details=args.cross_details,
-                               min_matching_hashes=min_matching_hashes,
-                               fasta=args.fasta)
-        except subprocess.CalledProcessError:
-            # If something unforeseen goes wrong, traceback will be printed to screen.
-            # We then add the sample to the report with a note that it failed.
-            multi_positions = 0
-            genus = 'Error processing sample'
-            write_output(output_report=os.path.join(args.output_name, 'confindr_report.csv'),
-                         sample_name=sample_name,
-                         multi_positions=multi_positions,
-                         genus=genus,
-                         percent_contam='ND',
-                         contam_stddev='ND',
-                         total_gene_length=0,
-                         database_download_date='ND')
-            logging.warning('Encountered error when attempting to run ConFindr on sample '
-                            '{sample}. Skipping...'.format(sample=sample_name))
-            logging.warning('Error encounted was:\n{}'.format(traceback.format_exc()))
-            if args.keep_files is False:
-                shutil.rmtree(os.path.join(args.output_name, sample_name))
+    reads = sorted(paired_reads + unpaired_reads + alignment_files)
+    if args.assembly_mode and not args.fasta:
+        logging.error('ERROR: --assembly_mode can only be used with --fasta')
+        quit(code=1)
+    if args.batch and (args.all_genera or args.assembly_mode):
+        logging.warning('--all_genera and --assembly_mode can not be used with --batch, so samples will be run one at '
+                        'a time.')
+    if args.batch and not (args.all_genera or args.assembly_mode):
+        find_contamination_batch(pairs=reads,
+                                 forward_id=args.forward_id,
+                                 reverse_id=args.reverse_id,
+                                 threads=args.threads,
+                                 output_folder=args.output_name,
+                                 databases_folder=args.databases,
+                                 keep_files=args.keep_files,
+                                 quality_cutoff=args.quality_cutoff,
+                                 base_cutoff=args.base_cutoff,
+                                 base_fraction_cutoff=args.base_fraction_cutoff,
+                                 cgmlst_db=args.cgmlst,
+                                 xmx=args.Xmx,
+                                 tmpdir=database_tmpdir,
+                                 data_type=args.data_type,
+                                 use_rmlst=args.rmlst,
+                                 cross_details=args.cross_details,
+                                 min_matching_hashes=min_matching_hashes,
+                                 fasta=args.fasta,
+                                 merge_reads=args.merge_reads,
+                                 dedupe=args.dedupe,
+                                 min_coverage=args.min_coverage,
+                                 species_db=args.species_db,
+                                 bait_engine=args.bait_engine,
+                                 regions=regions,
+                                 cram_reference=args.cram_reference,
+                                 reference_cache=reference_cache,
+                                 parallel_samples=args.parallel_samples)
+    else:
+        # Screen every sample first, so that every database needed can be built and indexed up front, in parallel.
+        samples = prescreen_samples(pairs=reads,
+                                    output_folder=args.output_name,
+                                    databases_folder=args.databases,
+                                    forward_id=args.forward_id,
+                                    reverse_id=args.reverse_id,
+                                    threads=args.threads,
+                                    min_matching_hashes=min_matching_hashes,
+                                    regions=regions,
+                                    cram_reference=args.cram_reference)
+        prepare_databases(samples=samples,
+                          databases_folder=args.databases,
+                          log=os.path.join(args.output_name, 'confindr_log.txt'),
+                          threads=args.threads,
+                          tmpdir=database_tmpdir,
+                          use_rmlst=args.rmlst,
+                          cgmlst_db=args.cgmlst,
+                          cross_details=args.cross_details,
+                          all_genera=args.all_genera,
+                          species_db=args.species_db,
+                          min_matching_hashes=min_matching_hashes,
+                          bait_engine=args.bait_engine,
+                          fasta=args.fasta,
+                          assembly_mode=args.assembly_mode)
+        # Then analyse them, typing and mapping up to --parallel_samples at a time.
+        find_contamination_parallel(samples=samples,
+                                    output_folder=args.output_name,
+                                    databases_folder=args.databases,
+                                    parallel_samples=args.parallel_samples,
+                                    forward_id=args.forward_id,
+                                    threads=args.threads,
+                                    keep_files=args.keep_files,
+                                    quality_cutoff=args.quality_cutoff,
+                                    base_cutoff=args.base_cutoff,
+                                    base_fraction_cutoff=args.base_fraction_cutoff,
+                                    cgmlst_db=args.cgmlst,
+                                    xmx=args.Xmx,
+                                    tmpdir=database_tmpdir,
+                                    data_type=args.data_type,
+                                    use_rmlst=args.rmlst,
+                                    cross_details=args.cross_details,
+                                    min_matching_hashes=min_matching_hashes,
+                                    fasta=args.fasta,
+                                    merge_reads=args.merge_reads,
+                                    dedupe=args.dedupe,
+                                    min_coverage=args.min_coverage,
+                                    all_genera=args.all_genera,
+                                    species_db=args.species_db,
+                                    bait_engine=args.bait_engine,
+                                    assembly_mode=args.assembly_mode,
+                                    regions=regions,
+                                    cram_reference=args.cram_reference,
+                                    reference_cache=reference_cache)
     if args.keep_files is False and args.tmp is not None:
         shutil.rmtree(args.tmp)
+    kma_shm.detach_all(log=os.path.join(args.output_name, 'confindr_log.txt'))
+    if reference_cache is not None:
+        log_reference_cache_stats()
+    if args.cache is not None:
+        evicted = database_cache.evict_cache(args.cache, max_size=args.cache_size * 1e9, keep_since=run_start)
+        if evicted:
+            logging.info('Removed {} least recently used database(s) from cache to keep it under {} GB'
+                         .format(len(evicted), args.cache_size))
+        database_cache.finish_job(args.cache)
     logging.info('Contamination detection complete!')
 
 
@@ -1124,11 +2811,36 @@ def main():
                         type=int,
                         default=cpu_count,
                         help='Number of threads to run analysis with.')
+    parser.add_argument('-ps', '--parallel_samples',
+                        type=int,
+                        default=1,
+                        help='Number of samples to work on at once. Threads get split between the samples, and their '
+                             'external programs (bbduk, KMA, bbmap, etc.) run at the same time, which helps with lots '
+                             'of small samples that can\'t keep every thread busy on their own. Defaults to 1.')
     parser.add_argument('-tmp', '--tmp',
                         type=str,
                         help='If your ConFindr databases are in a location you don\'t have write access to, '
                              'you can enter this option to specify a temporary directory to put genus-specific '
                              'databases to.')
+    parser.add_argument('-ca', '--cache',
+                        type=str,
+                        help='Folder to keep databases and indexes derived from your ConFindr databases in, so they '
+                             'only have to be made once and can be shared between runs (and users). Takes priority '
+                             'over --tmp for databases. Anything in the cache gets remade when your ConFindr '
+                             'databases are updated.')
+    parser.add_argument('-cs', '--cache_size',
+                        type=float,
+                        default=20,
+                        help='Maximum size of the cache, in GB. Once a run finishes, the least recently used '
+                             'databases get removed until the cache is under this size. Defaults to 20.')
+    parser.add_argument('-shm', '--kma_shm',
+                        default=False,
+                        action='store_true',
+                        help='Load KMA databases into shared memory, once per machine, and have KMA use the shared '
+                             'copy. Saves loading each database again for every sample, and lets ConFindr jobs running '
+                             'at the same time on one machine share one copy. Databases are removed from shared memory '
+                             'once no job is using them. If anything goes wrong with shared memory, KMA reads the '
+                             'database from disk as usual.')
     parser.add_argument('-k', '--keep_files',
                         default=False,
                         action='store_true',
@@ -1175,8 +2887,8 @@ def main():
                         help='Path to a cgMLST database to use for contamination detection instead of using the default'
                              ' rMLST database. Sequences in this file should have headers in format '
                              '>genename_allelenumber. To speed up ConFindr runs, clustering the cgMLST database with '
-                             'CD-HIT before running ConFindr is recommended. This is highly experimental, results '
-                             'should be interpreted with great care.')
+                             'confindr_cluster_db (or CD-HIT) before running ConFindr is recommended. This is highly '
+                             'experimental, results should be interpreted with great care.')
     parser.add_argument('--fasta',
                         default=False,
                         action='store_true',
@@ -1195,6 +2907,77 @@ def main():
                         type=int,
                         help='Minimum number of matching hashes in a MASH screen in order for a genus to be considered '
                              'present in a sample. Default is 150')
+    parser.add_argument('-merge', '--merge_reads',
+                        default=False,
+                        action='store_true',
+                        help='Merge overlapping read pairs with bbmerge before mapping, so that bases covered by both '
+                             'mates are only counted once. Reduces the amount of work done when looking for '
+                             'multiple alleles in libraries with short inserts. Only used for paired Illumina reads.')
+    parser.add_argument('-dedupe', '--dedupe',
+                        default=False,
+                        action='store_true',
+                        help='Remove duplicate reads from the reads baited out for core genes before mapping. Useful '
+                             'for amplicon-heavy or low-input libraries with lots of PCR duplicates. The number of '
+                             'reads removed is added to the report. Only used for Illumina reads.')
+    parser.add_argument('-mc', '--min_coverage',
+                        default=2,
+                        type=float,
+                        help='Minimum estimated coverage of core genes, based on the number of bases baited out of '
+                             'your reads. Samples below this (wrong organism, empty libraries, failed runs) are '
+                             'reported as having low coverage and the rest of their analysis is skipped. Default is 2')
+    parser.add_argument('-ag', '--all_genera',
+                        default=False,
+                        action='store_true',
+                        help='When used with --cross_details, analyse every genus found in a cross-contaminated '
+                             'sample at the same time instead of only the predominant genus. Each genus gets its own '
+                             'row in the report, and its own _rmlst.csv and _contamination.csv files.')
+    parser.add_argument('-batch', '--batch',
+                        default=False,
+                        action='store_true',
+                        help='Map samples that end up with the same core gene alleles together in a single run of '
+                             'bbmap, instead of one at a time. Speeds up runs with lots of small samples of the same '
+                             'type. Results are the same as without this option.')
+    parser.add_argument('-r', '--regions',
+                        type=str,
+                        help='BED file of where core genes are in the reference genome that BAM/CRAM input was '
+                             'aligned to. If given, only reads in these regions (and their mates) are extracted '
+                             'through the index instead of going through the whole file. Input must be coordinate '
+                             'sorted and indexed.')
+    parser.add_argument('-cr', '--cram_reference',
+                        type=str,
+                        help='Reference FASTA that CRAM input was compressed against, if it can not be found '
+                             'from the CRAM header.')
+    parser.add_argument('-am', '--assembly_mode',
+                        default=False,
+                        action='store_true',
+                        help='Used along with --fasta. Instead of treating assemblies like reads, align core gene '
+                             'alleles straight to the contigs and call contamination when core genes are found at '
+                             'more than one locus with different sequences. Much faster for screening lots of '
+                             'assemblies.')
+    parser.add_argument('-be', '--bait_engine',
+                        default='bbduk',
+                        choices=['bbduk', 'numpy'],
+                        help='What to use to bait out core gene reads. bbduk (the default) runs BBDuk for every '
+                             'sample. numpy does the same thing within ConFindr, using k-mers from each database that '
+                             'get cached on disk the first time they are needed, which saves starting up BBDuk for '
+                             'each sample. FASTA input always uses bbduk.')
+    parser.add_argument('-to', '--timeout',
+                        type=float,
+                        help='Number of minutes each external program (mash, bbduk, kma, bbmap, etc.) is allowed '
+                             'to run for per GB of input, with a minimum of one GB. Programs that go over are '
+                             'killed and the sample is reported as timed out. By default, there is no timeout.')
+    parser.add_argument('-re', '--retries',
+                        type=int,
+                        default=1,
+                        help='Number of times to retry an external program that times out or is killed by a signal '
+                             'before giving up on a sample, waiting a little longer before each retry. Programs that '
+                             'exit with an error are not retried. Defaults to 1.')
+    parser.add_argument('-sp', '--species_db',
+                        default=False,
+                        action='store_true',
+                        help='Use a database of only the rMLST alleles known from the species your sample best matches '
+                             'instead of the whole genus. This makes baiting and typing faster for large genera. '
+                             'Not used for genera with core-genome derived databases unless --rmlst is also set.')
     args = parser.parse_args()
     # Setup the logger. TODO: Different colors for different levels.
     if args.verbosity == 'info':
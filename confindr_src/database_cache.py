@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+from confindr_src.database_setup import build_lock, find_file_fingerprint, find_temporary_path
+from confindr_src import kma_shm
+import hashlib
+import logging
+import shutil
+import json
+import time
+import glob
+import os
+
+# Files in ConFindr's database folder that derived databases get made from. If any of these change, everything
+# derived from them needs to be made again.
+SOURCE_FILES = ['rMLST_combined.fasta', 'gene_allele.txt', 'species_allele.txt', 'profiles.txt']
+# Written into each cache folder, saying which database folder it was made from.
+CACHE_SOURCE = 'source.json'
+# Folder in the cache that each job using it leaves a file named after its process ID in, saying which cache folder it
+# is using and when it started, so that other jobs don't delete anything out from under it.
+JOBS_FOLDER = 'jobs'
+
+
+def read_json(json_file):
+    """
+    :param json_file: Path to JSON file.
+    :return: Contents of the file, or an empty dictionary if it doesn't exist or can't be read.
+    """
+    try:
+        with open(json_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def write_json(contents, json_file):
+    """
+    Writes a JSON file somewhere else first and then moves it into place, so it can't be read half-written.
+    :param contents: Anything json can write.
+    :param json_file: Path to write to.
+    """
+    tmp_file = find_temporary_path(json_file)
+    with open(tmp_file, 'w') as f:
+        json.dump(contents, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, json_file)
+
+
+def find_source_fingerprint(databases_folder, cache_dir):
+    """
+    Finds a fingerprint for the source files in a database folder. Checksums are remembered in the cache (along with
+    the size and modification time of the file they were found for), so large files like rMLST_combined.fasta only
+    get read again when they change.
+    :param databases_folder: Full path to folder where ConFindr's databases live.
+    :param cache_dir: Path to cache folder.
+    :return: Fingerprint, as a string of hex digits.
+    """
+    checksums_file = os.path.join(cache_dir, 'checksums.json')
+    checksums = read_json(checksums_file)
+    source_files = SOURCE_FILES + [os.path.split(cgderived_database)[-1] for cgderived_database in
+                                   glob.glob(os.path.join(databases_folder, '*_db_cgderived.fasta'))]
+    fingerprints = dict()
+    updated = False
+    for source_file in sorted(source_files):
+        path = os.path.abspath(os.path.join(databases_folder, source_file))
+        if not os.path.isfile(path):
+            continue
+        size, mtime = os.path.getsize(path), os.path.getmtime(path)
+        known = checksums.get(path)
+        if known is None or known['size'] != size or known['mtime'] != mtime:
+            known = find_file_fingerprint(path)
+            known['mtime'] = mtime
+            checksums[path] = known
+            updated = True
+        fingerprints[source_file] = known['sha256']
+    if updated:
+        with build_lock(checksums_file):
+            # Other jobs may have added their own checksums while these were being found.
+            all_checksums = read_json(checksums_file)
+            all_checksums.update(checksums)
+            write_json(all_checksums, checksums_file)
+    return hashlib.sha256(json.dumps(fingerprints, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def find_running_jobs(cache_dir):
+    """
+    Finds the jobs using a cache, cleaning up after any that exited without saying so (i.e. because they were killed).
+    :param cache_dir: Path to cache folder.
+    :return: Dictionary with process IDs of jobs that are still running as keys, and what they recorded in
+    find_cache_folder (cache_folder and started) as values.
+    """
+    jobs = dict()
+    for job_file in glob.glob(os.path.join(cache_dir, JOBS_FOLDER, '[0-9]*')):
+        pid = int(os.path.split(job_file)[-1])
+        if kma_shm.is_running(pid):
+            jobs[pid] = read_json(job_file)
+        else:
+            try:
+                os.remove(job_file)
+            except FileNotFoundError:
+                pass
+    return jobs
+
+
+def finish_job(cache_dir):
+    """
+    Records that this job is done with a cache, so that the cache folder it was using can be deleted once it's out
+    of date.
+    :param cache_dir: Path to cache folder.
+    """
+    try:
+        os.remove(os.path.join(cache_dir, JOBS_FOLDER, str(os.getpid())))
+    except FileNotFoundError:
+        pass
+
+
+def find_cache_folder(cache_dir, databases_folder):
+    """
+    Finds the folder in the cache that databases derived from a database folder go in. Each version of a database
+    folder gets its own cache folder, named after the fingerprint of its source files, so updating the databases
+    (i.e. re-running confindr_database_setup) means new derived databases get made. Cache folders made from older
+    versions of the same database folder get deleted once no running job is using them. This job is recorded as
+    using the folder returned until finish_job is called (or it exits).
+    :param cache_dir: Path to cache folder. Created if it doesn't exist.
+    :param databases_folder: Full path to folder where ConFindr's databases live.
+    :return: Path to folder to put derived databases in.
+    """
+    os.makedirs(os.path.join(cache_dir, JOBS_FOLDER), exist_ok=True)
+    fingerprint = find_source_fingerprint(databases_folder, cache_dir)
+    cache_folder = os.path.join(cache_dir, fingerprint)
+    source = os.path.abspath(databases_folder)
+    with build_lock(os.path.join(cache_dir, 'cache')):
+        # Jobs only get recorded while this lock is held, so none can start using a folder while it's being deleted.
+        write_json({'cache_folder': cache_folder, 'started': time.time()},
+                   os.path.join(cache_dir, JOBS_FOLDER, str(os.getpid())))
+        folders_in_use = set(job.get('cache_folder') for job in find_running_jobs(cache_dir).values())
+        for source_file in glob.glob(os.path.join(cache_dir, '*', CACHE_SOURCE)):
+            old_cache_folder = os.path.dirname(source_file)
+            if old_cache_folder == cache_folder or read_json(source_file).get('databases_folder') != source:
+                continue
+            if old_cache_folder in folders_in_use:
+                logging.info('Databases in {} have changed, but out of date cache {} is still being used by another '
+                             'job, so it will be removed later'.format(source, old_cache_folder))
+                continue
+            logging.info('Databases in {} have changed, removing out of date cache {}'
+                         .format(source, old_cache_folder))
+            shutil.rmtree(old_cache_folder)
+        if not os.path.isdir(cache_folder):
+            os.makedirs(cache_folder)
+        if not os.path.isfile(os.path.join(cache_folder, CACHE_SOURCE)):
+            write_json({'databases_folder': source}, os.path.join(cache_folder, CACHE_SOURCE))
+    return cache_folder
+
+
+def find_reference_cache(cache_dir):
+    """
+    Finds the folder in the cache that mapping references (see confindr.find_cached_reference) go in. References are
+    keyed on the database they came from, so they don't need to go in a cache folder for one version of a database
+    folder, and get evicted the same way databases do.
+    :param cache_dir: Path to cache folder. Created if it doesn't exist.
+    :return: Path to folder to put references in.
+    """
+    reference_cache = os.path.join(cache_dir, 'references')
+    if not os.path.isdir(reference_cache):
+        os.makedirs(reference_cache, exist_ok=True)
+    if not os.path.isfile(os.path.join(reference_cache, CACHE_SOURCE)):
+        write_json({'contents': 'references'}, os.path.join(reference_cache, CACHE_SOURCE))
+    return reference_cache
+
+
+def find_size(path):
+    """
+    :param path: Path to a file or folder.
+    :return: Size of the file, or of everything in the folder, in bytes.
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def mark_used(database):
+    """
+    Records that a database was just used, if it's in a cache folder, so that it's the last thing to get evicted.
+    :param database: Path to database.
+    """
+    if os.path.isfile(os.path.join(os.path.dirname(database), CACHE_SOURCE)):
+        with open(database + '.used', 'a'):
+            pass
+        os.utime(database + '.used')
+
+
+def find_last_used(database):
+    """
+    :param database: Path to database in a cache folder.
+    :return: When the database was last used (or made, if it's never been used), in seconds since the epoch.
+    """
+    used_file = database + '.used'
+    return os.path.getmtime(used_file if os.path.isfile(used_file) else database)
+
+
+def find_cache_entries(cache_dir):
+    """
+    :param cache_dir: Path to cache folder.
+    :return: List of dictionaries, one for each database in the cache, with the database, all of the files (and
+    folders) that belong to it (indexes, k-mer files), their total size, and when the database was last used.
+    """
+    entries = list()
+    for database in glob.glob(os.path.join(cache_dir, '*', '*.fasta')):
+        prefix = database.replace('.fasta', '')
+        # Lock files stay, so jobs waiting on them aren't left with a lock nobody else can see, and so do files that
+        # are still being built.
+        files = [f for f in glob.glob(database + '*') + glob.glob(prefix + '_kma.*') + glob.glob(prefix + '_kmers_k*') +
+                 glob.glob(prefix + '_bbmap') + glob.glob(prefix + '.mmi')
+                 if not f.endswith('.lock') and '.tmp' not in os.path.split(f)[-1]]
+        entries.append({'database': database,
+                        'files': files,
+                        'size': sum(find_size(f) for f in files),
+                        'last_used': find_last_used(database)})
+    return entries
+
+
+def evict_cache(cache_dir, max_size, keep_since=None):
+    """
+    Deletes the least recently used databases in a cache until it's under a size limit.
+    :param cache_dir: Path to cache folder.
+    :param max_size: Maximum size of the cache, in bytes.
+    :param keep_since: Databases used at or after this time (seconds since the epoch) are never deleted, so that a run
+    doesn't evict what it's using. Databases used since any other job using the cache started are never deleted
+    either, since it may still be reading them. If None, anything other jobs aren't using can be deleted.
+    :return: List of databases that were deleted.
+    """
+    job_starts = [job.get('started', 0) for pid, job in find_running_jobs(cache_dir).items() if pid != os.getpid()]
+    keep_since = min(job_starts + [keep_since if keep_since is not None else time.time()])
+    entries = sorted(find_cache_entries(cache_dir), key=lambda entry: entry['last_used'])
+    total_size = sum(entry['size'] for entry in entries)
+    evicted = list()
+    for entry in entries:
+        if total_size <= max_size:
+            break
+        if entry['last_used'] >= keep_since:
+            continue
+        # Don't pull a database out from under a job that's building it.
+        with build_lock(entry['database']):
+            # Another job may have started using it since the cache was looked at.
+            if os.path.isfile(entry['database']) and find_last_used(entry['database']) >= keep_since:
+                continue
+            for f in entry['files']:
+                if os.path.isdir(f):
+                    shutil.rmtree(f, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(f)
+                    except FileNotFoundError:
+                        pass
+        total_size -= entry['size']
+        evicted.append(entry['database'])
+        logging.debug('Evicted {} from cache'.format(entry['database']))
+    return evicted
+
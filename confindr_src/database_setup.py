@@ -1,17 +1,45 @@
 #!/usr/bin/env python
 
 from rauth import OAuth1Session
+from multiprocessing.pool import ThreadPool
 from Bio import SeqIO
+import contextlib
+import threading
 import argparse
 import datetime
+import hashlib
+import base64
+import gzip
+import io
+import itertools
+import queue
+import sqlite3
+import fcntl
 import logging
 import urllib.request
+import urllib.error
 import tarfile
+import zlib
 import shutil
+import pysam
+import json
+import time
 import glob
 import csv
 import re
 import os
+from confindr_src.wrappers import runner
+from confindr_src import kmer_bait
+from confindr_src import packed_alleles
+
+# Written to the database folder by prebuild_databases, recording what was built.
+PREBUILT_FINGERPRINT = 'prebuilt.json'
+# SQLite store of gene_allele.txt and species_allele.txt, for looking up one genus or species at a time.
+ALLELE_STORE = 'alleles.sqlite'
+# Genes in the rMLST scheme, as they're named in the profiles.
+RMLST_GENES = ['BACT{:06d}'.format(i) for i in range(1, 66)]
+# Written to the database folder by confindr_database_setup, recording where every file came from and its checksum.
+MANIFEST = 'manifest.json'
 
 
 class RmlstRest(object):
@@ -22,7 +50,7 @@ class RmlstRest(object):
                                         access_token=self.access_token,
                                         access_token_secret=self.access_secret)
         url = self.test_rest_url + '/oauth/get_session_token'
-        r = session_request.get(url)
+        r = session_request.get(url, params=dict())
         if r.status_code == 200:
             self.session_token = r.json()['oauth_token']
             self.session_secret = r.json()['oauth_token_secret']
@@ -31,12 +59,32 @@ class RmlstRest(object):
                           'secret and access token files have valid credentials and try again.')
             quit(code=1)
 
+    def create_session(self):
+        return OAuth1Session(self.consumer_key,
+                             self.consumer_secret,
+                             access_token=self.session_token,
+                             access_token_secret=self.session_secret)
+
+    @contextlib.contextmanager
+    def pooled_session(self):
+        """
+        Lends out an authenticated session. Sessions go back in the pool once they're done with, so their connections
+        get reused by later downloads, and no more than max_sessions are ever made - anything that needs a session
+        once they're all in use waits for one to be handed back.
+        """
+        with self.session_lock:
+            if self.idle_sessions.empty() and self.session_count < self.max_sessions:
+                self.idle_sessions.put(self.create_session())
+                self.session_count += 1
+        session = self.idle_sessions.get()
+        try:
+            yield session
+        finally:
+            self.idle_sessions.put(session)
+
     def get_loci_and_scheme_url(self):
-        session = OAuth1Session(self.consumer_key,
-                                self.consumer_secret,
-                                access_token=self.session_token,
-                                access_token_secret=self.session_secret)
-        r = session.get(self.test_rest_url)
+        with self.pooled_session() as session:
+            r = session.get(self.test_rest_url, params=dict())
         if r.status_code == 200 or r.status_code == 201:
             if re.search('json', r.headers['content-type'], flags=0):
                 decoded = r.json()
@@ -50,52 +98,82 @@ class RmlstRest(object):
                           'at https://github.com/OLC-Bioinformatics/ConFindr/issues and we\'ll get things sorted out.')
             quit(code=1)
 
-    def download_loci(self):
-        session = OAuth1Session(self.consumer_key,
-                                self.consumer_secret,
-                                access_token=self.session_token,
-                                access_token_secret=self.session_secret)
-        r = session.get(self.loci)
+    def download_locus(self, locus_url, writer, entry=None):
+        """
+        Downloads the alleles for an rMLST locus to <locus>.fasta in the output folder (resuming an earlier attempt if
+        there is one, see download_file), then streams them from there into a new rMLST_combined.fasta.
+        :param locus_url: URL for an rMLST locus.
+        :param writer: IndexedFastaWriter for rMLST_combined.fasta
+        :param entry: Manifest entry for the locus, or None to download it regardless.
+        :return: locus, entry, changed: Name of the locus, its new manifest entry, and whether or not it changed.
+        """
+        locus = os.path.split(locus_url)[1]
+        locus_file = os.path.join(self.output_folder, locus + '.fasta')
+        logging.info('Downloading {}...'.format(locus))
+        with self.pooled_session() as session:
+            new_entry, changed = download_file(locus_url + '/alleles_fasta', locus_file, entry=entry, session=session)
+        if changed:
+            writer.write_alleles(parse_locus(read_lines(read_file_chunks(locus_file), dict())), locus=locus)
+            os.remove(locus_file)
+        return locus, new_entry, changed
+
+    def download_loci(self, writer, manifest=None):
+        """
+        Downloads the alleles for every rMLST locus straight into a new rMLST_combined.fasta, max_sessions loci at a
+        time. With a manifest, loci are only downloaded if they've changed since they were last downloaded - loci
+        that weren't downloaded are left out of writer.loci, and need to be copied over from the old
+        rMLST_combined.fasta
+        :param writer: IndexedFastaWriter for rMLST_combined.fasta
+        :param manifest: Manifest of the database folder (see read_manifest), which gets updated with every locus
+        downloaded. If None, every locus is downloaded.
+        :return: List of the loci that changed (or were removed) since the manifest was last updated.
+        """
+        with self.pooled_session() as session:
+            r = session.get(self.loci, params=dict())
         if r.status_code == 200 or r.status_code == 201:
             if re.search('json', r.headers['content-type'], flags=0):
                 decoded = r.json()
             else:
                 decoded = r.text
+            known_loci = manifest['loci'] if manifest is not None else dict()
+            # Unchanged loci get taken from rMLST_combined, so without one everything has to be downloaded.
+            have_combined = os.path.isfile(os.path.join(self.output_folder, 'rMLST_combined.fasta'))
             # Extract all the URLs in the decoded dictionary under the key 'loci'
-            for locus_url in decoded['loci']:
-                output_file = os.path.join(self.output_folder, '{}.tfa'.format(os.path.split(locus_url)[1]))
-                logging.info('Downloading {}...'.format(os.path.split(locus_url)[1]))
-                with open(output_file, 'w') as f:
-                    download = session.get(locus_url + '/alleles_fasta')
-                    if download.status_code == 200 or download.status_code == 201:
-                        if re.search('json', download.headers['content-type'], flags=0):
-                            decoded = download.json()
-                        else:
-                            decoded = download.text
-                        with open(output_file, 'w') as locus_fasta:
-                            locus_fasta.write(decoded)
-                
+            p = ThreadPool(processes=self.max_sessions)
+            downloads = p.map(lambda locus_url: self.download_locus(locus_url, writer,
+                                                                    entry=known_loci.get(os.path.split(locus_url)[1])
+                                                                    if have_combined else None),
+                              decoded['loci'])
+            p.close()
+            p.join()
+            loci = {locus: entry for locus, entry, changed in downloads}
+            changed_loci = [locus for locus, entry, changed in downloads if changed]
+            changed_loci += [locus for locus in known_loci if locus not in loci]
+            if manifest is not None:
+                manifest['loci'] = loci
+            return sorted(changed_loci)
         else:
             logging.error('ERROR: Could not find URLs for rMLST download, they may have moved. Please open an issue '
                           'at https://github.com/OLC-Bioinformatics/ConFindr/issues and we\'ll get things sorted out.')
             quit(code=1)
 
-    def download_profile(self):
+    def download_profile(self, manifest=None):
+        """
+        Downloads the rMLST profiles to profiles.txt in the output folder.
+        :param manifest: Manifest of the database folder (see read_manifest). If given, the profiles are only
+        downloaded if they've changed since they were last downloaded, and the manifest gets updated.
+        :return: True if the profiles changed, False otherwise.
+        """
         profile_file = os.path.join(self.output_folder, 'profiles.txt')
-        session = OAuth1Session(self.consumer_key,
-                                self.consumer_secret,
-                                access_token=self.session_token,
-                                access_token_secret=self.session_secret)
-        r = session.get(self.profile + '/1/profiles_csv')
         logging.info('Downloading rMLST profiles...')
-        if r.status_code == 200 or r.status_code == 201:
-            if re.search('json', r.headers['content-type'], flags=0):
-                decoded = r.json()
-            else:
-                decoded = r.text
-            # Write the profile file to disk
-            with open(profile_file, 'w') as profile:
-                profile.write(decoded)
+        entry = manifest['files'].get('profiles.txt') if manifest is not None and os.path.isfile(profile_file) \
+            else None
+        with self.pooled_session() as session:
+            entry, changed = download_file(self.profile + '/1/profiles_csv', profile_file, entry=entry,
+                                           session=session)
+        if manifest is not None:
+            manifest['files']['profiles.txt'] = entry
+        return changed
 
     def get_request_token(self):
         session = OAuth1Session(consumer_key=self.consumer_key,
@@ -127,8 +205,9 @@ class RmlstRest(object):
             self.access_token = r.json()['oauth_token']
             self.access_secret = r.json()['oauth_token_secret']
 
-    def __init__(self, consumer_secret_file, output_folder):
-        self.test_rest_url = 'http://rest.pubmlst.org/db/pubmlst_rmlst_seqdef'
+    def __init__(self, consumer_secret_file, output_folder, rest_url='http://rest.pubmlst.org/db/pubmlst_rmlst_seqdef',
+                 max_sessions=8):
+        self.test_rest_url = rest_url
         self.test_web_url = 'http://pubmlst.org/cgi-bin/bigsdb/bigsdb.pl?db=pubmlst_rmlst_seqdef'
         self.request_token_url = self.test_rest_url + '/oauth/get_request_token'
         self.access_token_url = self.test_rest_url + '/oauth/get_access_token'
@@ -158,86 +237,1188 @@ class RmlstRest(object):
         self.request_secret = str()
         self.access_token = str()
         self.access_secret = str()
+        # Authenticated sessions that downloads share, so that up to max_sessions downloads can run at once.
+        self.max_sessions = max(1, max_sessions)
+        self.idle_sessions = queue.Queue()
+        self.session_count = 0
+        self.session_lock = threading.Lock()
 
 
-def create_gene_allele_file(profiles_file, gene_allele_file):
-    genus_allele_info = dict()
+def read_profile_alleles(profiles_file):
+    """
+    Goes through an rMLST profiles file once to find every allele found with each genus and each species.
+    :param profiles_file: Path to rMLST profiles file.
+    :return: genus_alleles, species_alleles: Dictionaries with genera (or species, written out as genus and species,
+    i.e. Escherichia coli, regardless of how they're written in the profiles) as keys, and dictionaries with alleles as
+    keys as values, which keeps alleles in the order they were first seen while making membership checks constant
+    time.
+    """
+    genus_alleles = dict()
+    species_alleles = dict()
     with open(profiles_file) as tsvfile:
         reader = csv.DictReader(tsvfile, delimiter='\t')
+        genes = [gene for gene in RMLST_GENES if gene in reader.fieldnames]
         for row in reader:
             genus = row['genus']
-            if genus not in genus_allele_info:
-                genus_allele_info[genus] = list()
-            for i in range(1, 66):
-                if i < 10:
-                    gene = 'BACT00000' + str(i)
-                else:
-                    gene = 'BACT0000' + str(i)
-                if gene in row:
-                    allele_number = row[gene]
+            species = row.get('species')
+            allele_sets = [genus_alleles.setdefault(genus, dict())]
+            if species:
+                if not species.startswith(genus):
+                    species = '{} {}'.format(genus, species)
+                allele_sets.append(species_alleles.setdefault(species, dict()))
+            for gene in genes:
+                allele_number = row[gene]
+                if allele_number != 'N':
                     gene_allele = '{}_{}'.format(gene, allele_number)
-                    if allele_number != 'N' and gene_allele not in genus_allele_info[genus]:
-                        genus_allele_info[genus].append(gene_allele)
-    with open(gene_allele_file, 'w') as f:
-        for genus in genus_allele_info:
-            f.write(str(genus) + ':')
-            for allele in genus_allele_info[genus]:
+                    for allele_set in allele_sets:
+                        allele_set[gene_allele] = None
+    return genus_alleles, species_alleles
+
+
+def write_allele_file(alleles, allele_file):
+    """
+    :param alleles: Dictionary created by read_profile_alleles.
+    :param allele_file: Path to write genus (or species) and alleles to, one per line in name:allele,allele, format.
+    """
+    with open(allele_file, 'w') as f:
+        for name in alleles:
+            f.write(str(name) + ':')
+            for allele in alleles[name]:
                 f.write(str(allele) + ',')
             f.write('\n')
 
 
-def setup_confindr_database(output_folder, consumer_secret):
-    # Remove previous output folder if it existed.
+def create_gene_allele_file(profiles_file, gene_allele_file):
+    """
+    Lists the alleles found for each genus in the rMLST profiles.
+    :param profiles_file: Path to rMLST profiles file.
+    :param gene_allele_file: Path to file to write genus/allele information to.
+    """
+    write_allele_file(read_profile_alleles(profiles_file)[0], gene_allele_file)
+
+
+def create_species_allele_file(profiles_file, species_allele_file):
+    """
+    Same idea as create_gene_allele_file, but lists the alleles found for each species instead of each genus. Species
+    are written out as genus and species (i.e. Escherichia coli), regardless of how they're written in the profiles.
+    :param profiles_file: Path to rMLST profiles file.
+    :param species_allele_file: Path to file to write species/allele information to.
+    """
+    write_allele_file(read_profile_alleles(profiles_file)[1], species_allele_file)
+
+
+def create_allele_store(allele_files, allele_store):
+    """
+    Puts the contents of allele files into an SQLite database, so that the alleles for a genus or species can be looked
+    up directly rather than by reading through the whole file. The size and modification time of each allele file
+    are recorded as well, so that lookups can tell if a file has changed since.
+    :param allele_files: Dictionary with paths to allele files as keys and dictionaries created by read_profile_alleles
+    as values.
+    :param allele_store: Path to write the SQLite database to.
+    """
+    tmp_store = find_temporary_path(allele_store)
+    connection = sqlite3.connect(tmp_store)
+    try:
+        with connection:
+            connection.execute('CREATE TABLE sources (source TEXT PRIMARY KEY, size INTEGER, mtime REAL)')
+            connection.execute('CREATE TABLE alleles (source TEXT, name TEXT, alleles TEXT, PRIMARY KEY (source, name))'
+                               ' WITHOUT ROWID')
+            for allele_file, alleles in allele_files.items():
+                source = os.path.split(allele_file)[-1]
+                connection.execute('INSERT INTO sources VALUES (?, ?, ?)',
+                                   (source, os.path.getsize(allele_file), os.path.getmtime(allele_file)))
+                connection.executemany('INSERT INTO alleles VALUES (?, ?, ?)',
+                                       ((source, name, ','.join(alleles[name])) for name in alleles))
+    finally:
+        connection.close()
+    os.replace(tmp_store, allele_store)
+
+
+def create_allele_files(profiles_file, output_folder):
+    """
+    Creates gene_allele.txt and species_allele.txt (see create_gene_allele_file and create_species_allele_file), along
+    with an SQLite store of both (see create_allele_store), from one pass through the rMLST profiles.
+    :param profiles_file: Path to rMLST profiles file.
+    :param output_folder: Folder to write allele files to.
+    """
+    genus_alleles, species_alleles = read_profile_alleles(profiles_file)
+    allele_files = {os.path.join(output_folder, 'gene_allele.txt'): genus_alleles,
+                    os.path.join(output_folder, 'species_allele.txt'): species_alleles}
+    for allele_file, alleles in allele_files.items():
+        write_allele_file(alleles, allele_file)
+    create_allele_store(allele_files, os.path.join(output_folder, ALLELE_STORE))
+
+
+def find_stored_allele_list(allele_file, target):
+    """
+    Looks up alleles for a genus or species in the allele store next to an allele file.
+    :param allele_file: Path to gene_allele.txt or species_allele.txt
+    :param target: Genus or species to find alleles for.
+    :return: List of alleles, or None if there's no store for this file or the file has changed since the store was
+    made.
+    """
+    allele_store = os.path.join(os.path.dirname(allele_file), ALLELE_STORE)
+    if not os.path.isfile(allele_store):
+        return None
+    source = os.path.split(allele_file)[-1]
+    try:
+        connection = sqlite3.connect('file:{}?mode=ro'.format(urllib.request.pathname2url(allele_store)), uri=True)
+        try:
+            recorded = connection.execute('SELECT size, mtime FROM sources WHERE source = ?', (source,)).fetchone()
+            if recorded is None or tuple(recorded) != (os.path.getsize(allele_file), os.path.getmtime(allele_file)):
+                return None
+            row = connection.execute('SELECT alleles FROM alleles WHERE source = ? AND name = ?',
+                                     (source, target)).fetchone()
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return None
+    if row is None or not row[0]:
+        return list()
+    return row[0].split(',')
+
+
+def find_genusspecific_allele_list(profiles_file, target_genus):
+    """
+    A new way of making our specific databases: Make our profiles file have lists of every gene/allele present for
+    each genus instead of just excluding a few genes for each. This way, should have much smaller databases
+    while managing to make ConFindr a decent bit faster (maybe)
+    :param profiles_file: Path to profiles file.
+    :param target_genus: Genus you want to make a custom database for (STR)
+    :return: List of gene/allele combinations that should be part of species-specific database.
+    """
+    alleles = find_stored_allele_list(profiles_file, target_genus)
+    if alleles is not None:
+        return alleles
+    # No store (i.e. databases downloaded by an older version of ConFindr), so read through the file.
+    alleles = list()
+    with open(profiles_file) as f:
+        for line in f:
+            genus, _, genus_alleles = line.rstrip().partition(':')
+            if genus == target_genus:
+                alleles = genus_alleles.split(',')[:-1]
+    return alleles
+
+
+@contextlib.contextmanager
+def build_lock(path):
+    """
+    Holds an exclusive lock for building something, so that ConFindr jobs sharing a database folder wait for each
+    other instead of writing the same files at the same time. Other jobs should check whether what they need got
+    built while they were waiting once they have the lock.
+    :param path: Path to what is being built. The lock is held on path.lock
+    """
+    try:
+        handle = open(path + '.lock', 'a')
+    except OSError:
+        # If the lock can't be made, the folder can't be written to (i.e. it's mounted read-only), so nothing is going
+        # to get built there anyway.
+        yield
+        return
+    with handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def find_temporary_path(path):
+    """
+    :param path: Path to something that's going to be built.
+    :return: Path in the same folder to build it at first, unique to this process and thread, so that it can be
+    renamed into place once it's done.
+    """
+    return '{}.{}_{}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+
+def is_complete_fasta(fasta_file):
+    """
+    :param fasta_file: Path to FASTA file.
+    :return: True if the file exists and doesn't look half-written, False otherwise.
+    """
+    if not os.path.isfile(fasta_file):
+        return False
+    if os.path.getsize(fasta_file) == 0:
+        return True
+    with open(fasta_file, 'rb') as f:
+        first_character = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        last_character = f.read(1)
+    return first_character == b'>' and last_character == b'\n'
+
+
+def is_complete_fai(fasta_file):
+    """
+    :param fasta_file: Path to FASTA file.
+    :return: True if the FASTA file's .fai exists and covers the whole file, False otherwise.
+    """
+    fai_file = fasta_file + '.fai'
+    if not os.path.isfile(fai_file) or os.path.getmtime(fai_file) < os.path.getmtime(fasta_file):
+        return False
+    last_line = None
+    with open(fai_file) as f:
+        for line in f:
+            last_line = line
+    if last_line is None:
+        return os.path.getsize(fasta_file) == 0
+    if not last_line.endswith('\n'):
+        return False
+    x = last_line.split('\t')
+    # Offset of the last sequence, plus its length, has to fit in the FASTA file.
+    return len(x) == 5 and int(x[2]) + int(x[1]) <= os.path.getsize(fasta_file)
+
+
+def is_complete_kma_index(fasta_file, kma_database):
+    """
+    :param fasta_file: Path to FASTA file that was indexed. Must have a complete .fai.
+    :param kma_database: Prefix of the KMA database.
+    :return: True if the KMA index exists and has every sequence in the FASTA file, False otherwise.
+    """
+    if not os.path.isfile(kma_database + '.name') or not os.path.isfile(kma_database + '.length.b'):
+        return False
+    with open(kma_database + '.name') as f:
+        kma_sequences = sum(1 for _ in f)
+    with open(fasta_file + '.fai') as f:
+        fasta_sequences = sum(1 for _ in f)
+    return kma_sequences == fasta_sequences
+
+
+def setup_allelespecific_database(fasta_file, database_folder, allele_list):
+    """
+    Since some genera have some rMLST genes missing, or two copies of some genes, genus-specific databases are needed.
+    This will take only the alleles known to be part of each genus and write them to a genus-specific file. The file
+    is written somewhere else and then moved into place, so a half-written database is never seen, and nothing is done
+    if another job finishes writing it first. Alleles are pulled out of the packed alleles made at database setup
+    (see packed_alleles.create_packed_alleles) if they're there, and out of rMLST_combined.fasta if they aren't.
+    :param database_folder: Path to folder where rMLST_combined is stored.
+    :param fasta_file: Path to fasta file to write allele-specific database to.
+    :param allele_list: allele list generated by find_genusspecific_allele_list
+    """
+    rmlst_file = os.path.join(database_folder, 'rMLST_combined.fasta')
+    with build_lock(fasta_file):
+        if is_complete_fasta(fasta_file):
+            return
+        tmp_file = find_temporary_path(fasta_file)
+        if packed_alleles.has_packed_alleles(rmlst_file):
+            missing_alleles = packed_alleles.write_packed_alleles(rmlst_file, allele_list, tmp_file)
+        else:
+            index = SeqIO.index(rmlst_file, 'fasta')
+            seqs = list()
+            missing_alleles = list()
+            for s in allele_list:
+                try:
+                    seqs.append(index[s])
+                except KeyError:
+                    missing_alleles.append(s)
+            index.close()
+            SeqIO.write(seqs, tmp_file, 'fasta')
+        for s in missing_alleles:
+            logging.warning('Tried to add {} to allele-specific database, but could not find it.'.format(s))
+        os.replace(tmp_file, fasta_file)
+
+
+def find_writable_database(source_database, database_folder):
+    """
+    Databases get indexed in place, so ones that live somewhere that might not be writable (i.e. cgderived databases
+    when a tmpdir or cache is being used) get copied over to where they can be indexed, unless they've been
+    indexed already.
+    :param source_database: Path to database in ConFindr's database folder.
+    :param database_folder: Folder to copy the database to if it needs indexing.
+    :return: Path to the database to use.
+    """
+    if is_complete_fai(source_database) and \
+            is_complete_kma_index(source_database, find_kma_database(source_database)):
+        return source_database
+    database = os.path.join(database_folder, os.path.split(source_database)[-1])
+    with build_lock(database):
+        if not is_complete_fasta(database):
+            tmp_file = find_temporary_path(database)
+            shutil.copyfile(source_database, tmp_file)
+            os.replace(tmp_file, database)
+    return database
+
+
+def index_fasta(fasta_file):
+    """
+    Creates a .fai for a FASTA file if there isn't a complete one already.
+    :param fasta_file: Path to FASTA file.
+    """
+    if is_complete_fai(fasta_file):
+        return
+    with build_lock(fasta_file):
+        if is_complete_fai(fasta_file):
+            return
+        tmp_file = find_temporary_path(fasta_file + '.fai')
+        pysam.faidx(fasta_file, '--fai-idx', tmp_file)
+        os.replace(tmp_file, fasta_file + '.fai')
+
+
+def find_kma_database(database):
+    """
+    :param database: Path to core gene database, in FASTA format.
+    :return: Prefix of the KMA database made from it by index_database.
+    """
+    return database.replace('.fasta', '') + '_kma'
+
+
+def index_database(database, log=None, bait_engine='bbduk', fasta=False):
+    """
+    Creates the index files needed to use a core gene database (.fai, KMA index, and k-mer file for the numpy bait
+    engine), if there aren't complete ones already. Indexes are built somewhere else and moved into place, and only
+    one job builds them at a time - any others wait, and then use what was built.
+    :param database: Path to core gene database, in FASTA format.
+    :param log: Logfile to write commands, stdout and stderr to. If None, output isn't logged.
+    :param bait_engine: Either bbduk or numpy. k-mer files are only made for numpy.
+    :param fasta: If True, k-mer files aren't made, since FASTA input always uses bbduk.
+    :return: Path to the KMA database.
+    """
+    index_fasta(database)
+    kma_database = find_kma_database(database)
+    if not is_complete_kma_index(database, kma_database):
+        with build_lock(kma_database):
+            if not is_complete_kma_index(database, kma_database):
+                logging.info('Since this is the first time you are using {}, it needs to be indexed by KMA. '
+                             'This might take a while'.format(os.path.split(database)[-1]))
+                tmp_database = find_temporary_path(kma_database)
+                cmd = 'kma index -i {} -o {}'.format(database, tmp_database)  # NOTE: Need KMA >=1.2.0 for this to work.
+                runner.run(cmd, log=log)
+                # .name gets moved last, since it's what says that the index is there.
+                tmp_files = sorted(glob.glob(tmp_database + '.*'), key=lambda tmp_file: tmp_file.endswith('.name'))
+                for tmp_file in tmp_files:
+                    os.replace(tmp_file, kma_database + tmp_file[len(tmp_database):])
+    if bait_engine == 'numpy' and not fasta:
+        with build_lock(kmer_bait.find_kmer_file(database)):
+            try:
+                kmer_bait.create_kmer_file(database)
+            except OSError:
+                # Samples will cache the k-mers somewhere they can write to instead (see kmer_bait.bait_reads).
+                logging.warning('Could not write k-mers for {} next to it'.format(database))
+    return kma_database
+
+
+def find_file_fingerprint(filename):
+    """
+    :param filename: Path to file.
+    :return: Dictionary with the size and SHA-256 checksum of the file, or None if the file doesn't exist.
+    """
+    if not os.path.isfile(filename):
+        return None
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            sha256.update(chunk)
+    return {'size': os.path.getsize(filename),
+            'sha256': sha256.hexdigest()}
+
+
+def read_gene_allele_file(gene_allele_file):
+    """
+    :param gene_allele_file: Path to file created by create_gene_allele_file (or create_species_allele_file).
+    :return: Dictionary with genera (or species) as keys, and a list of their alleles as values.
+    """
+    genus_alleles = dict()
+    with open(gene_allele_file) as f:
+        for line in f:
+            line = line.rstrip()
+            if ':' not in line:
+                continue
+            genus, alleles = line.split(':', 1)
+            genus_alleles[genus] = [allele for allele in alleles.split(',') if allele]
+    return genus_alleles
+
+
+def read_manifest(database_folder):
+    """
+    :param database_folder: Path to folder with ConFindr's databases.
+    :return: Manifest of the folder, as written by write_manifest. Has a files dictionary, with entries for each
+    downloaded file (and each file extracted from a download), and a loci dictionary, with an entry for each rMLST
+    locus. Both are empty if there's no manifest.
+    """
+    manifest = {'files': dict(), 'loci': dict()}
+    try:
+        with open(os.path.join(database_folder, MANIFEST)) as f:
+            manifest.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    return manifest
+
+
+def write_manifest(manifest, database_folder):
+    """
+    :param manifest: Manifest, as returned by read_manifest.
+    :param database_folder: Path to folder with ConFindr's databases.
+    """
+    manifest_file = os.path.join(database_folder, MANIFEST)
+    tmp_file = find_temporary_path(manifest_file)
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def is_retryable(error):
+    """
+    :param error: Exception raised by a download (urllib or requests).
+    :return: True if trying again might work (connection problems, server errors, rate limiting), False otherwise.
+    """
+    status = getattr(error, 'code', None)
+    if status is None and getattr(error, 'response', None) is not None:
+        status = error.response.status_code
+    return status is None or status >= 500 or status in (408, 416, 429)
+
+
+def find_md5(filename):
+    """
+    :param filename: Path to file.
+    :return: MD5 of the file, as hex digits.
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def find_git_blob_sha1(filename):
+    """
+    :param filename: Path to file.
+    :return: SHA-1 that git gives the file when it stores it as a blob (which is what GitHub publishes for files), as
+    hex digits.
+    """
+    sha1 = hashlib.sha1('blob {}\0'.format(os.path.getsize(filename)).encode())
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def find_s3_multipart_etags(filename, parts):
+    """
+    Finds what the ETag of a file would be if it had been uploaded to S3 in parts (the MD5 of the MD5s of the parts).
+    The part size isn't recorded anywhere, so it's done for the usual part sizes that give the right number of parts,
+    all in one pass through the file.
+    :param filename: Path to file.
+    :param parts: Number of parts the file was uploaded in.
+    :return: Set of the ETags the file could have, without quotes.
+    """
+    mib = 1048576
+    size = os.path.getsize(filename)
+    part_sizes = [part_size for part_size in set([-(-size // (parts * mib)), 5, 8, 15, 16, 32, 64, 100, 128])
+                  if part_size > 0 and -(-size // (part_size * mib)) == parts]
+    part_md5s = {part_size: list() for part_size in part_sizes}
+    md5s = {part_size: hashlib.md5() for part_size in part_sizes}
+    with open(filename, 'rb') as f:
+        for i, chunk in enumerate(iter(lambda: f.read(mib), b'')):
+            for part_size in part_sizes:
+                md5s[part_size].update(chunk)
+                if (i + 1) % part_size == 0:
+                    part_md5s[part_size].append(md5s[part_size].digest())
+                    md5s[part_size] = hashlib.md5()
+    for part_size in part_sizes:
+        if len(part_md5s[part_size]) < parts:
+            part_md5s[part_size].append(md5s[part_size].digest())
+    return set('{}-{}'.format(hashlib.md5(b''.join(part_md5s[part_size])).hexdigest(), parts)
+               for part_size in part_sizes)
+
+
+def verify_download(partial_file, status, response_headers, checksum=None, require_checksum=False):
+    """
+    Checks a finished download against what the server said it was sending - its length, and its MD5 if the server
+    gave one (as Content-MD5, or as the ETag of a file on S3, which is where figshare serves files from) - and
+    against a checksum published for it somewhere else, if there is one.
+    :param partial_file: Path to the download.
+    :param status: HTTP status of the response (200, or 206 if the download was resumed).
+    :param response_headers: Headers the server sent.
+    :param checksum: Checksum published for the file, as an (algorithm, hex digits) tuple, where algorithm is md5 or
+    git-sha1 (see find_git_blob_sha1). If None, only what the server sent is checked.
+    :param require_checksum: If True, downloads that neither have a published checksum nor come with one from the
+    server aren't trusted, and raise ValueError (which doesn't get retried).
+    Raises IOError if the download doesn't match. If it's too long or the checksum doesn't match, the download gets
+    removed so that the next attempt starts from the beginning, otherwise the next attempt carries on from where this
+    one stopped.
+    """
+    # Lengths and checksums are for what was sent, not what it decompresses to.
+    if response_headers.get('Content-Encoding', 'identity') != 'identity':
+        if checksum is None and require_checksum:
+            os.remove(partial_file)
+            raise ValueError('{} was sent compressed without a checksum, so it can\'t be checked'.format(partial_file))
+        return
+    content_range = response_headers.get('Content-Range')
+    expected_size = None
+    if content_range is not None and not content_range.endswith('/*'):
+        expected_size = int(content_range.rsplit('/', 1)[1])
+    elif status != 206 and response_headers.get('Content-Length') is not None:
+        expected_size = int(response_headers['Content-Length'])
+    size = os.path.getsize(partial_file)
+    if expected_size is not None and size != expected_size:
+        if size > expected_size:
+            os.remove(partial_file)
+        raise IOError('Downloaded {} bytes of {}, but expected {}'.format(size, partial_file, expected_size))
+    checksums = [checksum] if checksum is not None else list()
+    etag = (response_headers.get('ETag') or '').strip('"')
+    if response_headers.get('Content-MD5') and status != 206:
+        checksums.append(('md5', base64.b64decode(response_headers['Content-MD5']).hex()))
+    elif response_headers.get('x-amz-request-id') and re.fullmatch('[0-9a-f]{32}', etag):
+        checksums.append(('md5', etag))
+    elif response_headers.get('x-amz-request-id') and re.fullmatch('[0-9a-f]{32}-[0-9]+', etag):
+        checksums.append(('s3-multipart', etag))
+    if not checksums and require_checksum:
+        os.remove(partial_file)
+        raise ValueError('No checksum was published or sent for {}, so it can\'t be checked'.format(partial_file))
+    for algorithm, expected in checksums:
+        if algorithm == 'git-sha1':
+            matches = find_git_blob_sha1(partial_file) == expected
+        elif algorithm == 's3-multipart':
+            matches = expected in find_s3_multipart_etags(partial_file, int(expected.rsplit('-', 1)[1]))
+        else:
+            matches = find_md5(partial_file) == expected
+        if not matches:
+            os.remove(partial_file)
+            raise IOError('Checksum of {} does not match the one for the file'.format(partial_file))
+
+
+def read_file_chunks(filename):
+    """
+    :param filename: Path to file.
+    :return: Generator of the contents of the file, in chunks of bytes.
+    """
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            yield chunk
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    File-like object that reads from an iterable of chunks of bytes (i.e. a download as it comes in), so that modules
+    that read from files (gzip, tarfile) can read from it.
+    """
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.chunk:
+            self.chunk = next(self.chunks, None)
+            if self.chunk is None:
+                self.chunk = b''
+                return 0
+        size = min(len(b), len(self.chunk))
+        b[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = iter(chunks)
+        self.chunk = b''
+
+
+def fetch_url(url, partial_file, headers, session=None, consume=None, checksum=None, require_checksum=False):
+    """
+    Downloads a URL to a file, picking up where the last attempt left off if part of the file was already downloaded.
+    The ETag (or Last-Modified) of the file being downloaded is kept next to it, and sent as If-Range when resuming,
+    so a file that changed on the server in between gets downloaded from the start instead of being spliced together.
+    Once the download is finished it gets checked with verify_download.
+    :param url: URL to download.
+    :param partial_file: Path to download to (i.e. output_file.part).
+    :param headers: Dictionary of headers to send (i.e. for conditional requests).
+    :param session: Session to download with, or None to use urllib.
+    :param consume: Function that gets handed the whole file as an iterable of chunks of bytes while it's downloaded
+    (i.e. to extract it on the fly), starting with anything downloaded by earlier attempts. Has to read everything.
+    :param checksum: Checksum published for the file (see verify_download).
+    :param require_checksum: If True, fail if there's no checksum to check the file against (see verify_download).
+    :return: status, headers: HTTP status (304 if nothing was downloaded, 200 or 206 otherwise) and response headers.
+    """
+    headers = dict(headers)
+    validator_file = partial_file + '.validator'
+    validator = None
+    if os.path.isfile(partial_file) and os.path.isfile(validator_file):
+        with open(validator_file) as f:
+            validator = f.read().strip()
+    if validator:
+        headers['Range'] = 'bytes={}-'.format(os.path.getsize(partial_file))
+        headers['If-Range'] = validator
+    if session is None:
+        try:
+            response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=300)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return 304, e.headers
+            if e.code == 416:
+                # Whatever was downloaded before doesn't line up with the file any more, so start again.
+                os.remove(partial_file)
+            raise
+        status = response.status
+        chunks = iter(lambda: response.read(1048576), b'')
+    else:
+        # rauth can't handle the params=None that newer versions of requests pass along by default.
+        response = session.get(url, params=dict(), headers=headers, stream=True, timeout=300)
+        if response.status_code == 304:
+            return 304, response.headers
+        if response.status_code == 416:
+            os.remove(partial_file)
+        response.raise_for_status()
+        status = response.status_code
+        chunks = response.iter_content(1048576)
+    if status != 206:
+        # Whole file coming (the server ignored the Range, or the file changed), so record what it's a download of in
+        # case this attempt gets interrupted too.
+        with open(validator_file, 'w') as f:
+            f.write(response.headers.get('ETag') or response.headers.get('Last-Modified') or '')
+
+    def save_chunks():
+        with open(partial_file, 'ab' if status == 206 else 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+
+    with response:
+        if consume is None:
+            for _ in save_chunks():
+                pass
+        else:
+            consume(itertools.chain(read_file_chunks(partial_file) if status == 206 else list(), save_chunks()))
+    verify_download(partial_file, status, response.headers, checksum=checksum, require_checksum=require_checksum)
+    return status, response.headers
+
+
+def find_conditional_headers(entry):
+    """
+    :param entry: Manifest entry from the last time a file was downloaded, or None.
+    :return: Headers asking the server to only send the file if it has changed since entry was recorded.
+    """
+    headers = dict()
+    if entry is not None and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry is not None and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def create_manifest_entry(url, fingerprint, response_headers):
+    """
+    :param url: URL that was downloaded.
+    :param fingerprint: Dictionary with the size and sha256 of what was downloaded (see find_file_fingerprint)
+    :param response_headers: Headers the server sent along with the download.
+    :return: Manifest entry for the download.
+    """
+    entry = dict(fingerprint)
+    entry.update({'url': url,
+                  'etag': response_headers.get('ETag'),
+                  'last_modified': response_headers.get('Last-Modified'),
+                  'downloaded': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')})
+    return entry
+
+
+def retry_download(download, url, retries=4, retry_delay=1):
+    """
+    Runs a download, trying again if it fails in a way that trying again might fix.
+    :param download: Function that does the download, with no arguments.
+    :param url: URL being downloaded, for logging.
+    :param retries: Number of times to try again after a download fails.
+    :param retry_delay: Seconds to wait before the first retry. Doubles with each retry after that.
+    :return: Whatever download returns.
+    """
+    attempt = 0
+    while True:
+        try:
+            return download()
+        except OSError as e:
+            # requests exceptions are OSErrors too.
+            if attempt >= retries or not is_retryable(e):
+                raise
+            delay = retry_delay * 2 ** attempt
+            attempt += 1
+            logging.warning('Download of {} failed ({}), trying again in {} seconds (retry {} of {})'
+                            .format(url, e, delay, attempt, retries))
+            time.sleep(delay)
+
+
+def download_file(url, output_file, entry=None, session=None, retries=4, retry_delay=1, consume=None, checksum=None,
+                  require_checksum=False):
+    """
+    Downloads a file, unless it hasn't changed since it was last downloaded. The server is asked to only send the file
+    if it has changed (using the ETag and Last-Modified it sent last time), and if it sends it anyway, its checksum is
+    compared to the last one. The file is streamed to output_file.part, and downloads that fail get tried again,
+    resuming from where they got to - as do downloads that were interrupted in an earlier run.
+    :param url: URL to download.
+    :param output_file: Path to write the file to. Isn't touched if the file hasn't changed.
+    :param entry: Manifest entry from the last time the file was downloaded, or None to download it regardless.
+    :param session: Session (i.e. OAuth1Session) to download with, for URLs that need authentication. If None, urllib
+    is used.
+    :param retries: Number of times to try again after a download fails.
+    :param retry_delay: Seconds to wait before the first retry. Doubles with each retry after that.
+    :param consume: Function to stream the file through as it downloads (see fetch_url). If given, the download is
+    only kept until it's complete, and output_file is never written.
+    :param checksum: Checksum published for the file (see verify_download).
+    :param require_checksum: If True, fail if there's no checksum to check the file against (see verify_download).
+    :return: entry, changed: Manifest entry for the file, and whether or not it changed since entry was recorded.
+    """
+    headers = find_conditional_headers(entry)
+    partial_file = output_file + '.part'
+    status, response_headers = retry_download(lambda: fetch_url(url, partial_file, headers, session=session,
+                                                                consume=consume, checksum=checksum,
+                                                                require_checksum=require_checksum),
+                                              url, retries=retries, retry_delay=retry_delay)
+    if status == 304:
+        # Anything left over from an interrupted download is out of date.
+        for f in (partial_file, partial_file + '.validator'):
+            if os.path.isfile(f):
+                os.remove(f)
+        return entry, False
+    os.remove(partial_file + '.validator')
+    new_entry = create_manifest_entry(url, find_file_fingerprint(partial_file), response_headers)
+    changed = entry is None or entry.get('sha256') != new_entry['sha256']
+    if changed and consume is None:
+        os.replace(partial_file, output_file)
+    else:
+        os.remove(partial_file)
+    return new_entry, changed
+
+
+def find_locus(allele):
+    """
+    :param allele: Allele, in format gene_allele (i.e. BACT000001_1)
+    :return: Locus the allele belongs to (i.e. BACT000001)
+    """
+    return allele.rsplit('_', 1)[0]
+
+
+def read_lines(chunks, fingerprint):
+    """
+    Splits a download into lines as it arrives, finding the size and checksum of the download along the way.
+    :param chunks: Iterable of chunks of bytes.
+    :param fingerprint: Dictionary that the size and sha256 of the download get put in, once it's all been read.
+    :return: Generator of lines, as strings without line endings.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    partial_line = b''
+    for chunk in chunks:
+        sha256.update(chunk)
+        size += len(chunk)
+        lines = (partial_line + chunk).split(b'\n')
+        partial_line = lines.pop()
+        for line in lines:
+            yield line.decode().rstrip('\r')
+    if partial_line:
+        yield partial_line.decode().rstrip('\r')
+    fingerprint.update({'size': size, 'sha256': sha256.hexdigest()})
+
+
+def parse_locus(lines):
+    """
+    Parses alleles for an rMLST locus, changing dashes in allele names to underscores (which is how the rest of
+    ConFindr names alleles) and taking gaps and Ns out of sequences.
+    :param lines: Iterable of lines of FASTA.
+    :return: Generator of (name, sequence) tuples.
+    """
+    name = None
+    sequence_lines = list()
+    for line in lines:
+        if line.startswith('>'):
+            if name is not None:
+                yield name, ''.join(sequence_lines).replace('-', '').replace('N', '')
+            name = (line[1:].split(None, 1) or [''])[0].replace('-', '_')
+            sequence_lines = list()
+        elif name is not None:
+            sequence_lines.append(line.strip())
+    if name is not None:
+        yield name, ''.join(sequence_lines).replace('-', '').replace('N', '')
+
+
+class IndexedFastaWriter(object):
+    """
+    Writes alleles to a FASTA file (wrapped the same way Biopython does), making its .fai and packed alleles (see
+    packed_alleles) at the same time, so neither needs another pass through the file. Several threads can write at
+    once - each batch of alleles gets written together. The file is written under a temporary name and only moved into
+    place, followed by its indexes, by close.
+    """
+
+    def write_alleles(self, alleles, locus=None):
+        """
+        :param alleles: Iterable of (name, sequence) tuples.
+        :param locus: Locus the alleles are from, which gets recorded in self.loci.
+        """
+        width = packed_alleles.LINE_WIDTH
+        with self.lock:
+            for name, sequence in alleles:
+                # Nothing left once gaps and Ns are taken out, and samtools can't index empty sequences.
+                if not sequence:
+                    continue
+                header = '>{}\n'.format(name)
+                sequence_lines = ''.join(sequence[i:i + width] + '\n' for i in range(0, len(sequence), width))
+                self.handle.write(header + sequence_lines)
+                # Same as samtools - bases per line is however many are on the first line.
+                line_bases = min(width, len(sequence))
+                self.fai_lines.append('{}\t{}\t{}\t{}\t{}\n'.format(name, len(sequence), self.offset + len(header),
+                                                                   line_bases, line_bases + 1))
+                self.offset += len(header) + len(sequence_lines)
+                packed_alleles.add_packed_allele(self.packing, name, sequence)
+            if locus is not None:
+                self.loci.add(locus)
+
+    def close(self):
+        self.handle.close()
+        os.replace(self.tmp_file, self.fasta_file)
+        # The .fai and packed alleles have to be newer than the FASTA file to get used.
+        tmp_fai = find_temporary_path(self.fasta_file + '.fai')
+        with open(tmp_fai, 'w') as f:
+            f.write(''.join(self.fai_lines))
+        os.replace(tmp_fai, self.fasta_file + '.fai')
+        packed_alleles.save_packed_alleles(self.packing, self.fasta_file)
+
+    def abort(self):
+        self.handle.close()
+        if os.path.isfile(self.tmp_file):
+            os.remove(self.tmp_file)
+
+    def __init__(self, fasta_file):
+        self.fasta_file = fasta_file
+        self.tmp_file = find_temporary_path(fasta_file)
+        self.handle = open(self.tmp_file, 'w')
+        self.offset = 0
+        self.fai_lines = list()
+        self.packing = packed_alleles.start_packing()
+        self.loci = set()
+        self.lock = threading.Lock()
 
+
+def copy_loci(fasta_file, loci, writer):
+    """
+    Copies the alleles for some loci from an old rMLST_combined.fasta to a new one.
+    :param fasta_file: Path to old rMLST_combined.fasta
+    :param loci: List of loci to copy.
+    :param writer: IndexedFastaWriter for the new rMLST_combined.fasta
+    """
+    if not loci:
+        return
+    loci = set(loci)
+    index_fasta(fasta_file)
+    with pysam.FastaFile(fasta_file) as f:
+        writer.write_alleles((allele, f.fetch(allele)) for allele in f.references if find_locus(allele) in loci)
+
+
+def find_derived_files(database):
+    """
+    :param database: Path to a database.
+    :return: List of the indexes (.fai, KMA index, k-mer files) that exist for the database.
+    """
+    prefix = database.replace('.fasta', '')
+    return glob.glob(database + '.fai') + glob.glob(prefix + '_kma.*') + glob.glob(prefix + '_kmers_k*')
+
+
+def invalidate_derived_databases(database_folder, changed_loci, old_allele_lists, changed_files=()):
+    """
+    Removes genus (and species) specific databases that are out of date after an update, along with their indexes, so
+    that they get made again the next time they're needed. A database is out of date if the alleles for its genus
+    changed, or any of its alleles come from a locus that changed. Indexes for rMLST_combined.fasta are removed if any
+    locus changed, and indexes for any other files that changed are removed too. Databases that get removed are taken
+    out of prebuilt.json.
+    :param database_folder: Path to folder with ConFindr's databases.
+    :param changed_loci: List of loci that changed.
+    :param old_allele_lists: Dictionary with gene_allele.txt and species_allele.txt as keys, and what was in them
+    (see read_gene_allele_file) before the update as values.
+    :param changed_files: Names of other files in the database folder that changed (i.e. cgderived databases).
+    :return: List of databases that were removed, or had their indexes removed.
+    """
+    changed_loci = set(changed_loci)
+    new_allele_lists = dict()
+    for allele_file in old_allele_lists:
+        path = os.path.join(database_folder, allele_file)
+        new_allele_lists[allele_file] = read_gene_allele_file(path) if os.path.isfile(path) else dict()
+    invalidated = list()
+    for database in sorted(glob.glob(os.path.join(database_folder, '*_db.fasta'))):
+        name = os.path.split(database)[-1][:-len('_db.fasta')]
+        for allele_file, target in (('gene_allele.txt', name), ('species_allele.txt', name.replace('_', ' '))):
+            if target in new_allele_lists.get(allele_file, dict()) or target in old_allele_lists.get(allele_file, dict()):
+                break
+        else:
+            # Not made from rMLST (i.e. made with confindr_create_db), so leave it alone.
+            continue
+        alleles = new_allele_lists[allele_file].get(target)
+        if alleles is not None and alleles == old_allele_lists[allele_file].get(target) and \
+                not any(find_locus(allele) in changed_loci for allele in alleles):
+            continue
+        logging.info('Removing out of date database {}'.format(os.path.split(database)[-1]))
+        for f in [database] + find_derived_files(database):
+            os.remove(f)
+        invalidated.append(database)
+    reindexed = list(changed_files)
+    if changed_loci:
+        reindexed.append('rMLST_combined.fasta')
+    for database in [os.path.join(database_folder, f) for f in reindexed]:
+        derived_files = find_derived_files(database)
+        if os.path.split(database)[-1] == 'rMLST_combined.fasta' and is_complete_fai(database):
+            # Made along with rMLST_combined.fasta, so it's already up to date.
+            derived_files.remove(database + '.fai')
+        if derived_files:
+            logging.info('Removing out of date indexes for {}'.format(os.path.split(database)[-1]))
+            invalidated.append(database)
+        for f in derived_files:
+            os.remove(f)
+    fingerprint_file = os.path.join(database_folder, PREBUILT_FINGERPRINT)
+    if invalidated and os.path.isfile(fingerprint_file):
+        with open(fingerprint_file) as f:
+            fingerprint = json.load(f)
+        removed = {os.path.split(database)[-1] for database in invalidated}
+        fingerprint['databases'] = [database for database in fingerprint['databases'] if database not in removed]
+        with open(fingerprint_file, 'w') as f:
+            json.dump(fingerprint, f, indent=2)
+    return invalidated
+
+
+def prebuild_databases(database_folder, genera=None, threads=1, kmers=False):
+    """
+    Creates every genus-specific rMLST database along with all of the indexes ConFindr needs for them, so that
+    nothing has to be built when ConFindr runs and the database folder can be mounted read-only. What was built is
+    recorded in a fingerprint file (prebuilt.json) in the database folder.
+    :param database_folder: Path to folder with ConFindr's databases.
+    :param genera: List of genera to build databases for. If None, every genus in gene_allele.txt is built.
+    :param threads: Number of databases to index at once.
+    :param kmers: If True, k-mer files for --bait_engine numpy are made as well.
+    :return: List of paths to the databases that were built.
+    """
+    gene_allele_file = os.path.join(database_folder, 'gene_allele.txt')
+    rmlst_file = os.path.join(database_folder, 'rMLST_combined.fasta')
+    databases = list()
+    if os.path.isfile(gene_allele_file) and os.path.isfile(rmlst_file):
+        genus_alleles = read_gene_allele_file(gene_allele_file)
+        if genera is None:
+            genera = sorted(genus_alleles)
+        # Pack rMLST_combined once (if database setup didn't already), so every genus is a slice out of it.
+        packed_alleles.create_packed_alleles(rmlst_file)
+        for genus in genera:
+            if genus not in genus_alleles:
+                logging.warning('WARNING: No rMLST alleles found for genus {}, skipping it.'.format(genus))
+                continue
+            genus_database = os.path.join(database_folder, '{}_db.fasta'.format(genus))
+            if not is_complete_fasta(genus_database):
+                logging.info('Setting up rMLST genus-specific database for genus {}...'.format(genus))
+                setup_allelespecific_database(fasta_file=genus_database,
+                                              database_folder=database_folder,
+                                              allele_list=genus_alleles[genus])
+            databases.append(genus_database)
+        databases.append(rmlst_file)
+    else:
+        logging.warning('WARNING: rMLST databases not found, so only core-genome derived databases will be prebuilt.')
+    databases += sorted(glob.glob(os.path.join(database_folder, '*_db_cgderived.fasta')))
+
+    logging.info('Indexing {} databases...'.format(len(databases)))
+    # Threads rather than processes, since indexing is mostly waiting on KMA.
+    p = ThreadPool(processes=max(1, threads))
+    p.map(lambda database: index_database(database, bait_engine='numpy' if kmers else 'bbduk'), databases)
+    p.close()
+    p.join()
+
+    fingerprint = {'date': datetime.datetime.utcnow().strftime('%Y-%m-%d'),
+                   'rMLST_combined.fasta': find_file_fingerprint(rmlst_file),
+                   'gene_allele.txt': find_file_fingerprint(gene_allele_file),
+                   'kmers': kmers,
+                   'databases': [os.path.split(database)[-1] for database in databases]}
+    with open(os.path.join(database_folder, PREBUILT_FINGERPRINT), 'w') as f:
+        json.dump(fingerprint, f, indent=2)
+    logging.info('Done prebuilding {} databases!'.format(len(databases)))
+    return databases
+
+
+def update_rmlst_database(rmlst_rest, output_folder, manifest=None):
+    """
+    Downloads rMLST loci and profiles through the REST API (several at once, see RmlstRest.max_sessions), and makes
+    rMLST_combined.fasta (along with its .fai and packed alleles) and the allele files out of them. With a manifest,
+    only the loci and profiles that changed since the last update get downloaded.
+    :param rmlst_rest: RmlstRest, with a session token.
+    :param output_folder: Folder to put databases in.
+    :param manifest: Manifest of the output folder (see read_manifest), which gets updated. If None, everything is
+    downloaded.
+    :return: List of loci that changed.
+    """
+    rmlst_rest.get_loci_and_scheme_url()
+    # The profiles get downloaded while the loci are, sharing the same sessions.
+    p = ThreadPool(processes=1)
+    profile_download = p.apply_async(rmlst_rest.download_profile, kwds={'manifest': manifest})
+    p.close()
+    # Loci get written into a new rMLST_combined.fasta as they're downloaded.
+    combined_file = os.path.join(output_folder, 'rMLST_combined.fasta')
+    writer = IndexedFastaWriter(combined_file)
+    try:
+        changed_loci = rmlst_rest.download_loci(writer, manifest=manifest)
+        if changed_loci or not os.path.isfile(combined_file):
+            loci = manifest['loci'] if manifest is not None else writer.loci
+            copy_loci(combined_file, [locus for locus in loci if locus not in writer.loci], writer)
+            writer.close()
+        else:
+            logging.info('No rMLST loci have changed.')
+            writer.abort()
+    except BaseException:
+        writer.abort()
+        raise
+    profiles_changed = profile_download.get()
+    p.join()
+
+    if profiles_changed or not os.path.isfile(os.path.join(output_folder, ALLELE_STORE)):
+        logging.info('Assigning alleles to genera and species...')
+        # Parse profiles so that we know what alleles are found with each genus.
+        create_allele_files(profiles_file=os.path.join(output_folder, 'profiles.txt'),
+                            output_folder=output_folder)
+    if manifest is not None:
+        for output_file in ['rMLST_combined.fasta', 'gene_allele.txt', 'species_allele.txt']:
+            manifest['files'][output_file] = find_file_fingerprint(os.path.join(output_folder, output_file))
+    return changed_loci
+
+
+def setup_confindr_database(output_folder, consumer_secret, manifest=None, download_threads=8):
+    """
+    Goes through the rMLST REST API (which needs the user to authorize ConFindr in their browser) and downloads
+    rMLST data. See update_rmlst_database.
+    :param output_folder: Folder to put databases in.
+    :param consumer_secret: Path to file with consumer key and secret.
+    :param manifest: Manifest of the output folder, or None to download everything.
+    :param download_threads: Number of files to download at once.
+    :return: List of loci that changed.
+    """
     # Go through the REST API in order to get profiles downloaded.
     rmlst_rest = RmlstRest(consumer_secret_file=consumer_secret,
-                           output_folder=output_folder)
+                           output_folder=output_folder,
+                           max_sessions=download_threads)
     rmlst_rest.get_request_token()
     rmlst_rest.get_access_token()
     rmlst_rest.get_session_token()
-    rmlst_rest.get_loci_and_scheme_url()
-    rmlst_rest.download_loci()
-    rmlst_rest.download_profile()
-
-    # With the sequences downloaded, make a file of all rMLST sequences combined.
-    logging.info('Combining rMLST files...')
-    with open(os.path.join(output_folder, 'rMLST_combined.fasta'), 'w') as f:
-        locus_files = sorted(glob.glob(os.path.join(output_folder, 'BACT*.tfa')))
-        for locus_file in locus_files:
-            for record in SeqIO.parse(locus_file, 'fasta'):
-                record.id = record.id.replace('-', '_')
-                record.seq._data = record.seq._data.replace('-', '').replace('N', '')
-                record.name = ''
-                record.description = ''
-                SeqIO.write(record, f, 'fasta')
-            # Clean up individual file.
-            try:
-                os.remove(locus_file)
-            except OSError:
-                logging.warning('WARNING: Could not delete {}. This won\'t affect ConFindr performance, but '
-                                ' you may want to delete it to save on disk space.'.format(locus_file))
+    return update_rmlst_database(rmlst_rest, output_folder, manifest=manifest)
 
-    logging.info('Assigning alleles to genera...')
-    # Parse profiles so that we know what alleles are found with each genus.
-    create_gene_allele_file(profiles_file=os.path.join(output_folder, 'profiles.txt'),
-                            gene_allele_file=os.path.join(output_folder, 'gene_allele.txt'))
-    
-    
-def download_mash_sketch(output_folder):
+
+def is_downloaded(filename, entry):
+    """
+    :param filename: Path to a downloaded file.
+    :param entry: Manifest entry for the file, or None.
+    :return: True if the file is there, and is the size the manifest says it should be (if there's a manifest entry).
+    """
+    return os.path.isfile(filename) and (not entry or entry.get('size') == os.path.getsize(filename))
+
+
+def find_github_checksum(contents_url):
+    """
+    :param contents_url: GitHub API URL for a file in a repository, i.e.
+    https://api.github.com/repos/<owner>/<repository>/contents/<path>?ref=<branch>
+    :return: Checksum GitHub publishes for the file, as a tuple for verify_download.
+    """
+    def fetch():
+        with urllib.request.urlopen(contents_url, timeout=300) as response:
+            return json.loads(response.read().decode())
+    return 'git-sha1', retry_download(fetch, contents_url)['sha']
+
+
+def download_mash_sketch(output_folder, manifest=None,
+                         url='https://github.com/OLC-Bioinformatics/ConFindr/raw/master/refseq_sketch/refseq.msh',
+                         contents_url='https://api.github.com/repos/OLC-Bioinformatics/ConFindr/contents/'
+                                      'refseq_sketch/refseq.msh?ref=master'):
+    """
+    :param output_folder: Folder to download refseq.msh to.
+    :param manifest: Manifest of the output folder (see read_manifest). If given, the sketch is only downloaded if it
+    has changed, and the manifest gets updated.
+    :param url: URL of the sketch.
+    :param contents_url: GitHub API URL for the sketch, which gives the checksum it gets checked against.
+    :return: True if the sketch changed, False otherwise.
+    """
     logging.info('Downloading mash refseq sketch...')
-    urllib.request.urlretrieve('https://github.com/OLC-Bioinformatics/ConFindr/raw/master/refseq_sketch/refseq.msh',
-                               os.path.join(output_folder, 'refseq.msh'))
+    sketch = os.path.join(output_folder, 'refseq.msh')
+    entry = manifest['files'].get('refseq.msh') if manifest is not None else None
+    entry, changed = download_file(url, sketch, entry=entry if is_downloaded(sketch, entry) else None,
+                                   checksum=find_github_checksum(contents_url), require_checksum=True)
+    if manifest is not None:
+        manifest['files']['refseq.msh'] = entry
+    return changed
+
+
+def extract_tar_stream(chunks, staging_folder):
+    """
+    Extracts a .tar.gz as it's read, rather than once it's been saved. Only regular files are extracted, and only ones
+    that would end up inside staging_folder. Everything is read, even after the end of the archive, so that gzip
+    checks the CRC of the whole thing.
+    :param chunks: Iterable of chunks of bytes of the .tar.gz
+    :param staging_folder: Folder to extract to. Anything already in it gets removed first.
+    :return: List of the names of files extracted.
+    """
+    if os.path.isdir(staging_folder):
+        shutil.rmtree(staging_folder)
+    os.makedirs(staging_folder)
+    names = list()
+    try:
+        with gzip.GzipFile(fileobj=io.BufferedReader(ChunkReader(chunks), 1048576)) as gz:
+            with tarfile.open(fileobj=gz, mode='r|') as tar:
+                for member in tar:
+                    name = os.path.normpath(member.name)
+                    if not member.isfile() or os.path.isabs(name) or name.startswith('..'):
+                        continue
+                    output_file = os.path.join(staging_folder, name)
+                    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+                    with tar.extractfile(member) as source, open(output_file, 'wb') as destination:
+                        shutil.copyfileobj(source, destination, 1048576)
+                    names.append(name)
+            while gz.read(1048576):
+                pass
+    # A corrupt gzip stream raises OSError (gzip.BadGzipFile from Python 3.8).
+    except (tarfile.TarError, OSError, EOFError, zlib.error) as e:
+        raise IOError('Could not extract download: {}'.format(e))
+    return names
 
 
-def download_cgmlst_derived_data(output_folder):
+def download_cgmlst_derived_data(output_folder, manifest=None, url='https://ndownloader.figshare.com/files/14771267',
+                                 md5=None):
+    """
+    Downloads the cgMLST-derived databases, extracting them as they download. Files are extracted to a staging folder
+    and only moved into place once the whole archive has downloaded and checked out (see verify_download), so a
+    download that fails part way through never leaves half-extracted databases behind. An interrupted download picks
+    up from where it stopped.
+    :param output_folder: Folder to download and extract the cgMLST-derived databases to.
+    :param manifest: Manifest of the output folder (see read_manifest). If given, the databases are only downloaded if
+    they have changed, and the manifest gets updated with the archive and every file in it.
+    :param url: URL of the archive.
+    :param md5: MD5 published for the archive. If None, the archive has to come with one from the server (figshare
+    serves files from S3, which sends their MD5 as the ETag), or the download fails.
+    :return: List of files extracted that changed.
+    """
     logging.info('Downloading cgMLST-derived data for Escherichia, Salmonella, and Listeria...')
-    urllib.request.urlretrieve('https://ndownloader.figshare.com/files/14771267',
-                               os.path.join(output_folder, 'confindr_db.tar.gz'))
     confindr_tar = os.path.join(output_folder, 'confindr_db.tar.gz')
-    tar = tarfile.open(confindr_tar)
-    tar.extractall(path=output_folder)
-    tar.close()
-    os.remove(confindr_tar)
+    staging_folder = find_temporary_path(confindr_tar)
+    entry = None
+    if manifest is not None:
+        entry = manifest['files'].get('confindr_db.tar.gz')
+        # Only skip the download if everything that came out of the archive last time is still there.
+        extracted = [name for name in manifest['files']
+                     if manifest['files'][name] and manifest['files'][name].get('source') == 'confindr_db.tar.gz']
+        if not extracted or not all(is_downloaded(os.path.join(output_folder, name), manifest['files'][name])
+                                    for name in extracted):
+            entry = None
+    members = list()
+
+    def extract(chunks):
+        # Called again for each retry, each of which extracts the whole archive again.
+        members[:] = extract_tar_stream(chunks, staging_folder)
+
+    try:
+        entry, changed = download_file(url, confindr_tar, entry=entry, consume=extract,
+                                       checksum=('md5', md5) if md5 is not None else None, require_checksum=True)
+        if manifest is not None:
+            manifest['files']['confindr_db.tar.gz'] = entry
+        if not changed:
+            return list()
+        changed_files = list()
+        for name in members:
+            fingerprint = find_file_fingerprint(os.path.join(staging_folder, name))
+            fingerprint['source'] = 'confindr_db.tar.gz'
+            if manifest is not None:
+                if (manifest['files'].get(name) or dict()).get('sha256') == fingerprint['sha256']:
+                    continue
+                manifest['files'][name] = fingerprint
+            changed_files.append(name)
+        for name in members:
+            os.makedirs(os.path.dirname(os.path.join(output_folder, name)), exist_ok=True)
+            os.replace(os.path.join(staging_folder, name), os.path.join(output_folder, name))
+    finally:
+        if os.path.isdir(staging_folder):
+            shutil.rmtree(staging_folder)
+    return changed_files
 
 
 def main():
@@ -248,17 +1429,64 @@ def main():
     parser.add_argument('-o', '--output_folder',
                         default=os.environ.get('CONFINDR_DB', os.path.expanduser('~/.confindr_db')),
                         help='Path to download databases to - if folder does not exist, will be created. If folder does '
-                             'exist, will be deleted and updated sequences downloaded. Defaults to ~/.confindr_db, or '
-                             'the CONFINDR_DB environmental variable.')
+                             'exist, only what has changed since it was last updated will be downloaded (see --clean). '
+                             'Defaults to ~/.confindr_db, or the CONFINDR_DB environmental variable.')
     parser.add_argument('-s', '--secret_file',
                         type=str,
                         help='Path to consumer secret file for rMLST database.')
+    parser.add_argument('-c', '--clean',
+                        default=False,
+                        action='store_true',
+                        help='Delete the output folder and download everything again, rather than only downloading '
+                             'what has changed since the last time databases were downloaded.')
+    parser.add_argument('-p', '--prebuild',
+                        default=False,
+                        action='store_true',
+                        help='Once databases are downloaded, create the genus-specific databases and their indexes '
+                             'for every genus, so that ConFindr never has to build anything when it runs and the '
+                             'database folder can be mounted read-only. Requires KMA.')
+    parser.add_argument('-po', '--prebuild_only',
+                        default=False,
+                        action='store_true',
+                        help='Prebuild databases in an existing database folder without downloading anything.')
+    parser.add_argument('-g', '--genera',
+                        nargs='+',
+                        help='Genera to prebuild databases for. Defaults to every genus with rMLST data.')
+    parser.add_argument('-k', '--kmers',
+                        default=False,
+                        action='store_true',
+                        help='When prebuilding, also create the k-mer files used by confindr --bait_engine numpy.')
+    parser.add_argument('-t', '--threads',
+                        type=int,
+                        default=1,
+                        help='Number of databases to index at once when prebuilding. Defaults to 1.')
+    parser.add_argument('-dt', '--download_threads',
+                        type=int,
+                        default=8,
+                        help='Number of rMLST files to download at once. Defaults to 8.')
     args = parser.parse_args()
-    if os.path.isdir(args.output_folder):
+    if args.prebuild_only:
+        if not os.path.isdir(args.output_folder):
+            logging.error('ERROR: Database folder {} does not exist.'.format(args.output_folder))
+            quit(code=1)
+        prebuild_databases(args.output_folder, genera=args.genera, threads=args.threads, kmers=args.kmers)
+        return
+    if args.clean and os.path.isdir(args.output_folder):
         logging.info('Removing old databases...')
         shutil.rmtree(args.output_folder)
-    os.makedirs(args.output_folder)
-    download_cgmlst_derived_data(args.output_folder)
+    if not os.path.isdir(args.output_folder):
+        os.makedirs(args.output_folder)
+    # Anything that's already there and hasn't changed (according to the manifest) is kept, along with the databases
+    # and indexes made from it.
+    manifest = read_manifest(args.output_folder)
+    old_allele_lists = dict()
+    for allele_file in ['gene_allele.txt', 'species_allele.txt']:
+        if os.path.isfile(os.path.join(args.output_folder, allele_file)):
+            old_allele_lists[allele_file] = read_gene_allele_file(os.path.join(args.output_folder, allele_file))
+        else:
+            old_allele_lists[allele_file] = dict()
+    changed_files = download_cgmlst_derived_data(args.output_folder, manifest=manifest)
+    changed_loci = list()
     if args.secret_file is None:
         logging.warning('WARNING: Without an rMLST secret file, data will only be downloaded for Escherichia, '
                         'Salmonella, and Listeria. See '
@@ -266,15 +1494,26 @@ def main():
                         'instructions on how to get access to rMLST databases so ConFindr can be used for other species'
                         ' as well')
     else:
-        setup_confindr_database(args.output_folder,
-                                args.secret_file)
-    download_mash_sketch(args.output_folder)
+        changed_loci = setup_confindr_database(args.output_folder,
+                                               args.secret_file,
+                                               manifest=manifest,
+                                               download_threads=args.download_threads)
+    download_mash_sketch(args.output_folder, manifest=manifest)
+    invalidated = invalidate_derived_databases(args.output_folder,
+                                               changed_loci=changed_loci,
+                                               old_allele_lists=old_allele_lists,
+                                               changed_files=changed_files)
+    write_manifest(manifest, args.output_folder)
+    logging.info('{} rMLST loci and {} other files changed, {} databases need to be rebuilt.'
+                 .format(len(changed_loci), len(changed_files), len(invalidated)))
     current_year = datetime.datetime.utcnow().year
     current_month = datetime.datetime.utcnow().month
     current_day = datetime.datetime.utcnow().day
     with open(os.path.join(args.output_folder, 'download_date.txt'), 'w') as f:
         f.write('{}-{}-{}'.format(current_year, current_month, current_day))
     logging.info('Done downloading ConFindr databases!')
+    if args.prebuild:
+        prebuild_databases(args.output_folder, genera=args.genera, threads=args.threads, kmers=args.kmers)
     
     
 if __name__ == '__main__':
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+from confindr_src.database_setup import build_lock
+from confindr_src.wrappers import runner
+import subprocess
+import threading
+import tempfile
+import hashlib
+import logging
+import glob
+import os
+
+# Settings for hosting KMA databases in shared memory. Set once through configure, from command line options.
+shared_memory = {'enabled': False,
+                 'registry': os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                                          'confindr_kma_shm')}
+# KMA database prefixes that this process is using the shared memory copy of. Each one counts once towards the number
+# of jobs using a database, however many samples in this job use it.
+attached_databases = set()
+attached_lock = threading.Lock()
+
+
+def configure(enabled=False, registry=None):
+    """
+    Sets up whether KMA databases get hosted in shared memory.
+    :param enabled: If True, databases are loaded into shared memory with kma shm and KMA gets pointed at them.
+    :param registry: Folder that jobs on this machine record which shared databases they're using in. Has to be on
+    the same machine for every job sharing the databases - if None, a folder in /dev/shm (or the temporary folder,
+    if there's no /dev/shm) is used.
+    """
+    shared_memory['enabled'] = enabled
+    if registry is not None:
+        shared_memory['registry'] = registry
+
+
+def find_registry_folder(kma_database):
+    """
+    :param kma_database: Prefix of a KMA database.
+    :return: Folder that jobs using the shared copy of the database leave a file named after their process ID in.
+    """
+    key = hashlib.sha256(os.path.abspath(kma_database).encode()).hexdigest()[:16]
+    return os.path.join(shared_memory['registry'], key)
+
+
+def is_running(pid):
+    """
+    :param pid: Process ID.
+    :return: True if a process with the ID is running on this machine, False otherwise.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running, but owned by someone else.
+        return True
+    return True
+
+
+def find_holders(registry_folder):
+    """
+    Finds the processes using a shared database, cleaning up after any that exited without letting go of it (i.e.
+    because they were killed).
+    :param registry_folder: Registry folder for a database, as found by find_registry_folder.
+    :return: List of process IDs that are still using the database.
+    """
+    holders = list()
+    for holder_file in glob.glob(os.path.join(registry_folder, '[0-9]*')):
+        pid = int(os.path.split(holder_file)[-1])
+        if is_running(pid):
+            holders.append(pid)
+        else:
+            os.remove(holder_file)
+    return holders
+
+
+def attach(kma_database, log=None):
+    """
+    Starts using the shared memory copy of a KMA database, loading it with kma shm if no other job on this machine
+    has already. The database stays attached (so later samples don't have to load it again) until detach is called.
+    :param kma_database: Prefix of a KMA database, as created by database_setup.index_database.
+    :param log: Logfile to write commands, stdout and stderr to.
+    :return: True if KMA can be run on the database with -shm, False if it wasn't enabled or couldn't be loaded, in
+    which case KMA should read the database from disk as usual.
+    """
+    if not shared_memory['enabled']:
+        return False
+    with attached_lock:
+        if kma_database in attached_databases:
+            return True
+        registry_folder = find_registry_folder(kma_database)
+        try:
+            os.makedirs(registry_folder, exist_ok=True)
+            with build_lock(registry_folder):
+                loaded_file = os.path.join(registry_folder, 'loaded')
+                # If the last job to use it was killed before destroying it, the shared copy is still there.
+                if not os.path.isfile(loaded_file):
+                    logging.debug('Loading {} into shared memory'.format(kma_database))
+                    runner.run('kma shm -t_db {} -shmLvl 1'.format(kma_database), log=log)
+                    with open(loaded_file, 'w') as f:
+                        f.write(os.path.abspath(kma_database) + '\n')
+                open(os.path.join(registry_folder, str(os.getpid())), 'w').close()
+        except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            logging.warning('Could not load {} into shared memory ({}), KMA will read it from disk'
+                            .format(kma_database, e))
+            return False
+        attached_databases.add(kma_database)
+    return True
+
+
+def detach(kma_database, log=None):
+    """
+    Stops using the shared memory copy of a KMA database. Once no job on this machine is using it, it gets removed
+    from shared memory.
+    :param kma_database: Prefix of a KMA database that attach returned True for.
+    :param log: Logfile to write commands, stdout and stderr to.
+    """
+    with attached_lock:
+        if kma_database not in attached_databases:
+            return
+        attached_databases.remove(kma_database)
+        registry_folder = find_registry_folder(kma_database)
+        with build_lock(registry_folder):
+            try:
+                os.remove(os.path.join(registry_folder, str(os.getpid())))
+            except FileNotFoundError:
+                pass
+            if find_holders(registry_folder):
+                return
+            logging.debug('Removing {} from shared memory'.format(kma_database))
+            try:
+                runner.run('kma shm -t_db {} -shmLvl 1 -destroy'.format(kma_database), log=log)
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                logging.warning('Could not remove {} from shared memory: {}'.format(kma_database, e))
+            try:
+                os.remove(os.path.join(registry_folder, 'loaded'))
+            except FileNotFoundError:
+                pass
+
+
+def detach_all(log=None):
+    """
+    Stops using every shared database this process is using, so that nothing is left loaded once a run ends.
+    :param log: Logfile to write commands, stdout and stderr to.
+    """
+    for kma_database in sorted(attached_databases):
+        detach(kma_database, log=log)
+
+
+def detach_unused(kma_databases, log=None):
+    """
+    Stops using every shared database this process is using that isn't in kma_databases, so that databases don't stay
+    loaded once the last sample that needs them is done.
+    :param kma_databases: Prefixes of the KMA databases that are still needed.
+    :param log: Logfile to write commands, stdout and stderr to.
+    """
+    for kma_database in sorted(attached_databases - set(kma_databases)):
+        detach(kma_database, log=log)
+
+
+def run_kma(cmd, kma_database, log=None):
+    """
+    Runs a KMA command, using the shared memory copy of the database if there is one. If KMA fails with the shared
+    copy, the command is run again reading the database from disk.
+    :param cmd: KMA command, as a string.
+    :param kma_database: Prefix of the KMA database the command uses.
+    :param log: Logfile to write commands, stdout and stderr to.
+    :return: out, err: stdout and stderr from KMA.
+    """
+    if not attach(kma_database, log=log):
+        return runner.run(cmd, log=log)
+    try:
+        return runner.run(cmd + ' -shm 1', log=log)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        logging.warning('KMA failed using {} from shared memory ({}), reading it from disk instead'
+                        .format(kma_database, e))
+        return runner.run(cmd, log=log)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+from multiprocessing.pool import ThreadPool
+from functools import partial
+import multiprocessing
+import numpy as np
+import threading
+import hashlib
+import logging
+import gzip
+import os
+from Bio import SeqIO
+
+# Two bit codes for each base. Anything that isn't ACGT gets a 4, and k-mers containing it are thrown out.
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate(b'ACGT'):
+    BASE_CODES[base] = code
+    BASE_CODES[ord(chr(base).lower())] = code
+
+# k-mer arrays that worker processes have already memory mapped, keyed by file path.
+loaded_kmer_files = dict()
+
+
+def find_canonical_kmers(sequence, k=27):
+    """
+    Finds every k-mer in a sequence, 2-bit encoded into a 64 bit integer. The smaller of each k-mer and its
+    reverse complement is used, so that reads from either strand match.
+    :param sequence: Sequence to find k-mers in, as bytes.
+    :param k: k-mer size. Must be 32 or less.
+    :return: Array with the start position of each k-mer that only has ACGT in it, and array of those k-mers.
+    """
+    codes = BASE_CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    num_kmers = len(codes) - k + 1
+    if num_kmers <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64)
+    # Count how many non-ACGT bases each window has so that those windows can be skipped.
+    invalid_counts = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = (invalid_counts[k:] - invalid_counts[:-k]) == 0
+    codes = codes.astype(np.uint64) & np.uint64(3)
+    forward = np.zeros(num_kmers, dtype=np.uint64)
+    reverse = np.zeros(num_kmers, dtype=np.uint64)
+    for i in range(k):
+        window = codes[i:i + num_kmers]
+        forward = (forward << np.uint64(2)) | window
+        reverse |= (np.uint64(3) - window) << np.uint64(2 * i)
+    return np.nonzero(valid)[0], np.minimum(forward, reverse)[valid]
+
+
+def find_kmer_file(database, k=27, kmer_folder=None):
+    """
+    :param database: Path to core gene database, in FASTA format.
+    :param k: k-mer size.
+    :param kmer_folder: Folder to cache the k-mers in instead of next to the database (i.e. if the database's folder
+    can't be written to).
+    :return: Path to the file that the database's k-mers get cached in.
+    """
+    if kmer_folder is None:
+        return os.path.splitext(database)[0] + '_kmers_k{}.npy'.format(k)
+    # Databases in different folders can have the same name, so tell them apart by their full path.
+    path_hash = hashlib.sha256(os.path.abspath(database).encode()).hexdigest()[:12]
+    return os.path.join(kmer_folder, '{}_{}_kmers_k{}.npy'.format(os.path.splitext(os.path.split(database)[1])[0],
+                                                                  path_hash, k))
+
+
+def create_kmer_file(database, k=27, chunk_size=1000000, kmer_folder=None):
+    """
+    Finds every k-mer in a database and caches them on disk as a sorted NumPy array next to the database, or in
+    kmer_folder if the database's folder can't be written to. The cache is only rebuilt if it doesn't exist or is
+    older than the database.
+    :param database: Path to core gene database, in FASTA format.
+    :param k: k-mer size.
+    :param chunk_size: Approximate number of bases to find k-mers for at once, to keep memory use down.
+    :param kmer_folder: Folder to cache the k-mers in if they can't go next to the database. If None, they have to go
+    next to the database.
+    :return: Path to the k-mer file.
+    """
+    kmer_files = [find_kmer_file(database, k)]
+    if kmer_folder is not None:
+        kmer_files.append(find_kmer_file(database, k, kmer_folder))
+    for kmer_file in kmer_files:
+        if os.path.isfile(kmer_file) and os.path.getmtime(kmer_file) >= os.path.getmtime(database):
+            return kmer_file
+    logging.info('Finding k-mers in {}...'.format(os.path.split(database)[-1]))
+    kmer_chunks = list()
+    sequences = list()
+    bases = 0
+    for record in SeqIO.parse(database, 'fasta'):
+        sequences.append(bytes(record.seq))
+        bases += len(record.seq)
+        if bases >= chunk_size:
+            kmer_chunks.append(np.unique(find_canonical_kmers(b'N'.join(sequences), k)[1]))
+            sequences = list()
+            bases = 0
+    if sequences:
+        kmer_chunks.append(np.unique(find_canonical_kmers(b'N'.join(sequences), k)[1]))
+    if kmer_chunks:
+        kmers = np.unique(np.concatenate(kmer_chunks))
+    else:
+        kmers = np.zeros(0, dtype=np.uint64)
+    for kmer_file in kmer_files:
+        # Write somewhere else first and then move into place, so that nothing else can ever load a half-written file.
+        tmp_file = '{}.{}_{}.tmp.npy'.format(kmer_file, os.getpid(), threading.get_ident())
+        try:
+            np.save(tmp_file, kmers)
+            os.replace(tmp_file, kmer_file)
+        except OSError:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+            if kmer_file == kmer_files[-1]:
+                raise
+            logging.warning('Could not write k-mers to {}, caching them in {} instead'.format(kmer_file,
+                                                                                              kmer_folder))
+            continue
+        return kmer_file
+
+
+def load_kmer_file(kmer_file):
+    """
+    Memory maps a k-mer file read-only. Done once per process, and all processes share the same pages.
+    :param kmer_file: Path to k-mer file created by create_kmer_file
+    :return: Sorted array of k-mers.
+    """
+    if kmer_file not in loaded_kmer_files:
+        loaded_kmer_files[kmer_file] = np.load(kmer_file, mmap_mode='r')
+    return loaded_kmer_files[kmer_file]
+
+
+def find_baited_reads(kmer_file, k, sequence_sets):
+    """
+    Checks a batch of reads for k-mers found in a database.
+    :param kmer_file: Path to k-mer file created by create_kmer_file
+    :param k: k-mer size.
+    :param sequence_sets: List with a list of read sequences (as bytes) for each read file. For paired reads, this is
+    the forward and reverse sequences, which need to be in the same order.
+    :return: Boolean array saying whether or not each read (or pair of reads) has a k-mer in the database.
+    """
+    database_kmers = load_kmer_file(kmer_file)
+    baited = np.zeros(len(sequence_sets[0]), dtype=bool)
+    if len(database_kmers) == 0:
+        return baited
+    for sequences in sequence_sets:
+        # Join the reads up so they can all be done at once - k-mers that span two reads contain the N and get ignored.
+        read_starts = np.cumsum([0] + [len(sequence) + 1 for sequence in sequences[:-1]])
+        positions, kmers = find_canonical_kmers(b'N'.join(sequences), k)
+        indices = np.searchsorted(database_kmers, kmers)
+        indices[indices == len(database_kmers)] = 0
+        matches = database_kmers[indices] == kmers
+        baited[np.searchsorted(read_starts, positions[matches], side='right') - 1] = True
+    return baited
+
+
+def read_fastq_batches(fastq, batch_size):
+    """
+    Reads a FASTQ file a batch at a time.
+    :param fastq: Path to FASTQ file, which may be gzipped.
+    :param batch_size: Number of reads in each batch.
+    :return: Generator of lists of reads, where each read is a list of its four lines (as bytes).
+    """
+    opener = gzip.open if fastq.endswith('.gz') else open
+    with opener(fastq, 'rb') as f:
+        batch = list()
+        while True:
+            header = f.readline()
+            if not header:
+                break
+            batch.append([header, f.readline(), f.readline(), f.readline()])
+            if len(batch) == batch_size:
+                yield batch
+                batch = list()
+        if batch:
+            yield batch
+
+
+def bait_reads(reference, forward_in, forward_out, reverse_in=None, reverse_out=None, k=27, threads=1,
+               batch_size=10000, kmer_folder=None):
+    """
+    Pulls out reads (or pairs of reads) that have at least one k-mer in common with a reference, the same way that
+    bbtools.bbduk_bait does, but without having to start up BBDuk and build its k-mer table for every sample. The
+    reference's k-mers get cached on disk the first time they're needed (see create_kmer_file).
+    :param reference: Reference you want to pull reads out for. Should be in fasta format.
+    :param forward_in: Forward (or unpaired) reads, in FASTQ format.
+    :param forward_out: Output forward reads. Will be gzipped.
+    :param reverse_in: Reverse reads, if reads are paired.
+    :param reverse_out: Output reverse reads, if reads are paired.
+    :param k: k-mer size.
+    :param threads: Number of processes to check reads with. Threads are used instead when this isn't called from
+    the main thread.
+    :param batch_size: Number of reads each process checks at a time.
+    :param kmer_folder: Folder to cache the reference's k-mers in if its own folder can't be written to. Defaults to
+    the folder forward_out is in.
+    :return: Number of reads and number of bases baited out, same as find_baited_read_stats.
+    """
+    if kmer_folder is None:
+        kmer_folder = os.path.split(os.path.abspath(forward_out))[0]
+    kmer_file = create_kmer_file(reference, k, kmer_folder=kmer_folder)
+    paired = reverse_in is not None
+    if paired:
+        batches = zip(read_fastq_batches(forward_in, batch_size), read_fastq_batches(reverse_in, batch_size))
+        outputs = [gzip.open(forward_out, 'wb', compresslevel=1), gzip.open(reverse_out, 'wb', compresslevel=1)]
+    else:
+        batches = ((batch,) for batch in read_fastq_batches(forward_in, batch_size))
+        outputs = [gzip.open(forward_out, 'wb', compresslevel=1)]
+    if threads <= 1:
+        pool = None
+    elif threading.current_thread() is threading.main_thread():
+        pool = multiprocessing.Pool(processes=threads)
+    else:
+        # Forking from any other thread can copy locks that other threads are holding into the children, where
+        # they'd never get released. NumPy lets go of the GIL for most of the work, so threads do nearly as well.
+        pool = ThreadPool(processes=threads)
+    check_batch = partial(find_baited_reads, kmer_file, k)
+    baited_reads = 0
+    baited_bases = 0
+    try:
+        while True:
+            # Only read in enough batches to keep every process busy, so memory use doesn't depend on file size.
+            batch_group = [batch for _, batch in zip(range(threads), batches)]
+            if not batch_group:
+                break
+            sequence_sets = [[[read[1].rstrip() for read in mate_batch] for mate_batch in batch]
+                             for batch in batch_group]
+            if pool is not None:
+                results = pool.map(check_batch, sequence_sets)
+            else:
+                results = [check_batch(sequence_set) for sequence_set in sequence_sets]
+            for batch, baited, sequence_set in zip(batch_group, results, sequence_sets):
+                for mate_batch, mate_sequences, output in zip(batch, sequence_set, outputs):
+                    for i in np.nonzero(baited)[0]:
+                        output.write(b''.join(mate_batch[i]))
+                        baited_reads += 1
+                        baited_bases += len(mate_sequences[i])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for output in outputs:
+            output.close()
+    return baited_reads, baited_bases
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+import numpy as np
+import logging
+import os
+
+# Two bit codes for each base. Alleles with anything else in them (lowercase, ambiguous bases) are stored as they are.
+PACK_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate(b'ACGT'):
+    PACK_CODES[base] = code
+# Bases for each of the four 2-bit codes packed into every possible byte, first base in the highest bits.
+UNPACK_TABLE = np.array([[b'ACGT'[(byte >> shift) & 3] for shift in (6, 4, 2, 0)] for byte in range(256)],
+                        dtype=np.uint8)
+# Fields for each allele in the index, which is sorted by id.
+INDEX_DTYPE = [('offset', np.uint64), ('length', np.uint32), ('packed', np.bool_)]
+# Width of sequence lines in FASTA files written out, same as Biopython uses.
+LINE_WIDTH = 60
+
+# Sequences and indexes that have already been memory mapped, keyed by FASTA file.
+loaded_packs = dict()
+
+
+def find_pack_files(fasta_file):
+    """
+    :param fasta_file: Path to FASTA file (i.e. rMLST_combined.fasta)
+    :return: Paths to the packed sequence file and index file for the FASTA file.
+    """
+    prefix = os.path.splitext(fasta_file)[0]
+    return prefix + '_packed.npy', prefix + '_packed_index.npy'
+
+
+def has_packed_alleles(fasta_file):
+    """
+    :param fasta_file: Path to FASTA file.
+    :return: True if packed alleles have been created for the FASTA file since it was last changed, False otherwise.
+    """
+    sequence_file, index_file = find_pack_files(fasta_file)
+    # The index is written last, so if it's there and up to date the sequences are too.
+    return os.path.isfile(index_file) and os.path.isfile(sequence_file) and \
+        os.path.getmtime(index_file) >= os.path.getmtime(fasta_file)
+
+
+def pack_sequence(sequence):
+    """
+    :param sequence: Sequence, as bytes.
+    :return: Sequence packed four bases to a byte as a numpy array, or None if it has anything other than ACGT in it.
+    """
+    codes = PACK_CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    if np.any(codes == 4):
+        return None
+    codes = np.concatenate([codes, np.zeros(-len(codes) % 4, dtype=np.uint8)]).reshape(-1, 4)
+    return (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+
+
+def start_packing():
+    """
+    :return: Dictionary that alleles get packed into by add_packed_allele, before being saved by save_packed_alleles.
+    """
+    return {'sequences': bytearray(), 'names': list(), 'entries': list()}
+
+
+def add_packed_allele(packing, name, sequence):
+    """
+    :param packing: Dictionary created by start_packing.
+    :param name: Name of the allele.
+    :param sequence: Sequence of the allele, as a string.
+    """
+    sequence = sequence.encode()
+    packed = pack_sequence(sequence)
+    packing['names'].append(name.encode())
+    packing['entries'].append((len(packing['sequences']), len(sequence), packed is not None))
+    packing['sequences'] += sequence if packed is None else packed.tobytes()
+
+
+def save_packed_alleles(packing, fasta_file):
+    """
+    Writes packed alleles, along with an index sorted by allele name, next to the FASTA file they came from. Needs to
+    be called once the FASTA file is in place, since packed alleles older than their FASTA file don't get used.
+    :param packing: Dictionary created by start_packing, with every allele in the FASTA file added to it.
+    :param fasta_file: Path to FASTA file the alleles came from.
+    :return: Paths to the packed sequence file and index file.
+    """
+    sequence_file, index_file = find_pack_files(fasta_file)
+    names = packing['names']
+    index = np.zeros(len(names), dtype=[('id', 'S{}'.format(max([len(name) for name in names] + [1])))] + INDEX_DTYPE)
+    index['id'] = names
+    entries = np.array(packing['entries'], dtype=INDEX_DTYPE)
+    for field, _ in INDEX_DTYPE:
+        index[field] = entries[field]
+    index = index[np.argsort(index['id'], kind='stable')]
+    # Write somewhere else first and then move into place, so that nothing else can ever load a half-written file.
+    for data, output_file in [(np.frombuffer(bytes(packing['sequences']), dtype=np.uint8), sequence_file),
+                              (index, index_file)]:
+        tmp_file = '{}.{}.tmp.npy'.format(output_file, os.getpid())
+        np.save(tmp_file, data)
+        os.replace(tmp_file, output_file)
+    return sequence_file, index_file
+
+
+def create_packed_alleles(fasta_file):
+    """
+    Stores every allele in a FASTA file packed four bases to a byte, along with an index sorted by allele name, so
+    that any set of alleles can be pulled out by slicing a memory mapped file instead of parsing or indexing the FASTA
+    file. Nothing is done if the packed alleles are already up to date.
+    :param fasta_file: Path to FASTA file (i.e. rMLST_combined.fasta)
+    :return: Paths to the packed sequence file and index file.
+    """
+    if has_packed_alleles(fasta_file):
+        return find_pack_files(fasta_file)
+    logging.info('Packing alleles in {}...'.format(os.path.split(fasta_file)[-1]))
+    packing = start_packing()
+    with open(fasta_file) as f:
+        for title, sequence in SimpleFastaParser(f):
+            add_packed_allele(packing, title.split(None, 1)[0], sequence)
+    return save_packed_alleles(packing, fasta_file)
+
+
+def load_packed_alleles(fasta_file):
+    """
+    Memory maps packed alleles, so that every process using them shares one copy in the page cache.
+    :param fasta_file: Path to FASTA file that packed alleles were created for.
+    :return: sequences, index: Packed sequences and the index for them, as read-only numpy arrays.
+    """
+    if fasta_file not in loaded_packs:
+        sequence_file, index_file = find_pack_files(fasta_file)
+        loaded_packs[fasta_file] = (np.load(sequence_file, mmap_mode='r'), np.load(index_file, mmap_mode='r'))
+    return loaded_packs[fasta_file]
+
+
+def write_packed_alleles(fasta_file, allele_list, output_file):
+    """
+    Writes a set of alleles out of packed alleles to a FASTA file.
+    :param fasta_file: Path to FASTA file that packed alleles were created for.
+    :param allele_list: List of allele names to write, in the order they should be written.
+    :param output_file: Path to FASTA file to write.
+    :return: List of alleles that couldn't be found.
+    """
+    sequences, index = load_packed_alleles(fasta_file)
+    wanted = np.array([allele.encode() for allele in allele_list], dtype=index['id'].dtype)
+    # Alleles with names too long to fit can't be in the index, and shouldn't match one that's been cut short.
+    fits = np.array([len(allele.encode()) <= index['id'].dtype.itemsize for allele in allele_list], dtype=bool)
+    positions = np.minimum(np.searchsorted(index['id'], wanted), max(len(index) - 1, 0))
+    found = fits & (index['id'][positions] == wanted) if len(index) > 0 else np.zeros(len(allele_list), dtype=bool)
+    with open(output_file, 'wb') as f:
+        for allele, entry in zip(wanted[found], index[positions[found]]):
+            offset, length = int(entry['offset']), int(entry['length'])
+            if entry['packed']:
+                sequence = UNPACK_TABLE[sequences[offset:offset + (length + 3) // 4]].ravel()[:length]
+            else:
+                sequence = sequences[offset:offset + length]
+            sequence = sequence.tobytes()
+            f.write(b'>' + allele + b'\n')
+            f.write(b''.join(sequence[i:i + LINE_WIDTH] + b'\n' for i in range(0, length, LINE_WIDTH)))
+    return [allele for allele, allele_found in zip(allele_list, found) if not allele_found]
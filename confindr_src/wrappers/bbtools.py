@@ -1,20 +1,15 @@
 import os
 import subprocess
-from subprocess import Popen, PIPE
+from confindr_src.wrappers import runner
 
 
-def run_subprocess(command):
+def run_subprocess(command, log=None):
     """
     command is the command to run, as a string.
-    runs a subprocess, returns stdout and stderr from the subprocess as strings.
+    runs a subprocess (without a shell), returns stdout and stderr from the subprocess as strings.
+    If log is given, stdout and stderr are streamed to it as they're produced.
     """
-    x = Popen(command, shell=True, stdout=PIPE, stderr=PIPE)
-    out, err = x.communicate()
-    out = out.decode('utf-8')
-    err = err.decode('utf-8')
-    if x.returncode != 0:
-        raise subprocess.CalledProcessError(x.returncode, cmd=command)
-    return out, err
+    return runner.run(command, log=log)
 
 
 def kwargs_to_string(kwargs):
@@ -29,13 +24,14 @@ def kwargs_to_string(kwargs):
     return outstr
 
 
-def bbmap(reference, forward_in, out_bam, reverse_in='NA', returncmd=False, **kwargs):
+def bbmap(reference, forward_in, out_bam, reverse_in='NA', returncmd=False, log=None, **kwargs):
     """
     Wrapper for bbmap. Assumes that bbmap executable is in your $PATH.
     :param reference: Reference fasta. Won't be written to disk by default. If you want it to be, add nodisk='t' as an arg.
     :param forward_in: Input reads. Should be in fastq format.
     :param out_bam: Output file. Should end in .sam or .bam
     :param returncmd: If set to true, function will return the cmd string passed to subprocess as a third value.
+    :param log: Logfile to stream stdout and stderr to. If None, output isn't logged.
     :param reverse_in: If your reverse reads are present and normal conventions (_R1 for forward, _R2 for reverse) are
      followed, the reverse reads will be followed automatically. If you want to specify reverse reads, you may do so.
     :param kwargs: Other arguments to give to bbmap in parameter=argument format. See bbmap documentation for full list.
@@ -49,19 +45,20 @@ def bbmap(reference, forward_in, out_bam, reverse_in='NA', returncmd=False, **kw
         cmd = 'bbmap.sh ref={} in={} out={} nodisk{}'.format(reference, forward_in, out_bam, options)
     else:
         cmd = 'bbmap.sh ref={} in={} in2={} out={} nodisk{}'.format(reference, forward_in, reverse_in, out_bam, options)
-    out, err = run_subprocess(cmd)
+    out, err = run_subprocess(cmd, log=log)
     if returncmd:
         return out, err, cmd
     else:
         return out, err
 
 
-def bbduk_trim(forward_in, forward_out, reverse_in='NA', reverse_out='NA', returncmd=False, **kwargs):
+def bbduk_trim(forward_in, forward_out, reverse_in='NA', reverse_out='NA', returncmd=False, log=None, **kwargs):
     """
     Wrapper for using bbduk to quality trim reads. Contains arguments used in OLC Assembly Pipeline, but these can
     be overwritten by using keyword parameters.
     :param forward_in: Forward reads you want to quality trim.
     :param returncmd: If set to true, function will return the cmd string passed to subprocess as a third value.
+    :param log: Logfile to stream stdout and stderr to. If None, output isn't logged.
     :param forward_out: Output forward reads.
     :param reverse_in: Reverse input reads. Don't need to be specified if _R1/_R2 naming convention is used.
     :param reverse_out: Reverse output reads. Don't need to be specified if _R1/_R2 convention is used.
@@ -105,19 +102,21 @@ def bbduk_trim(forward_in, forward_out, reverse_in='NA', reverse_out='NA', retur
                     f_out=forward_out,
                     r_out=reverse_out,
                     optn=options)
-    out, err = run_subprocess(cmd)
+    out, err = run_subprocess(cmd, log=log)
     if returncmd:
         return out, err, cmd
     else:
         return out, err
 
 
-def tadpole(forward_in, forward_out, reverse_in='NA', returncmd=False, reverse_out='NA', mode='correct', **kwargs):
+def tadpole(forward_in, forward_out, reverse_in='NA', returncmd=False, reverse_out='NA', mode='correct', log=None,
+            **kwargs):
     """
     Runs tadpole. Default is to run in correction mode, but other modes ('contig', 'extend') can also be specified.
     :param forward_in: Forward input reads.
     :param forward_out: Forward output reads.
     :param returncmd: If set to true, function will return the cmd string passed to subprocess as a third value.
+    :param log: Logfile to stream stdout and stderr to. If None, output isn't logged.
     :param reverse_in: Reverse reads. Only specify if not following _R1/_R2 convention/not in same folder as input.
     :param reverse_out: Reverse output reads. Automatically generated unless specified.
     :param mode: Mode to run tadpole in. Default is 'correct'.
@@ -144,7 +143,7 @@ def tadpole(forward_in, forward_out, reverse_in='NA', returncmd=False, reverse_o
                                                                            forward_out, reverse_out,
                                                                            mode, options)
     if not os.path.isfile(forward_out):
-        out, err = run_subprocess(cmd)
+        out, err = run_subprocess(cmd, log=log)
     else:
         out = str()
         err = str()
@@ -154,12 +153,13 @@ def tadpole(forward_in, forward_out, reverse_in='NA', returncmd=False, reverse_o
         return out, err
 
 
-def bbnorm(forward_in, forward_out, returncmd=False, reverse_in='NA', reverse_out='NA', **kwargs):
+def bbnorm(forward_in, forward_out, returncmd=False, reverse_in='NA', reverse_out='NA', log=None, **kwargs):
     """
     Runs bbnorm to normalize read depth. Default target kmer depth is left at bbnorm's default, which is 100.
     :param forward_in: Forward input reads.
     :param forward_out: Forward output reads.
     :param returncmd: If set to true, function will return the cmd string passed to subprocess as a third value.
+    :param log: Logfile to stream stdout and stderr to. If None, output isn't logged.
     :param reverse_in: Reverse reads. Only specify if not following _R1/_R2 convention/not in same folder as input.
     :param reverse_out: Reverse output reads. Automatically generated unless specified.
     :param kwargs: Other arguments to give to bbnorm in parameter='argument' format. See bbnorm documentation for full list.
@@ -185,7 +185,7 @@ def bbnorm(forward_in, forward_out, returncmd=False, reverse_in='NA', reverse_ou
                                                                   forward_out, reverse_out,
                                                                   options)
     if not os.path.isfile(forward_out):
-        out, err = run_subprocess(cmd)
+        out, err = run_subprocess(cmd, log=log)
     else:
         out = str()
         err = str()
@@ -195,12 +195,13 @@ def bbnorm(forward_in, forward_out, returncmd=False, reverse_in='NA', reverse_ou
         return out, err
 
 
-def bbmerge(forward_in, merged_reads, returncmd=False, reverse_in='NA', **kwargs):
+def bbmerge(forward_in, merged_reads, returncmd=False, reverse_in='NA', log=None, **kwargs):
     """
     Runs bbmerge.
     :param forward_in: Forward input reads. Reverse reads automatically detected if present in the same folder.
     :param merged_reads: Output file to write merged reads to.
     :param returncmd: If set to true, function will return the cmd string passed to subprocess as a third value.
+    :param log: Logfile to stream stdout and stderr to. If None, output isn't logged.
     :param reverse_in: Reverse input file, if you don't want it autodetected.
     :param kwargs: Other arguments to give to bbmerge in parameter='argument' format. See bbmerge documentation for full list.
     :return: out and err: stdout string and stderr string from running bbmerge.
@@ -214,7 +215,7 @@ def bbmerge(forward_in, merged_reads, returncmd=False, reverse_in='NA', **kwargs
     else:
         cmd = 'bbmerge.sh in={} in2={} out={} {}'.format(forward_in, reverse_in, merged_reads, options)
     if not os.path.isfile(merged_reads):
-        out, err = run_subprocess(cmd)
+        out, err = run_subprocess(cmd, log=log)
     else:
         out = str()
         err = str()
@@ -224,12 +225,14 @@ def bbmerge(forward_in, merged_reads, returncmd=False, reverse_in='NA', **kwargs
         return out, err
 
 
-def bbduk_bait(reference, forward_in, forward_out, returncmd=False, reverse_in='NA', reverse_out='NA', **kwargs):
+def bbduk_bait(reference, forward_in, forward_out, returncmd=False, reverse_in='NA', reverse_out='NA', log=None,
+               **kwargs):
     """
     Uses bbduk to bait out reads that have kmers matching to a reference.
     :param reference: Reference you want to pull reads out for. Should be in fasta format.
     :param forward_in: Forward reads you want to quality trim.
     :param returncmd: If set to true, function will return the cmd string passed to subprocess as a third value.
+    :param log: Logfile to stream stdout and stderr to. If None, output isn't logged.
     :param forward_out: Output forward reads.
     :param reverse_in: Reverse input reads. Don't need to be specified if _R1/_R2 naming convention is used.
     :param reverse_out: Reverse output reads. Don't need to be specified if _R1/_R2 convention is used.
@@ -255,19 +258,21 @@ def bbduk_bait(reference, forward_in, forward_out, returncmd=False, reverse_in='
         cmd = 'bbduk.sh in={} in2={} outm={} outm2={} ref={}{}'.format(forward_in, reverse_in,
                                                                        forward_out, reverse_out,
                                                                        reference, options)
-    out, err = run_subprocess(cmd)
+    out, err = run_subprocess(cmd, log=log)
     if returncmd:
         return out, err, cmd
     else:
         return out, err
 
 
-def bbduk_filter(reference, forward_in, forward_out, returncmd=False, reverse_in='NA', reverse_out='NA', **kwargs):
+def bbduk_filter(reference, forward_in, forward_out, returncmd=False, reverse_in='NA', reverse_out='NA', log=None,
+                 **kwargs):
     """
     Uses bbduk to filter out reads that have kmers matching to a reference.
     :param reference: Reference you want to pull reads out for. Should be in fasta format.
     :param forward_in: Forward reads you want to quality trim.
     :param returncmd: If set to true, function will return the cmd string passed to subprocess as a third value.
+    :param log: Logfile to stream stdout and stderr to. If None, output isn't logged.
     :param forward_out: Output forward reads.
     :param reverse_in: Reverse input reads. Don't need to be specified if _R1/_R2 naming convention is used.
     :param reverse_out: Reverse output reads. Don't need to be specified if _R1/_R2 convention is used.
@@ -293,36 +298,76 @@ def bbduk_filter(reference, forward_in, forward_out, returncmd=False, reverse_in
         cmd = 'bbduk.sh in={} in2={} out={} out2={} ref={}{}'.format(forward_in, reverse_in,
                                                                      forward_out, reverse_out,
                                                                      reference, options)
-    out, err = run_subprocess(cmd)
+    out, err = run_subprocess(cmd, log=log)
     if returncmd:
         return out, err, cmd
     else:
         return out, err
 
 
-def dedupe(input_file, output_file, returncmd=False, **kwargs):
+def dedupe(input_file, output_file, returncmd=False, log=None, **kwargs):
     """
     Runs dedupe from the bbtools package.
     :param input_file: Input file.
     :param returncmd: If set to true, function will return the cmd string passed to subprocess as a third value.
+    :param log: Logfile to stream stdout and stderr to. If None, output isn't logged.
     :param output_file: Output file.
     :param kwargs: Arguments to give to dedupe in parameter=argument format. See dedupe documentation for full list.
     :return: out and err: stdout string and stderr string from running dedupe.
     """
     options = kwargs_to_string(kwargs)
     cmd = 'dedupe.sh in={} out={}{}'.format(input_file, output_file, options)
-    out, err = run_subprocess(cmd)
+    out, err = run_subprocess(cmd, log=log)
     if returncmd:
         return out, err, cmd
     else:
         return out, err
 
 
-def seal(reference, forward_in, output_file, reverse_in='NA', returncmd=False, **kwargs):
+def clumpify(forward_in, forward_out, returncmd=False, reverse_in='NA', reverse_out='NA', log=None, **kwargs):
+    """
+    Runs clumpify from the bbtools package. Unlike dedupe, keeps pairs together when reads are in two files.
+    :param forward_in: Forward input reads.
+    :param forward_out: Forward output reads.
+    :param returncmd: If set to true, function will return the cmd string passed to subprocess as a third value.
+    :param log: Logfile to stream stdout and stderr to. If None, output isn't logged.
+    :param reverse_in: Reverse input reads. Don't need to be specified if _R1/_R2 naming convention is used.
+    :param reverse_out: Reverse output reads. Don't need to be specified if _R1/_R2 convention is used.
+    :param kwargs: Arguments to give to clumpify in parameter=argument format. See clumpify documentation for full list.
+    :return: out and err: stdout string and stderr string from running clumpify.
+    """
+    options = kwargs_to_string(kwargs)
+    if os.path.isfile(forward_in.replace('_R1', '_R2')) and reverse_in == 'NA' and '_R1' in forward_in:
+        reverse_in = forward_in.replace('_R1', '_R2')
+        if reverse_out == 'NA':
+            if '_R1' in forward_out:
+                reverse_out = forward_out.replace('_R1', '_R2')
+            else:
+                raise ValueError('If you do not specify reverse_out, forward_out must contain _R1.\n\n')
+        cmd = 'clumpify.sh in1={} in2={} out1={} out2={}{}'.format(forward_in, reverse_in,
+                                                                  forward_out, reverse_out,
+                                                                  options)
+    elif reverse_in == 'NA':
+        cmd = 'clumpify.sh in={} out={}{}'.format(forward_in, forward_out, options)
+    else:
+        if reverse_out == 'NA':
+            raise ValueError('Reverse output reads must be specified.')
+        cmd = 'clumpify.sh in1={} in2={} out1={} out2={}{}'.format(forward_in, reverse_in,
+                                                                  forward_out, reverse_out,
+                                                                  options)
+    out, err = run_subprocess(cmd, log=log)
+    if returncmd:
+        return out, err, cmd
+    else:
+        return out, err
+
+
+def seal(reference, forward_in, output_file, reverse_in='NA', returncmd=False, log=None, **kwargs):
     """
     Runs seal from the bbtools package.
     :param reference: Reference file, in fasta format.
     :param returncmd: If set to true, function will return the cmd string passed to subprocess as a third value.
+    :param log: Logfile to stream stdout and stderr to. If None, output isn't logged.
     :param forward_in: Forward reads, fastq format.
     :param output_file: Output file to put rpkm statistics into.
     :param reverse_in: Reverse reads. Not necessary to specify if in same folder and follow _R1/_R2 convention.
@@ -337,19 +382,20 @@ def seal(reference, forward_in, output_file, reverse_in='NA', returncmd=False, *
         cmd = 'seal.sh ref={} in={} rpkm={} nodisk{}'.format(reference, forward_in, output_file, options)
     else:
         cmd = 'seal.sh ref={} in={} in2={} rpkm={} nodisk{}'.format(reference, forward_in, reverse_in, output_file, options)
-    out, err = run_subprocess(cmd)
+    out, err = run_subprocess(cmd, log=log)
     if returncmd:
         return out, err, cmd
     else:
         return out, err
 
 
-def kmercountexact(forward_in, reverse_in='NA', returncmd=False, **kwargs):
+def kmercountexact(forward_in, reverse_in='NA', returncmd=False, log=None, **kwargs):
     """
     Wrapper for kmer count exact.
     :param forward_in: Forward input reads.
     :param reverse_in: Reverse input reads. Found automatically for certain conventions.
     :param returncmd: If set to true, function will return the cmd string passed to subprocess as a third value.
+    :param log: Logfile to stream stdout and stderr to. If None, output isn't logged.
     :param kwargs: Arguments to give to kmercountexact in parameter='argument' format.
     See kmercountexact documentation for full list.
     :return: out and err: stdout string and stderr string from running kmercountexact.
@@ -362,7 +408,7 @@ def kmercountexact(forward_in, reverse_in='NA', returncmd=False, **kwargs):
         cmd = 'kmercountexact.sh in={} {}'.format(forward_in, options)
     else:
         cmd = 'kmercountexact.sh in={} in2={} {}'.format(forward_in, reverse_in, options)
-    out, err = run_subprocess(cmd)
+    out, err = run_subprocess(cmd, log=log)
     if returncmd:
         return out, err, cmd
     else:
@@ -390,7 +436,7 @@ def genome_size(peaks_file, haploid=True):
 
 
 def subsample_reads(forward_in, forward_out, num_bases, returncmd=False, reverse_in='NA', reverse_out='NA',
-                    **kwargs):
+                    log=None, **kwargs):
     options = kwargs_to_string(kwargs)
     if os.path.isfile(forward_in.replace('_R1', '_R2')) and reverse_in == 'NA' and '_R1' in forward_in:
         reverse_in = forward_in.replace('_R1', '_R2')
@@ -412,7 +458,7 @@ def subsample_reads(forward_in, forward_out, num_bases, returncmd=False, reverse
                                                                                          forward_out, reverse_out,
                                                                                          str(num_bases), options)
     if not os.path.isfile(forward_out):
-        out, err = run_subprocess(cmd)
+        out, err = run_subprocess(cmd, log=log)
     else:
         out = str()
         err = str()
@@ -422,20 +468,20 @@ def subsample_reads(forward_in, forward_out, num_bases, returncmd=False, reverse
         return out, err
 
 
-def validate_reads(forward_in, returncmd=False, reverse_in='NA'):
+def validate_reads(forward_in, returncmd=False, reverse_in='NA', log=None):
     if os.path.isfile(forward_in.replace('_R1', '_R2')) and reverse_in == 'NA' and '_R1' in forward_in:
         reverse_in = forward_in.replace('_R1', '_R2')
         cmd = 'reformat.sh in1={} in2={} vpair'.format(forward_in, reverse_in)
     elif reverse_in == 'NA':
         cmd = 'reformat.sh in={}'.format(forward_in)
-    out, err = run_subprocess(cmd)
+    out, err = run_subprocess(cmd, log=log)
     if returncmd:
         return out, err, cmd
     else:
         return out, err
 
 
-def reformat_reads(forward_in, forward_out, returncmd=False, reverse_in='NA', reverse_out='NA'):
+def reformat_reads(forward_in, forward_out, returncmd=False, reverse_in='NA', reverse_out='NA', log=None):
     if os.path.isfile(forward_in.replace('_R1', '_R2')) and reverse_in == 'NA' and '_R1' in forward_in:
         reverse_in = forward_in.replace('_R1', '_R2')
         if reverse_out == 'NA':
@@ -453,7 +499,7 @@ def reformat_reads(forward_in, forward_out, returncmd=False, reverse_in='NA', re
         cmd = 'reformat.sh in1={} in2={} out1={} out2={} tossbrokenreads=t ow=t'\
             .format(forward_in, reverse_in, forward_out, reverse_out)
     if not os.path.isfile(forward_out):
-        out, err = run_subprocess(cmd)
+        out, err = run_subprocess(cmd, log=log)
     else:
         out = str()
         err = str()
@@ -463,7 +509,7 @@ def reformat_reads(forward_in, forward_out, returncmd=False, reverse_in='NA', re
         return out, err
 
 
-def repair_reads(forward_in, forward_out, returncmd=False, reverse_in='NA', reverse_out='NA'):
+def repair_reads(forward_in, forward_out, returncmd=False, reverse_in='NA', reverse_out='NA', log=None):
     if os.path.isfile(forward_in.replace('_R1', '_R2')) and reverse_in == 'NA' and '_R1' in forward_in:
         reverse_in = forward_in.replace('_R1', '_R2')
         if reverse_out == 'NA':
@@ -479,7 +525,7 @@ def repair_reads(forward_in, forward_out, returncmd=False, reverse_in='NA', reve
         cmd = 'repair.sh in1={} in2={} out1={} out2={} tossbrokenreads=t repair=t overwrite=t'\
             .format(forward_in, reverse_in, forward_out, reverse_out)
     if not os.path.isfile(forward_out):
-        out, err = run_subprocess(cmd)
+        out, err = run_subprocess(cmd, log=log)
     else:
         out = str()
         err = str()
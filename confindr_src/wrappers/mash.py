@@ -1,17 +1,16 @@
 #!/usr/bin/env python
-from subprocess import Popen, PIPE
+from confindr_src.wrappers import runner
+import shlex
+import glob
 
 
-def run_subprocess(command):
+def run_subprocess(command, log=None, stdout_file=None):
     """
     command is the command to run, as a string.
-    runs a subprocess, returns stdout and stderr from the subprocess as strings.
+    runs a subprocess (without a shell), returns stdout and stderr from the subprocess as strings.
+    If log is given, output is streamed to it. If stdout_file is given, stdout is written there instead.
     """
-    x = Popen(command, shell=True, stdout=PIPE, stderr=PIPE)
-    out, err = x.communicate()
-    out = out.decode('utf-8')
-    err = err.decode('utf-8')
-    return out, err
+    return runner.run(command, log=log, stdout_file=stdout_file)
 
 
 class MashResult:
@@ -32,6 +31,7 @@ class ScreenResult:
         self.median_multiplicity = x[2]
         self.pvalue = float(x[3])
         self.query_id = x[4]
+        self.query_comment = ' '.join(x[5:])
 
 
 def kwargs_to_string(kwargs):
@@ -46,7 +46,21 @@ def kwargs_to_string(kwargs):
     return outstr
 
 
-def sketch(*args, output_sketch='sketch.msh', threads=1, returncmd=False, **kwargs):
+def expand_file_patterns(args):
+    """
+    Commands don't go through a shell, so file patterns have to be expanded here. A pattern that matches nothing is
+    passed on as it is, so mash reports the missing file.
+    :param args: Files (or file patterns, i.e. *fasta).
+    :return: String with every file, quoted and separated by spaces, with a space at the end.
+    """
+    files = ''
+    for arg in args:
+        for matching_file in sorted(glob.glob(arg)) or [arg]:
+            files += shlex.quote(matching_file) + ' '
+    return files
+
+
+def sketch(*args, output_sketch='sketch.msh', threads=1, returncmd=False, log=None, **kwargs):
     """
     Wrapper for mash sketch.
     :param args: Files you want to sketch. Any number can be passed in, file patterns (i.e. *fasta) can be used.
@@ -54,53 +68,52 @@ def sketch(*args, output_sketch='sketch.msh', threads=1, returncmd=False, **kwar
     :param threads: Number of threads to run analysis on.
     :param kwargs: Other arguments, in parameter='argument' format. If parameter is just a switch, do parameter=''
     :param returncmd: If true, will return the command used to call mash as well as out and err.
+    :param log: Logfile to stream stderr to. If None, output isn't logged.
     :return: stdout and stderr from mash sketch
     """
     options = kwargs_to_string(kwargs)
     if len(args) == 0:
         raise ValueError('At least one file to sketch must be specified. You specified 0 files.')
-    cmd = 'mash sketch '
-    for arg in args:
-        cmd += arg + ' '
+    cmd = 'mash sketch ' + expand_file_patterns(args)
     cmd += '-o {} -p {} {}'.format(output_sketch, str(threads), options)
-    out, err = run_subprocess(cmd)
+    out, err = run_subprocess(cmd, log=log)
     if returncmd:
         return out, err, cmd
     else:
         return out, err
 
 
-def dist(*args, output_file='distances.tab', threads=1, returncmd=False, **kwargs):
+def dist(*args, output_file='distances.tab', threads=1, returncmd=False, log=None, **kwargs):
     """
     Wrapper for mash dist.
-    :param args: Files you want to find distances between. Can be
+    :param args: Files you want to find distances between. File patterns (i.e. *fasta) can be used.
     :param output_file: Output file to write your distances to. Default distances.tab
     :param threads: Number of threads to run mash on.
     :param kwargs: Other arguments, in parameter='argument' format. If parameter is just a switch, do parameter=''
     :param returncmd: If true, will return the command used to call mash as well as out and err.
+    :param log: Logfile to stream stderr to. If None, output isn't logged.
     :return: stdout and stderr from mash dist
     """
     options = kwargs_to_string(kwargs)
     if len(args) == 0:
         raise ValueError('At least one file to sketch must be specified. You specified 0 files.')
-    cmd = 'mash dist '
-    for arg in args:
-        cmd += arg + ' '
-    cmd += ' -p {} {} > {}'.format(str(threads), options, output_file)
-    out, err = run_subprocess(cmd)
+    cmd = 'mash dist ' + expand_file_patterns(args)
+    cmd += ' -p {} {}'.format(str(threads), options)
+    out, err = run_subprocess(cmd, log=log, stdout_file=output_file)
     if returncmd:
         return out, err, cmd
     else:
         return out, err
 
 
-def screen(*args, output_file='screen.tab', threads=1, returncmd=False, **kwargs):
+def screen(*args, output_file='screen.tab', threads=1, returncmd=False, log=None, **kwargs):
     """
     Wrapper for mash screen. Requires mash v2.0 or higher.
     :param args: Files you want to screen. First argument must be a sketch.
     :param output_file: Output to write containment info to.
     :param threads: Number of threads to run mash on.
     :param returncmd: If set to true, function will return the cmd string passed to subprocess as a third value.
+    :param log: Logfile to stream stderr to. If None, output isn't logged.
     :param kwargs: Other arguments, in parameter='argument' format. If parameter is just a switch, do parameter=''
     :return: stdout and stderr from mash screen
     """
@@ -108,14 +121,28 @@ def screen(*args, output_file='screen.tab', threads=1, returncmd=False, **kwargs
     cmd = 'mash screen '
     for arg in args:
         cmd += arg + ' '
-    cmd += ' -p {} {} | sort -gr > {}'.format(str(threads), options, output_file)
-    out, err = run_subprocess(cmd)
+    cmd += ' -p {} {}'.format(str(threads), options)
+    out, err = run_subprocess(cmd, log=log, stdout_file=output_file)
+    sort_screen_output(output_file)
     if returncmd:
         return out, err, cmd
     else:
         return out, err
 
 
+def sort_screen_output(output_file):
+    """
+    Sorts mash screen output so the best hits (highest identity) come first. Done here instead of by piping through
+    sort, since commands aren't run through a shell.
+    :param output_file: Output file from mash screen. Gets overwritten with the sorted version.
+    """
+    with open(output_file) as f:
+        lines = [line for line in f if line.strip()]
+    lines.sort(key=lambda line: float(line.split()[0]), reverse=True)
+    with open(output_file, 'w') as f:
+        f.writelines(lines)
+
+
 def read_mash_output(result_file):
     """
     :param result_file: Tab-delimited result file generated by mash dist.
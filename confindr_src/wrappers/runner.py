@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+import collections
+import threading
+import subprocess
+import asyncio
+import logging
+import signal
+import shlex
+import sys
+import os
+
+# Watchdog settings used for every command. Set once through configure, from command line options.
+watchdog = {'timeout': None,
+            'retries': 0,
+            'retry_delay': 5}
+# Event loop that every command runs on, in a thread of its own, so that commands started from different threads (i.e.
+# samples being analysed at the same time) run side by side on one loop. Started the first time a command is run, and
+# again in any process forked after that, since the thread running it doesn't come along.
+shared_loop = {'loop': None,
+               'pid': None}
+shared_loop_lock = threading.Lock()
+
+
+def configure(timeout=None, retries=0, retry_delay=5):
+    """
+    Sets up the timeout and retries that every command gets.
+    :param timeout: Number of seconds a command is allowed to run for per GB of input (with a minimum of one GB). If
+    None, commands can run forever.
+    :param retries: Number of times to try a command again if it times out or gets killed by a signal.
+    :param retry_delay: Seconds to wait before the first retry. Doubles with each retry after that.
+    """
+    watchdog['timeout'] = timeout
+    watchdog['retries'] = retries
+    watchdog['retry_delay'] = retry_delay
+
+
+def split_command(cmd):
+    """
+    Commands are run without a shell, so they need to be split up into a list of arguments.
+    :param cmd: Command, either as a string as it would be typed on the command line, or already split into a list.
+    :return: List of arguments.
+    """
+    if isinstance(cmd, str):
+        return shlex.split(cmd)
+    return [str(arg) for arg in cmd]
+
+
+def find_input_size(args):
+    """
+    Adds up the size of every file a command refers to, either as an argument or as the value of an argument in
+    parameter=value format (the way BBTools takes files).
+    :param args: List of arguments.
+    :return: Total size in bytes.
+    """
+    total_size = 0
+    for arg in args:
+        for path in (arg, arg.split('=', 1)[-1]):
+            if os.path.isfile(path):
+                total_size += os.path.getsize(path)
+                break
+    return total_size
+
+
+def find_timeout(args):
+    """
+    :param args: List of arguments for a command.
+    :return: Number of seconds the command is allowed to run for, scaled by the size of its input, or None if
+    there is no timeout.
+    """
+    if watchdog['timeout'] is None:
+        return None
+    size_in_gb = find_input_size(args) / 1e9
+    return watchdog['timeout'] * max(1, size_in_gb)
+
+
+if sys.version_info < (3, 8):
+    class ThreadedChildWatcher(asyncio.AbstractChildWatcher):
+        """
+        Waits for each child process in a thread of its own, the same way the default child watcher does from
+        Python 3.8. The default before that (SafeChildWatcher) only works with the event loop of the main thread, so
+        commands couldn't be run on the shared event loop, which runs in a thread of its own.
+        """
+
+        def add_child_handler(self, pid, callback, *args):
+            thread = threading.Thread(target=self.wait_for_child, args=(pid, callback, args), daemon=True)
+            thread.start()
+
+        @staticmethod
+        def wait_for_child(pid, callback, args):
+            try:
+                _, status = os.waitpid(pid, 0)
+            except ChildProcessError:
+                # Already waited for somewhere else, so the exit code is gone.
+                returncode = 255
+            else:
+                returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            callback(pid, returncode, *args)
+
+        def remove_child_handler(self, pid):
+            return False
+
+        def attach_loop(self, loop):
+            pass
+
+        def close(self):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            pass
+
+    asyncio.get_event_loop_policy().set_child_watcher(ThreadedChildWatcher())
+
+
+async def stream_output(stream, label, tail, logfile, chunk_size=65536):
+    """
+    Reads output from a program as it is produced. Every line gets written to the logfile (if there is one), but only
+    the last few lines are held on to.
+    :param stream: asyncio StreamReader for a program's stdout or stderr.
+    :param label: Label that each line gets in the logfile (i.e. STDOUT [1234])
+    :param tail: collections.deque with a maxlen, that lines get added to.
+    :param logfile: Open file handle to write lines to, or None.
+    :param chunk_size: Number of bytes to read at once.
+    """
+    partial_line = b''
+    while True:
+        chunk = await stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (partial_line + chunk).split(b'\n')
+        partial_line = lines.pop()
+        for line in lines:
+            text = line.decode('utf-8', errors='replace') + '\n'
+            tail.append(text)
+            if logfile is not None:
+                logfile.write('{}: {}'.format(label, text))
+    if partial_line:
+        text = partial_line.decode('utf-8', errors='replace')
+        tail.append(text)
+        if logfile is not None:
+            logfile.write('{}: {}\n'.format(label, text))
+
+
+async def kill_process(process):
+    """
+    Kills a process along with anything it started (the BBTools scripts start up java, for example).
+    :param process: asyncio Process, started in its own session.
+    """
+    if process.returncode is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+
+async def wait_for_exit(process, readers):
+    """
+    :param process: asyncio Process.
+    :param readers: stream_output coroutines reading the process's output.
+    :return: Exit code of the process, once it has finished and all of its output has been read.
+    """
+    await asyncio.gather(*readers)
+    return await process.wait()
+
+
+async def run_attempt(args, cmd_string, log=None, stdout_file=None, tail_lines=1000, timeout=None):
+    """
+    Runs a command once. See run_async.
+    :param args: List of arguments.
+    :param cmd_string: Command as a string, for logging.
+    :param timeout: Number of seconds to let the command run for before killing it, or None for no limit.
+    """
+    stdout_handle = open(stdout_file, 'wb') if stdout_file is not None else None
+    logfile = open(log, 'a', buffering=1) if log is not None else None
+    out_tail = collections.deque(maxlen=tail_lines)
+    err_tail = collections.deque(maxlen=tail_lines)
+    try:
+        try:
+            process = await asyncio.create_subprocess_exec(*args,
+                                                           stdout=stdout_handle if stdout_handle is not None
+                                                           else asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.PIPE,
+                                                           start_new_session=True)
+        except FileNotFoundError:
+            # Same exit code a shell would give for a program that doesn't exist.
+            raise subprocess.CalledProcessError(127, cmd=cmd_string)
+        except PermissionError:
+            raise subprocess.CalledProcessError(126, cmd=cmd_string)
+        if logfile is not None:
+            logfile.write('Command used [{}]: {}\n\n'.format(process.pid, cmd_string))
+        readers = [stream_output(process.stderr, 'STDERR [{}]'.format(process.pid), err_tail, logfile)]
+        if stdout_handle is None:
+            readers.append(stream_output(process.stdout, 'STDOUT [{}]'.format(process.pid), out_tail, logfile))
+        try:
+            returncode = await asyncio.wait_for(wait_for_exit(process, readers), timeout)
+        except asyncio.TimeoutError:
+            await kill_process(process)
+            if logfile is not None:
+                logfile.write('Command [{}] killed after running for {:.0f} seconds\n\n'.format(process.pid, timeout))
+            raise subprocess.TimeoutExpired(cmd_string, timeout)
+        except asyncio.CancelledError:
+            # Don't leave programs running if whatever was waiting on them has gone away.
+            await kill_process(process)
+            raise
+        if logfile is not None:
+            logfile.write('\n')
+    finally:
+        if stdout_handle is not None:
+            stdout_handle.close()
+        if logfile is not None:
+            logfile.close()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd=cmd_string)
+    return ''.join(out_tail), ''.join(err_tail)
+
+
+async def run_async(cmd, log=None, stdout_file=None, tail_lines=1000):
+    """
+    Runs a command without a shell. stdout and stderr are streamed into the log as they're produced instead of being
+    held in memory until the program finishes, so chatty programs don't use up memory, and the loop is free to run
+    other commands while this one is going (see run). Commands that go over the timeout set by configure get
+    killed, and commands that time out or are killed by a signal are tried again up to the number of retries set by
+    configure. Commands that exit with an error aren't retried.
+    :param cmd: Command to run, as a string or a list of arguments. Shell features (pipes, redirection) aren't
+    available - use stdout_file to send stdout to a file.
+    :param log: Path to logfile to stream output to. If None, output isn't logged.
+    :param stdout_file: Path to a file to write stdout to. If None, stdout is streamed like stderr.
+    :param tail_lines: Number of lines from the end of stdout and stderr to keep and return.
+    :return: out, err: The last tail_lines lines of stdout and stderr, as strings.
+    If the exit code is non-zero (or the program can't be found), raises subprocess.CalledProcessError. If the
+    command runs out of time, raises subprocess.TimeoutExpired
+    """
+    args = split_command(cmd)
+    cmd_string = cmd if isinstance(cmd, str) else ' '.join(shlex.quote(arg) for arg in args)
+    timeout = find_timeout(args)
+    attempt = 0
+    while True:
+        try:
+            return await run_attempt(args, cmd_string, log=log, stdout_file=stdout_file, tail_lines=tail_lines,
+                                     timeout=timeout)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            # Only hung or killed programs are worth trying again - anything that exits with an error (bad input, a
+            # program running out of memory) is going to do the same thing the next time.
+            killed = isinstance(e, subprocess.CalledProcessError) and e.returncode < 0
+            if attempt >= watchdog['retries'] or not (killed or isinstance(e, subprocess.TimeoutExpired)):
+                raise
+            delay = watchdog['retry_delay'] * 2 ** attempt
+            attempt += 1
+            logging.warning('Command {} failed ({}), trying again in {} seconds (retry {} of {})'
+                            .format(cmd_string, e, delay, attempt, watchdog['retries']))
+            await asyncio.sleep(delay)
+
+
+def find_event_loop():
+    """
+    :return: The shared event loop, started in a thread of its own if it isn't running in this process yet.
+    """
+    with shared_loop_lock:
+        if shared_loop['loop'] is None or shared_loop['pid'] != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            shared_loop['loop'] = loop
+            shared_loop['pid'] = os.getpid()
+        return shared_loop['loop']
+
+
+def run(cmd, log=None, stdout_file=None, tail_lines=1000):
+    """
+    Runs a command on the shared event loop and waits for it to finish. See run_async for details. Can be called from
+    any thread - commands from different threads all run at once on the same loop.
+    :return: out, err: The last tail_lines lines of stdout and stderr, as strings.
+    """
+    future = asyncio.run_coroutine_threadsafe(run_async(cmd, log=log, stdout_file=stdout_file, tail_lines=tail_lines),
+                                              find_event_loop())
+    try:
+        return future.result()
+    except KeyboardInterrupt:
+        # Cancelling kills the program, rather than leaving it running once ConFindr has stopped.
+        future.cancel()
+        raise
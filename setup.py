@@ -11,7 +11,8 @@ setup(
             'confindr.py = confindr_src.confindr:main',
             'confindr = confindr_src.confindr:main',
             'confindr_database_setup = confindr_src.database_setup:main',
-            'confindr_create_db = confindr_src.create_genus_specific_db:main'
+            'confindr_create_db = confindr_src.create_genus_specific_db:main',
+            'confindr_cluster_db = confindr_src.cluster_database:main'
        ],
     },
     author="Adam Koziol",
@@ -1,8 +1,24 @@
 from confindr_src.confindr import *
+from confindr_src import database_setup
+from confindr_src import kmer_bait
+from confindr_src import database_cache
+from confindr_src import packed_alleles
+from confindr_src import kma_shm
+from confindr_src import cluster_database
+from multiprocessing.pool import ThreadPool
 from Bio import SeqIO
+import http.server
+import socketserver
 import subprocess
+import tarfile
+import threading
+import hashlib
+import json
 import pytest
 import shutil
+import gzip
+import glob
+import time
 import csv
 import os
 
@@ -70,6 +86,86 @@ def test_unpaired_fastq():
     assert ['tests/fake_fastqs/test_alone.fastq.gz'] == find_unpaired_reads('tests/fake_fastqs')[2]
 
 
+def test_alignment_files():
+    assert find_alignment_files('tests') == [['tests/contamination.bam']]
+
+
+def test_extract_reads_from_alignment(tmpdir):
+    pair = extract_reads_from_alignment(alignment='tests/contamination.bam',
+                                        sample_tmp_dir=str(tmpdir),
+                                        sample_name='contamination')
+    assert pair == [os.path.join(str(tmpdir), 'contamination_R1.fastq.gz'),
+                    os.path.join(str(tmpdir), 'contamination_R2.fastq.gz')]
+    with gzip.open(pair[0], 'rt') as forward, gzip.open(pair[1], 'rt') as reverse:
+        forward_names = [record.id for record in SeqIO.parse(forward, 'fastq')]
+        reverse_names = [record.id for record in SeqIO.parse(reverse, 'fastq')]
+    assert forward_names == reverse_names
+    assert len(forward_names) == 4017
+
+
+def test_extract_reads_from_alignment_regions(tmpdir):
+    regions_file = os.path.join(str(tmpdir), 'regions.bed')
+    with open(regions_file, 'w') as f:
+        f.write('BACT000001_30\t0\t100\n')
+    pair = extract_reads_from_alignment(alignment='tests/contamination.bam',
+                                        sample_tmp_dir=str(tmpdir),
+                                        sample_name='contamination',
+                                        regions=read_regions(regions_file))
+    with gzip.open(pair[0], 'rt') as forward:
+        assert len(list(SeqIO.parse(forward, 'fastq'))) == 40
+
+
+def test_extract_reads_finds_mates_outside_regions(tmpdir, caplog):
+    bam_file = os.path.join(str(tmpdir), 'sample.bam')
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': 'contig', 'LN': 100000}]}
+    # Name, flag, position, mate position: two pairs with mates far away, a read whose mate is missing, and a read
+    # that isn't paired.
+    reads = [('pair_a', 0x1 | 0x40, 100, 50000), ('orphan', 0x1 | 0x40, 120, 80000), ('single', 0x0, 130, -1),
+             ('pair_b', 0x1 | 0x40, 150, 50100), ('pair_a', 0x1 | 0x80, 50000, 100), ('pair_b', 0x1 | 0x80, 50100, 150)]
+    with pysam.AlignmentFile(bam_file, 'wb', header=header) as bam:
+        for name, flag, position, mate_position in reads:
+            read = pysam.AlignedSegment()
+            read.query_name = name
+            read.flag = flag
+            read.reference_id = 0
+            read.reference_start = position
+            read.next_reference_id = 0 if mate_position >= 0 else -1
+            read.next_reference_start = mate_position
+            read.query_sequence = 'ACGT' * 10
+            read.query_qualities = pysam.qualitystring_to_array('I' * 40)
+            read.cigarstring = '40M'
+            bam.write(read)
+    pysam.index(bam_file)
+    pair = extract_reads_from_alignment(alignment=bam_file,
+                                        sample_tmp_dir=str(tmpdir),
+                                        sample_name='sample',
+                                        forward_id='_1',
+                                        reverse_id='_2',
+                                        regions=[('contig', 0, 200), ('contig', 100, 200)])
+    assert pair == [os.path.join(str(tmpdir), 'sample_1.fastq.gz'), os.path.join(str(tmpdir), 'sample_2.fastq.gz')]
+    assert not os.path.isfile(os.path.join(str(tmpdir), 'sample.fastq.gz'))
+    for read_file in pair:
+        with gzip.open(read_file, 'rt') as f:
+            assert [record.id for record in SeqIO.parse(f, 'fastq')] == ['pair_a', 'pair_b']
+    assert 'Left 1 reads whose mate could not be found and 1 unpaired reads out' in caplog.text
+
+    class FetchCounter(object):
+        def __init__(self, bam):
+            self.bam = bam
+            self.fetches = list()
+
+        def fetch(self, contig, start, end):
+            self.fetches.append((contig, start, end))
+            return self.bam.fetch(contig, start, end)
+
+    with pysam.AlignmentFile(bam_file) as bam:
+        counter = FetchCounter(bam)
+        mates = list(find_mates(counter, {'pair_a': (True, 'contig', 50000), 'pair_b': (True, 'contig', 50100),
+                                          'orphan': (True, 'contig', 80000)}))
+    assert sorted(mate.query_name for mate in mates) == ['pair_a', 'pair_b']
+    assert counter.fetches == [('contig', 50000, 50101), ('contig', 80000, 80001)]
+
+
 def test_correct_num_multipositions():
     contig_names = list()
     for contig in SeqIO.parse('tests/rmlst.fasta', 'fasta'):
@@ -103,6 +199,133 @@ def test_run_cmd_failure_exit_code():
         run_cmd('garbagecommandthatdoesnotwork')
 
 
+def test_run_cmd_streams_to_log(tmpdir):
+    log = os.path.join(str(tmpdir), 'log.txt')
+    run_cmd(['python', '-c', 'import sys; print("out line"); sys.stderr.write("err line")'], log=log)
+    with open(log) as f:
+        log_text = f.read()
+    assert 'Command used' in log_text
+    assert 'out line\n' in log_text
+    assert 'err line\n' in log_text
+
+
+def test_run_cmd_stdout_file(tmpdir):
+    out_file = os.path.join(str(tmpdir), 'out.txt')
+    out, err = run_cmd('echo asdf', stdout_file=out_file)
+    assert out == ''
+    with open(out_file) as f:
+        assert f.read() == 'asdf\n'
+
+
+def test_run_cmd_from_threads():
+    p = ThreadPool(processes=4)
+    results = p.map(lambda word: run_cmd(['echo', word]), ['one', 'two', 'three', 'four'])
+    p.close()
+    p.join()
+    assert results == [('one\n', ''), ('two\n', ''), ('three\n', ''), ('four\n', '')]
+
+
+def test_mash_dist_expands_patterns(tmpdir, monkeypatch):
+    monkeypatch.setattr(runner, 'run', lambda cmd, log=None, stdout_file=None: ('', ''))
+    for name in ('b.msh', 'a.msh'):
+        open(os.path.join(str(tmpdir), name), 'w').close()
+    out, err, cmd = mash.dist(os.path.join(str(tmpdir), '*.msh'), 'query.fasta', returncmd=True,
+                              output_file=os.path.join(str(tmpdir), 'distances.tab'))
+    assert runner.split_command(cmd)[:5] == ['mash', 'dist', os.path.join(str(tmpdir), 'a.msh'),
+                                             os.path.join(str(tmpdir), 'b.msh'), 'query.fasta']
+
+
+def test_run_cmd_shares_event_loop():
+    p = ThreadPool(processes=2)
+    loops = p.map(lambda _: runner.find_event_loop(), range(2))
+    p.close()
+    p.join()
+    assert loops[0] is loops[1] is runner.find_event_loop()
+    # Commands from different threads run at the same time.
+    p = ThreadPool(processes=3)
+    start = time.time()
+    p.map(lambda _: run_cmd(['sleep', '1']), range(3))
+    p.close()
+    p.join()
+    assert time.time() - start < 2.5
+
+
+def test_sort_screen_output(tmpdir):
+    screen_file = os.path.join(str(tmpdir), 'screen.tab')
+    with open(screen_file, 'w') as f:
+        f.write('0.85\t10/1000\t1\t0\tb.fna\n0.99\t900/1000\t30\t0\ta.fna\n0.9\t50/1000\t2\t0\tc.fna\n')
+    mash.sort_screen_output(screen_file)
+    assert [result.query_id for result in mash.read_mash_screen(screen_file)] == ['a.fna', 'c.fna', 'b.fna']
+
+
+def test_run_cmd_timeout():
+    runner.configure(timeout=0.5)
+    try:
+        with pytest.raises(subprocess.TimeoutExpired):
+            run_cmd('sleep 10')
+    finally:
+        runner.configure()
+
+
+def test_run_cmd_retries(tmpdir):
+    marker = os.path.join(str(tmpdir), 'marker')
+    # Gets killed the first time it's run, and works the second time.
+    cmd = ['python', '-c', 'import os, signal; exists = os.path.isfile("{0}"); open("{0}", "w").close(); '
+                           'exists or os.kill(os.getpid(), signal.SIGKILL)'.format(marker)]
+    runner.configure(retries=1, retry_delay=0)
+    try:
+        run_cmd(cmd)
+    finally:
+        runner.configure()
+    os.remove(marker)
+    with pytest.raises(subprocess.CalledProcessError):
+        run_cmd(cmd)
+
+
+def test_run_cmd_does_not_retry_errors(tmpdir):
+    marker = os.path.join(str(tmpdir), 'marker')
+    # Would work the second time, but exiting with an error isn't something to retry.
+    cmd = ['python', '-c', 'import os, sys; exists = os.path.isfile("{0}"); open("{0}", "w").close(); '
+                           'sys.exit(0 if exists else 1)'.format(marker)]
+    runner.configure(retries=1, retry_delay=0)
+    try:
+        with pytest.raises(subprocess.CalledProcessError):
+            run_cmd(cmd)
+    finally:
+        runner.configure()
+
+
+def test_failed_samples_reported(tmpdir):
+    output_folder = str(tmpdir)
+    os.makedirs(os.path.join(output_folder, 'sample'))
+    try:
+        raise subprocess.TimeoutExpired('kma', 60)
+    except subprocess.TimeoutExpired as e:
+        result = find_error_result('sample', e)
+    report_sample(output_folder=output_folder,
+                  sample_name='sample',
+                  genus=ERROR_GENUS,
+                  result=result,
+                  database_download_date='2020-01-01')
+    with open(os.path.join(output_folder, 'confindr_report.csv')) as f:
+        row = next(csv.DictReader(f))
+    assert row['Genus'] == ERROR_GENUS
+    assert row['ContamStatus'] == 'Timed out'
+    assert row['DatabaseDownloadDate'] == 'ND'
+    assert not os.path.isdir(os.path.join(output_folder, 'sample'))
+
+
+def test_timeout_scales_with_input_size():
+    runner.configure(timeout=60)
+    try:
+        assert runner.find_input_size(['kma', 'in=tests/example_contamination.csv']) == \
+            os.path.getsize('tests/example_contamination.csv')
+        assert runner.find_timeout(['kma', 'in=tests/example_contamination.csv']) == 60
+    finally:
+        runner.configure()
+    assert runner.find_timeout(['kma']) is None
+
+
 # test base_count_cutoff
 
 def test_two_hq_bases_above_threshold():
@@ -206,6 +429,1005 @@ def test_write_output_appends_if_file_does_exist():
     assert len(lines) > 2
 
 
+def test_write_output_includes_duplicates_removed():
+    write_output(output_report='tests/dedupe_report.csv',
+                 sample_name='Test',
+                 multi_positions=0,
+                 genus='Fakella',
+                 percent_contam=0,
+                 contam_stddev=0,
+                 total_gene_length=888,
+                 database_download_date='ND',
+                 duplicates_removed=42)
+    with open('tests/dedupe_report.csv') as csvfile:
+        rows = list(csv.DictReader(csvfile))
+    os.remove('tests/dedupe_report.csv')
+    assert rows[0]['DuplicatesRemoved'] == '42'
+
+
+def test_number_duplicates_removed():
+    err = 'Reads In:               1000\nClumps Formed:           900\nDuplicates Found:        120\n' \
+          'Reads Out:               880\n'
+    assert find_number_duplicates_removed(err) == 120
+
+
+def test_number_duplicates_removed_not_found():
+    assert find_number_duplicates_removed('Exception in thread "main"\n') == 'ND'
+
+
+def test_write_output_status_overrides_contam_call():
+    write_output(output_report='tests/status_report.csv',
+                 sample_name='Test',
+                 multi_positions='ND',
+                 genus='Fakella',
+                 percent_contam='ND',
+                 contam_stddev='ND',
+                 total_gene_length=0,
+                 database_download_date='ND',
+                 status='Low core gene coverage')
+    with open('tests/status_report.csv') as csvfile:
+        rows = list(csv.DictReader(csvfile))
+    os.remove('tests/status_report.csv')
+    assert rows[0]['ContamStatus'] == 'Low core gene coverage'
+
+
+def test_baited_read_stats():
+    err = 'Input:                  \t2000 reads \t\t300000 bases.\n' \
+          'Contaminants:           \t150 reads (7.50%) \t22500 bases (7.50%)\n' \
+          'Total Removed:          \t150 reads (7.50%) \t22500 bases (7.50%)\n'
+    assert find_baited_read_stats(err) == (150, 22500)
+
+
+def test_baited_read_stats_not_found():
+    assert find_baited_read_stats('') == (None, None)
+
+
+def test_database_gene_length():
+    # Only one allele per gene in the test database, so should be the same as the total sequence length.
+    assert find_database_gene_length('tests/rmlst.fasta') == 20862
+
+
+def test_write_core_gene_reference(tmpdir):
+    database = os.path.join(str(tmpdir), 'database.fasta')
+    shutil.copy('tests/rmlst.fasta', database)
+    contigs = list(SeqIO.parse(database, 'fasta'))
+    gene_alleles = sorted(contig.id for contig in contigs[::3])
+    reference = os.path.join(str(tmpdir), 'rmlst.fasta')
+    total_length = write_core_gene_reference(database, gene_alleles, reference)
+    # Same as writing out the alleles by going through the whole database.
+    with open(reference) as f:
+        assert f.read() == ''.join('>{}\n{}\n'.format(contig.id, contig.seq) for contig in contigs
+                                   if contig.id in gene_alleles)
+    assert total_length == find_total_sequence_length(reference)
+
+
+def test_reference_key():
+    assert find_reference_key('tests/rmlst.fasta', ['BACT000002_1', 'BACT000001_1']) == \
+        find_reference_key('tests/rmlst.fasta', ['BACT000001_1', 'BACT000002_1'])
+    assert find_reference_key('tests/rmlst.fasta', ['BACT000001_1', 'BACT000002_1']) != \
+        find_reference_key('tests/rmlst.fasta', ['BACT000001_1', 'BACT000002_2'])
+
+
+def test_bbmap_cmd_with_index():
+    cmd = build_bbmap_cmd(reference='ref.fasta', forward_in='reads.fastq.gz', outbam='out.bam', index='ref_bbmap')
+    assert 'path=ref_bbmap' in cmd
+    assert 'ref=' not in cmd and 'nodisk' not in cmd
+    assert 'nodisk' in build_bbmap_cmd(reference='ref.fasta', forward_in='reads.fastq.gz', outbam='out.bam')
+
+
+def test_kma_shm_holders(tmpdir):
+    registry_folder = os.path.join(str(tmpdir), 'abcd')
+    os.makedirs(registry_folder)
+    finished = subprocess.Popen(['true'])
+    finished.wait()
+    for pid in (os.getpid(), finished.pid):
+        open(os.path.join(registry_folder, str(pid)), 'w').close()
+    assert kma_shm.find_holders(registry_folder) == [os.getpid()]
+    assert not os.path.isfile(os.path.join(registry_folder, str(finished.pid)))
+
+
+def test_kma_shm_falls_back(tmpdir):
+    kma_shm.configure(enabled=True, registry=str(tmpdir))
+    try:
+        assert kma_shm.attach(os.path.join(str(tmpdir), 'Fakella_db_kma')) is False
+        assert kma_shm.attached_databases == set()
+    finally:
+        kma_shm.configure(enabled=False)
+
+
+def test_kma_shm_detaches_unused(tmpdir, monkeypatch):
+    commands = list()
+    monkeypatch.setattr(runner, 'run', lambda cmd, log=None: commands.append(cmd))
+    kma_shm.configure(enabled=True, registry=str(tmpdir))
+    needed, unused = [os.path.join(str(tmpdir), genus + '_db_kma') for genus in ('Fakella', 'Otherella')]
+    try:
+        assert kma_shm.attach(needed) and kma_shm.attach(unused)
+        kma_shm.detach_unused([needed])
+        assert kma_shm.attached_databases == {needed}
+        assert commands[-1] == 'kma shm -t_db {} -shmLvl 1 -destroy'.format(unused)
+    finally:
+        kma_shm.detach_all()
+        kma_shm.configure(enabled=False)
+    assert kma_shm.attached_databases == set()
+
+
+def test_genus_database_prefers_cgderived(tmpdir):
+    open(os.path.join(str(tmpdir), 'Fakella_db_cgderived.fasta'), 'w').close()
+    assert find_genus_database('Fakella', str(tmpdir)) == os.path.join(str(tmpdir), 'Fakella_db_cgderived.fasta')
+
+
+def test_genus_database_rmlst_priority(tmpdir):
+    open(os.path.join(str(tmpdir), 'Fakella_db_cgderived.fasta'), 'w').close()
+    assert find_genus_database('Fakella', str(tmpdir), use_rmlst=True) == os.path.join(str(tmpdir),
+                                                                                        'Fakella_db.fasta')
+
+
+def test_genus_database_cgmlst():
+    assert find_genus_database('Fakella', 'databases', cgmlst_db='tests/rmlst.fasta') == 'tests/rmlst.fasta'
+
+
+def test_screen_result_comment():
+    result = mash.ScreenResult('0.998\t990/1000\t45\t0\tGCF_000008865.2_ASM886v2_genomic.fna.gz\t'
+                               '[2 seqs] NC_002695.2 Escherichia coli O157:H7 str. Sakai, complete genome [...]')
+    assert result.query_comment == '[2 seqs] NC_002695.2 Escherichia coli O157:H7 str. Sakai, complete genome [...]'
+
+
+def test_predominant_species(tmpdir):
+    screen_file = os.path.join(str(tmpdir), 'screen.tab')
+    with open(screen_file, 'w') as f:
+        f.write('0.99\t990/1000\t45\t0\tdb/Bacteria/Escherichia/coli/GCF_1.fna\t'
+                '[2 seqs] NC_002695.2 Escherichia coli O157:H7 str. Sakai, complete genome [...]\n')
+        f.write('0.95\t900/1000\t20\t0\tdb/Bacteria/Escherichia/fergusonii/GCF_2.fna\t'
+                '[1 seqs] NC_011740.1 Escherichia fergusonii ATCC 35469, complete genome\n')
+    assert find_predominant_species(screen_file, 'Escherichia') == 'Escherichia coli'
+    assert find_predominant_species(screen_file, 'Listeria') is None
+
+
+def test_predominant_species_unnamed(tmpdir):
+    screen_file = os.path.join(str(tmpdir), 'screen.tab')
+    with open(screen_file, 'w') as f:
+        f.write('0.99\t990/1000\t45\t0\tdb/Bacteria/Escherichia/sp/GCF_1.fna\t'
+                '[1 seqs] NZ_CP000001.1 Escherichia sp. E4742, complete genome\n')
+    assert find_predominant_species(screen_file, 'Escherichia') is None
+
+
+def test_create_species_allele_file(tmpdir):
+    profiles_file = os.path.join(str(tmpdir), 'profiles.txt')
+    species_allele_file = os.path.join(str(tmpdir), 'species_allele.txt')
+    with open(profiles_file, 'w') as f:
+        f.write('rST\tgenus\tspecies\tBACT000001\tBACT000002\n')
+        f.write('1\tEscherichia\tEscherichia coli\t1\t5\n')
+        f.write('2\tEscherichia\tcoli\t2\tN\n')
+        f.write('3\tListeria\tListeria monocytogenes\t3\t4\n')
+    create_species_allele_file(profiles_file, species_allele_file)
+    assert find_genusspecific_allele_list(species_allele_file, 'Escherichia coli') == ['BACT000001_1',
+                                                                                       'BACT000002_5',
+                                                                                       'BACT000001_2']
+    assert find_genusspecific_allele_list(species_allele_file, 'Listeria monocytogenes') == ['BACT000001_3',
+                                                                                             'BACT000002_4']
+
+
+def test_allele_store(tmpdir):
+    profiles_file = os.path.join(str(tmpdir), 'profiles.txt')
+    with open(profiles_file, 'w') as f:
+        f.write('rST\tgenus\tspecies\tBACT000001\tBACT000002\n')
+        f.write('1\tEscherichia\tEscherichia coli\t1\t5\n')
+        f.write('2\tEscherichia\tfergusonii\t1\t6\n')
+        f.write('3\tListeria\tListeria monocytogenes\t3\tN\n')
+    database_setup.create_allele_files(profiles_file, str(tmpdir))
+    gene_allele_file = os.path.join(str(tmpdir), 'gene_allele.txt')
+    species_allele_file = os.path.join(str(tmpdir), 'species_allele.txt')
+    assert database_setup.find_stored_allele_list(gene_allele_file, 'Escherichia') == ['BACT000001_1', 'BACT000002_5',
+                                                                                       'BACT000002_6']
+    assert database_setup.find_stored_allele_list(species_allele_file, 'Escherichia fergusonii') == ['BACT000001_1',
+                                                                                                     'BACT000002_6']
+    assert database_setup.find_stored_allele_list(gene_allele_file, 'Fakella') == []
+    # Same answers as reading through the text files.
+    for genus, alleles in database_setup.read_gene_allele_file(gene_allele_file).items():
+        assert find_genusspecific_allele_list(gene_allele_file, genus) == alleles
+    # If the text file gets changed, the store can't be trusted any more.
+    with open(gene_allele_file, 'a') as f:
+        f.write('Fakella:BACT000001_9,\n')
+    assert database_setup.find_stored_allele_list(gene_allele_file, 'Fakella') is None
+    assert find_genusspecific_allele_list(gene_allele_file, 'Fakella') == ['BACT000001_9']
+
+
+def test_read_gene_allele_file(tmpdir):
+    gene_allele_file = os.path.join(str(tmpdir), 'gene_allele.txt')
+    with open(gene_allele_file, 'w') as f:
+        f.write('Escherichia:BACT000001_1,BACT000002_5,\nListeria:BACT000001_3,\n')
+    assert database_setup.read_gene_allele_file(gene_allele_file) == {'Escherichia': ['BACT000001_1', 'BACT000002_5'],
+                                                                       'Listeria': ['BACT000001_3']}
+
+
+def test_file_fingerprint():
+    fingerprint = database_setup.find_file_fingerprint('tests/rmlst.fasta')
+    assert fingerprint['size'] == os.path.getsize('tests/rmlst.fasta')
+    assert len(fingerprint['sha256']) == 64
+    assert database_setup.find_file_fingerprint('tests/not_a_file.fasta') is None
+
+
+def test_half_written_fasta_is_rebuilt(tmpdir):
+    database_folder = str(tmpdir)
+    shutil.copy('tests/rmlst.fasta', os.path.join(database_folder, 'rMLST_combined.fasta'))
+    allele = next(SeqIO.parse('tests/rmlst.fasta', 'fasta')).id
+    genus_database = os.path.join(database_folder, 'Fakella_db.fasta')
+    with open(genus_database, 'w') as f:
+        f.write('>{}\nACGT'.format(allele))
+    assert database_setup.is_complete_fasta(genus_database) is False
+    database_setup.setup_allelespecific_database(genus_database, database_folder, [allele])
+    assert database_setup.is_complete_fasta(genus_database) is True
+    assert len(next(SeqIO.parse(genus_database, 'fasta')).seq) > 4
+    # Nothing gets left behind from building somewhere else first.
+    assert not glob.glob(os.path.join(database_folder, '*.tmp'))
+
+
+def test_half_written_fai_is_rebuilt(tmpdir):
+    fasta_file = os.path.join(str(tmpdir), 'rmlst.fasta')
+    shutil.copy('tests/rmlst.fasta', fasta_file)
+    with open(fasta_file + '.fai', 'w') as f:
+        f.write('BACT000001_1\t1000\t14\t')
+    assert database_setup.is_complete_fai(fasta_file) is False
+    database_setup.index_fasta(fasta_file)
+    assert database_setup.is_complete_fai(fasta_file) is True
+    with open(fasta_file + '.fai') as f:
+        assert sum(1 for _ in f) == sum(1 for _ in SeqIO.parse(fasta_file, 'fasta'))
+
+
+def test_build_lock_waits(tmpdir):
+    path = os.path.join(str(tmpdir), 'Fakella_db.fasta')
+    events = list()
+
+    def build():
+        with database_setup.build_lock(path):
+            events.append('start')
+            time.sleep(0.2)
+            events.append('end')
+    threads = [threading.Thread(target=build) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert events == ['start', 'end', 'start', 'end']
+
+
+def test_genus_database_uses_prebuilt_with_tmpdir(tmpdir):
+    databases_folder = os.path.join(str(tmpdir), 'databases')
+    os.makedirs(databases_folder)
+    with open(os.path.join(databases_folder, PREBUILT_FINGERPRINT), 'w') as f:
+        f.write('{"databases": ["Fakella_db.fasta", "rMLST_combined.fasta"]}')
+    assert find_genus_database('Fakella', databases_folder, tmpdir=os.path.join(str(tmpdir), 'tmp'),
+                               use_rmlst=True) == os.path.join(databases_folder, 'Fakella_db.fasta')
+    # Genera that weren't prebuilt still get built in tmpdir.
+    assert find_genus_database('Otherella', databases_folder, tmpdir=os.path.join(str(tmpdir), 'tmp'),
+                               use_rmlst=True) == os.path.join(str(tmpdir), 'tmp', 'Otherella_db.fasta')
+
+
+def test_genus_database_built_in_cache(tmpdir):
+    databases_folder = os.path.join(str(tmpdir), 'databases')
+    os.makedirs(databases_folder)
+    shutil.copy('tests/rmlst.fasta', os.path.join(databases_folder, 'rMLST_combined.fasta'))
+    allele = next(SeqIO.parse('tests/rmlst.fasta', 'fasta')).id
+    with open(os.path.join(databases_folder, 'gene_allele.txt'), 'w') as f:
+        f.write('Fakella:{},\n'.format(allele))
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    cache_folder = database_cache.find_cache_folder(cache_dir, databases_folder)
+    assert database_cache.find_cache_folder(cache_dir, databases_folder) == cache_folder
+    sample_database = find_genus_database('Fakella', databases_folder, tmpdir=cache_folder, use_rmlst=True)
+    assert sample_database == os.path.join(cache_folder, 'Fakella_db.fasta')
+    assert [record.id for record in SeqIO.parse(sample_database, 'fasta')] == [allele]
+    assert os.path.isfile(sample_database + '.used')
+    # Updating the databases means a new cache folder, and the old one goes away.
+    with open(os.path.join(databases_folder, 'gene_allele.txt'), 'a') as f:
+        f.write('Otherella:{},\n'.format(allele))
+    new_cache_folder = database_cache.find_cache_folder(cache_dir, databases_folder)
+    assert new_cache_folder != cache_folder
+    assert not os.path.isdir(cache_folder)
+
+
+def test_cache_folder_kept_while_in_use(tmpdir):
+    databases_folder = os.path.join(str(tmpdir), 'databases')
+    os.makedirs(databases_folder)
+    with open(os.path.join(databases_folder, 'gene_allele.txt'), 'w') as f:
+        f.write('Fakella:BACT000001_1,\n')
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    cache_folder = database_cache.find_cache_folder(cache_dir, databases_folder)
+    # Another job is using the cache folder - the parent process stands in for it, since it is still running.
+    shutil.copy(os.path.join(cache_dir, database_cache.JOBS_FOLDER, str(os.getpid())),
+                os.path.join(cache_dir, database_cache.JOBS_FOLDER, str(os.getppid())))
+    with open(os.path.join(databases_folder, 'gene_allele.txt'), 'a') as f:
+        f.write('Otherella:BACT000001_1,\n')
+    new_cache_folder = database_cache.find_cache_folder(cache_dir, databases_folder)
+    assert os.path.isdir(cache_folder)
+    # Once it's done, the old folder goes the next time the cache is looked at.
+    os.remove(os.path.join(cache_dir, database_cache.JOBS_FOLDER, str(os.getppid())))
+    assert database_cache.find_cache_folder(cache_dir, databases_folder) == new_cache_folder
+    assert not os.path.isdir(cache_folder)
+    database_cache.finish_job(cache_dir)
+    assert database_cache.find_running_jobs(cache_dir) == dict()
+
+
+def test_evict_cache(tmpdir):
+    cache_folder = os.path.join(str(tmpdir), 'abcd')
+    os.makedirs(cache_folder)
+    open(os.path.join(cache_folder, database_cache.CACHE_SOURCE), 'w').close()
+    for age, genus in enumerate(['Newella', 'Middlella', 'Oldella']):
+        database = os.path.join(cache_folder, '{}_db.fasta'.format(genus))
+        with open(database, 'w') as f:
+            f.write('>a\n' + 'A' * 1000 + '\n')
+        with open(database.replace('.fasta', '_kma.name'), 'w') as f:
+            f.write('a\n')
+        database_cache.mark_used(database)
+        os.utime(database + '.used', (time.time() - age * 100, time.time() - age * 100))
+    assert database_cache.evict_cache(str(tmpdir), max_size=2500) == [os.path.join(cache_folder, 'Oldella_db.fasta')]
+    assert not os.path.isfile(os.path.join(cache_folder, 'Oldella_db_kma.name'))
+    # Databases used recently enough are kept even if that means going over the limit.
+    assert database_cache.evict_cache(str(tmpdir), max_size=0, keep_since=time.time() - 50) == \
+        [os.path.join(cache_folder, 'Middlella_db.fasta')]
+    assert os.path.isfile(os.path.join(cache_folder, 'Newella_db.fasta'))
+    # Nothing another running job (the parent process) may have used gets evicted either.
+    os.makedirs(os.path.join(str(tmpdir), database_cache.JOBS_FOLDER))
+    database_cache.write_json({'started': time.time() - 50},
+                              os.path.join(str(tmpdir), database_cache.JOBS_FOLDER, str(os.getppid())))
+    assert database_cache.evict_cache(str(tmpdir), max_size=0) == list()
+
+
+class RmlstServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Stands in for the PubMLST REST API, serving loci and profiles out of dictionaries that tests can change, and
+    recording every request along with the status it got. Paths in failures get a 503 until their count runs out, and
+    paths in files are served as they are.
+    """
+    daemon_threads = True
+
+    def __init__(self, loci, profiles):
+        super().__init__(('127.0.0.1', 0), RmlstHandler)
+        self.loci = loci
+        self.profiles = profiles
+        self.requests = list()
+        self.failures = dict()
+        self.files = dict()
+        self.rest_url = 'http://127.0.0.1:{}/db/pubmlst_rmlst_seqdef'.format(self.server_address[1])
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class RmlstHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        rest_url = self.server.rest_url
+        path = self.path.split('?')[0].replace('/db/pubmlst_rmlst_seqdef', '', 1)
+        locus = path.split('/')[2] if path.startswith('/loci/') else None
+        if path == '':
+            body, content_type = json.dumps({'loci': rest_url + '/loci', 'schemes': rest_url + '/schemes'}), 'json'
+        elif path == '/loci':
+            body = json.dumps({'loci': [rest_url + '/loci/' + locus for locus in sorted(self.server.loci)]})
+            content_type = 'json'
+        elif locus in self.server.loci and path.endswith('/alleles_fasta'):
+            body, content_type = self.server.loci[locus], 'text'
+        elif path == '/schemes/1/profiles_csv':
+            body, content_type = self.server.profiles, 'text'
+        elif path in self.server.files:
+            body, content_type = self.server.files[path], 'text'
+        else:
+            self.send_response(404)
+            self.end_headers()
+            self.server.requests.append((path, 404))
+            return
+        body = body.encode() if isinstance(body, str) else body
+        etag = '"{}"'.format(hashlib.sha256(body).hexdigest())
+        status = 304 if self.headers.get('If-None-Match') == etag else 200
+        if self.server.failures.get(path):
+            self.server.failures[path] -= 1
+            status, body = 503, b''
+        elif status == 200 and self.headers.get('Range') and self.headers.get('If-Range') == etag:
+            offset = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            content_range = 'bytes {}-{}/{}'.format(offset, len(body) - 1, len(body))
+            status, body = 206, body[offset:]
+        self.server.requests.append((path, status))
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json' if content_type == 'json' else 'text/plain')
+        self.send_header('Content-Length', str(len(body) if status != 304 else 0))
+        if status == 206:
+            self.send_header('Content-Range', content_range)
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_incremental_rmlst_update(tmpdir):
+    output_folder = str(tmpdir)
+    secret_file = os.path.join(output_folder, 'secret.txt')
+    with open(secret_file, 'w') as f:
+        f.write('key\nsecret\n')
+    server = RmlstServer(loci={'BACT000001': '>BACT000001_1\nACGT-ACGTN\n',
+                               'BACT000002': '>BACT000002-1\nTTTTGGGG\n'},
+                         profiles='rST\tBACT000001\tBACT000002\tgenus\tspecies\n'
+                                  '1\t1\tN\tFakella\t\n'
+                                  '2\tN\t1\tOtherella\t\n')
+    rmlst_rest = database_setup.RmlstRest(secret_file, output_folder, rest_url=server.rest_url)
+    manifest = database_setup.read_manifest(output_folder)
+    try:
+        assert database_setup.update_rmlst_database(rmlst_rest, output_folder, manifest) == \
+            ['BACT000001', 'BACT000002']
+        database_setup.write_manifest(manifest, output_folder)
+        combined_file = os.path.join(output_folder, 'rMLST_combined.fasta')
+        assert sorted((record.id, str(record.seq)) for record in SeqIO.parse(combined_file, 'fasta')) == \
+            [('BACT000001_1', 'ACGTACGT'), ('BACT000002_1', 'TTTTGGGG')]
+        assert glob.glob(os.path.join(output_folder, '*.tfa')) == list()
+        # The .fai made along the way has to match what samtools would make.
+        with open(combined_file + '.fai') as f:
+            fai = f.read()
+        os.remove(combined_file + '.fai')
+        index_fasta(combined_file)
+        with open(combined_file + '.fai') as f:
+            assert f.read() == fai
+        for genus in ['Fakella', 'Otherella']:
+            database = os.path.join(output_folder, '{}_db.fasta'.format(genus))
+            setup_allelespecific_database(database, output_folder,
+                                          find_genusspecific_allele_list(os.path.join(output_folder,
+                                                                                      'gene_allele.txt'), genus))
+            with open(database.replace('.fasta', '_kma.name'), 'w') as f:
+                f.write('a\n')
+        old_allele_lists = {'gene_allele.txt':
+                            database_setup.read_gene_allele_file(os.path.join(output_folder, 'gene_allele.txt'))}
+
+        # Only the locus that changed gets downloaded again, and only the database using it gets removed.
+        server.loci['BACT000002'] = '>BACT000002_1\nTTTTCCCC\n'
+        server.requests.clear()
+        manifest = database_setup.read_manifest(output_folder)
+        changed_loci = database_setup.update_rmlst_database(rmlst_rest, output_folder, manifest)
+        assert changed_loci == ['BACT000002']
+        assert ('/loci/BACT000001/alleles_fasta', 304) in server.requests
+        assert ('/loci/BACT000002/alleles_fasta', 200) in server.requests
+        assert ('/schemes/1/profiles_csv', 304) in server.requests
+        assert sorted(str(record.seq) for record in SeqIO.parse(combined_file, 'fasta')) == ['ACGTACGT', 'TTTTCCCC']
+        assert packed_alleles.has_packed_alleles(combined_file)
+        assert database_setup.invalidate_derived_databases(output_folder, changed_loci, old_allele_lists) == \
+            [os.path.join(output_folder, 'Otherella_db.fasta')]
+        assert database_setup.is_complete_fai(combined_file)
+        assert os.path.isfile(os.path.join(output_folder, 'Fakella_db_kma.name'))
+        assert not os.path.isfile(os.path.join(output_folder, 'Otherella_db_kma.name'))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_rmlst_download_resumes_and_retries(tmpdir):
+    output_folder = str(tmpdir)
+    secret_file = os.path.join(output_folder, 'secret.txt')
+    with open(secret_file, 'w') as f:
+        f.write('key\nsecret\n')
+    loci = {'BACT{:06d}'.format(i): '>BACT{:06d}-1\n{}\n'.format(i, 'ACGT' * i) for i in range(1, 11)}
+    profiles = 'rST\tgenus\n1\tFakella\n'
+    server = RmlstServer(loci=dict(loci), profiles=profiles)
+    server.failures['/loci/BACT000002/alleles_fasta'] = 1
+    # Left over from a download that got interrupted part way through.
+    with open(os.path.join(output_folder, 'profiles.txt.part'), 'w') as f:
+        f.write(profiles[:6])
+    with open(os.path.join(output_folder, 'profiles.txt.part.validator'), 'w') as f:
+        f.write('"{}"'.format(hashlib.sha256(profiles.encode()).hexdigest()))
+    with open(os.path.join(output_folder, 'BACT000004.fasta.part'), 'w') as f:
+        f.write(loci['BACT000004'][:8])
+    with open(os.path.join(output_folder, 'BACT000004.fasta.part.validator'), 'w') as f:
+        f.write('"{}"'.format(hashlib.sha256(loci['BACT000004'].encode()).hexdigest()))
+    rmlst_rest = database_setup.RmlstRest(secret_file, output_folder, rest_url=server.rest_url, max_sessions=3)
+    combined_file = os.path.join(output_folder, 'rMLST_combined.fasta')
+    try:
+        rmlst_rest.get_loci_and_scheme_url()
+        writer = database_setup.IndexedFastaWriter(combined_file)
+        assert rmlst_rest.download_loci(writer) == sorted(loci)
+        writer.close()
+        assert rmlst_rest.download_profile() is True
+        with pysam.FastaFile(combined_file) as f:
+            assert sorted(f.references) == ['{}_1'.format(locus) for locus in sorted(loci)]
+            assert f.fetch('BACT000003_1') == 'ACGT' * 3
+            assert f.fetch('BACT000004_1') == 'ACGT' * 4
+        with open(os.path.join(output_folder, 'profiles.txt')) as f:
+            assert f.read() == profiles
+        assert ('/schemes/1/profiles_csv', 206) in server.requests
+        assert ('/loci/BACT000004/alleles_fasta', 206) in server.requests
+        assert [status for path, status in server.requests if path == '/loci/BACT000002/alleles_fasta'] == [503, 200]
+        assert rmlst_rest.session_count <= 3
+        assert glob.glob(os.path.join(output_folder, '*.part*')) == list()
+        assert glob.glob(os.path.join(output_folder, 'BACT*')) == list()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_cgmlst_download_extracts_as_it_streams(tmpdir):
+    output_folder = str(tmpdir)
+    archive_folder = os.path.join(output_folder, 'archive')
+    os.makedirs(archive_folder)
+    contents = {'Fakella_db_cgderived.fasta': '>gene_1\n' + 'ACGT' * 5000 + '\n', 'gene_allele.txt': 'Fakella:gene_1\n'}
+    for name in contents:
+        with open(os.path.join(archive_folder, name), 'w') as f:
+            f.write(contents[name])
+    archive = os.path.join(output_folder, 'archive.tar.gz')
+    with tarfile.open(archive, 'w:gz') as tar:
+        for name in contents:
+            tar.add(os.path.join(archive_folder, name), arcname=name)
+    with open(archive, 'rb') as f:
+        archive_bytes = f.read()
+    database_folder = os.path.join(output_folder, 'databases')
+    os.makedirs(database_folder)
+    # Left over from a download that got interrupted part way through.
+    with open(os.path.join(database_folder, 'confindr_db.tar.gz.part'), 'wb') as f:
+        f.write(archive_bytes[:len(archive_bytes) // 2])
+    with open(os.path.join(database_folder, 'confindr_db.tar.gz.part.validator'), 'w') as f:
+        f.write('"{}"'.format(hashlib.sha256(archive_bytes).hexdigest()))
+    server = RmlstServer(loci=dict(), profiles='')
+    server.files['/confindr_db.tar.gz'] = archive_bytes
+    url = server.rest_url.replace('/db/pubmlst_rmlst_seqdef', '/confindr_db.tar.gz')
+    try:
+        manifest = database_setup.read_manifest(database_folder)
+        md5 = hashlib.md5(archive_bytes).hexdigest()
+        assert sorted(database_setup.download_cgmlst_derived_data(database_folder, manifest, url=url, md5=md5)) == \
+            sorted(contents)
+        assert server.requests == [('/confindr_db.tar.gz', 206)]
+        for name in contents:
+            with open(os.path.join(database_folder, name)) as f:
+                assert f.read() == contents[name]
+            assert manifest['files'][name]['source'] == 'confindr_db.tar.gz'
+        assert sorted(os.listdir(database_folder)) == sorted(contents)
+        # Nothing is downloaded again while the extracted files are intact.
+        assert database_setup.download_cgmlst_derived_data(database_folder, manifest, url=url) == list()
+        assert server.requests[-1] == ('/confindr_db.tar.gz', 304)
+        # The test server doesn't send a checksum, so without a published one the archive isn't trusted.
+        other_folder = os.path.join(output_folder, 'other_databases')
+        os.makedirs(other_folder)
+        with pytest.raises(ValueError):
+            database_setup.download_cgmlst_derived_data(other_folder, url=url)
+        assert [name for name in os.listdir(other_folder) if not name.endswith('.validator')] == list()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_verify_download(tmpdir):
+    partial_file = os.path.join(str(tmpdir), 'file.part')
+    with open(partial_file, 'wb') as f:
+        f.write(b'ACGT')
+    md5 = hashlib.md5(b'ACGT').hexdigest()
+    database_setup.verify_download(partial_file, 200, {'Content-Length': '4'})
+    database_setup.verify_download(partial_file, 206, {'Content-Range': 'bytes 2-3/4'})
+    database_setup.verify_download(partial_file, 200, {'ETag': '"{}"'.format(md5), 'x-amz-request-id': 'a'})
+    # Too short can be resumed, so it's kept.
+    with pytest.raises(IOError):
+        database_setup.verify_download(partial_file, 200, {'Content-Length': '8'})
+    assert os.path.isfile(partial_file)
+    with pytest.raises(IOError):
+        database_setup.verify_download(partial_file, 200, {'ETag': '"{}"'.format('0' * 32), 'x-amz-request-id': 'a'})
+    assert not os.path.isfile(partial_file)
+    with open(partial_file, 'wb') as f:
+        f.write(b'ACGT')
+    git_sha1 = hashlib.sha1(b'blob 4\0ACGT').hexdigest()
+    multipart_etag = '"{}-1"'.format(hashlib.md5(hashlib.md5(b'ACGT').digest()).hexdigest())
+    database_setup.verify_download(partial_file, 200, dict(), checksum=('git-sha1', git_sha1), require_checksum=True)
+    database_setup.verify_download(partial_file, 200, {'ETag': multipart_etag, 'x-amz-request-id': 'a'},
+                                   require_checksum=True)
+    # Nothing to check the download against.
+    with pytest.raises(ValueError):
+        database_setup.verify_download(partial_file, 200, {'Content-Length': '4'}, require_checksum=True)
+    assert not os.path.isfile(partial_file)
+
+
+def test_mash_sketch_download_checked_against_github(tmpdir, monkeypatch):
+    # Downloads that don't match get retried, which doesn't need to be waited for here.
+    monkeypatch.setattr(database_setup.time, 'sleep', lambda seconds: None)
+    sketch = b'not really a mash sketch'
+    server = RmlstServer(loci=dict(), profiles='')
+    server.files['/refseq.msh'] = sketch
+    server.files['/contents/refseq.msh'] = json.dumps({'sha': hashlib.sha1(b'blob 24\0' + sketch).hexdigest()})
+    base_url = server.rest_url.replace('/db/pubmlst_rmlst_seqdef', '')
+    try:
+        assert database_setup.download_mash_sketch(str(tmpdir), url=base_url + '/refseq.msh',
+                                                   contents_url=base_url + '/contents/refseq.msh?ref=master') is True
+        with open(os.path.join(str(tmpdir), 'refseq.msh'), 'rb') as f:
+            assert f.read() == sketch
+        server.files['/contents/refseq.msh'] = json.dumps({'sha': '0' * 40})
+        other_folder = os.path.join(str(tmpdir), 'other')
+        os.makedirs(other_folder)
+        with pytest.raises(IOError):
+            database_setup.download_mash_sketch(other_folder, url=base_url + '/refseq.msh',
+                                                contents_url=base_url + '/contents/refseq.msh')
+        assert not os.path.isfile(os.path.join(other_folder, 'refseq.msh'))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_cluster_database(tmpdir):
+    gene = 'ACGTTGCAAGGCTTACCGATCGATGGCATTACGGATCCAGTTGACCATGGTACCAGTAGCTAGCATCGACTGACTAGCATGCATG'
+    other_gene = 'TTGACCGGTTAACCGGTTAAGGCCTTAAGGCCAATTGGCCAATTCCGGAATTCCGGAATTGGCCTTAAGGCCTTAACCGGTTAACC'
+    database = os.path.join(str(tmpdir), 'cgmlst.fasta')
+    with open(database, 'w') as f:
+        f.write('>geneA_1\n{}\n'.format(gene))
+        # One substitution, and a copy that's been cut short - both within 90% of allele 1.
+        f.write('>geneA_2\n{}\n'.format(gene[:40] + 'A' + gene[41:]))
+        f.write('>geneA_3\n{}\n'.format(gene[5:]))
+        # Too different to be clustered with the rest.
+        f.write('>geneA_4\n{}\n'.format(gene[:30] + other_gene[30:]))
+        f.write('>gene_B_1\n{}\n'.format(other_gene))
+        f.write('>gene_B_2\n{}\n'.format(other_gene))
+    gene_alleles = cluster_database.read_gene_alleles(database)
+    assert list(gene_alleles) == ['geneA', 'gene_B']
+    gene_clusters = cluster_database.cluster_alleles(gene_alleles, identity=0.9)
+    assert gene_clusters == {'geneA': {'geneA_1': ['geneA_1', 'geneA_2', 'geneA_3'], 'geneA_4': ['geneA_4']},
+                             'gene_B': {'gene_B_1': ['gene_B_1', 'gene_B_2']}}
+    # At 100% identity, only alleles that are identical over the shorter one are clustered together.
+    assert list(cluster_database.cluster_gene(gene_alleles['geneA'], identity=1)) == ['geneA_1', 'geneA_2', 'geneA_4']
+    output_file = os.path.join(str(tmpdir), 'clustered.fasta')
+    cluster_file = cluster_database.write_clustered_database(gene_alleles, gene_clusters, output_file)
+    assert [(record.id, str(record.seq)) for record in SeqIO.parse(output_file, 'fasta')] == \
+        [('geneA_1', gene), ('geneA_4', gene[:30] + other_gene[30:]), ('gene_B_1', other_gene)]
+    with open(cluster_file) as f:
+        assert len(f.readlines()) == 7
+    summary = cluster_database.summarize_clustering(gene_alleles, gene_clusters)
+    assert (summary['alleles_before'], summary['alleles_after']) == (6, 3)
+    assert summary['bases_after'] == len(gene) + len(gene[:30] + other_gene[30:]) + len(other_gene)
+
+
+def test_genus_database_species_falls_back_to_genus(tmpdir):
+    # No species information available, so should end up with the genus database.
+    assert find_genus_database('Fakella', str(tmpdir), use_rmlst=True,
+                               species='Fakella fakeii') == os.path.join(str(tmpdir), 'Fakella_db.fasta')
+
+
+def test_batch_key_same_reference(tmpdir):
+    typings = list()
+    for sample in ['one', 'two']:
+        os.makedirs(os.path.join(str(tmpdir), sample))
+        shutil.copyfile('tests/rmlst.fasta', os.path.join(str(tmpdir), sample, 'rmlst.fasta'))
+        typings.append({'reference': os.path.join(str(tmpdir), sample, 'rmlst.fasta'),
+                        'paired': True,
+                        'merged': False})
+    assert find_batch_key(typings[0]) == find_batch_key(typings[1])
+    assert find_batch_key(typings[0], data_type='Nanopore') is None
+
+
+def test_analysed_genera():
+    assert find_analysed_genera('Escherichia') == ['Escherichia']
+    assert find_analysed_genera('Escherichia:Salmonella') == []
+    assert find_analysed_genera('Escherichia:Salmonella', cross_details=True) == ['Escherichia']
+    assert find_analysed_genera('Escherichia:Salmonella', cross_details=True,
+                                all_genera=True) == ['Escherichia', 'Salmonella']
+
+
+def test_prescreen_failure_is_recorded(tmpdir):
+    samples = prescreen_samples([[os.path.join(str(tmpdir), 'missing.fastq.gz')]], output_folder=str(tmpdir),
+                                databases_folder=str(tmpdir))
+    assert samples[0]['sample_name'] == 'missing'
+    assert samples[0]['error'] is not None
+
+
+def test_prepare_databases_builds_each_genus_once(tmpdir):
+    shutil.copyfile('tests/rmlst.fasta', os.path.join(str(tmpdir), 'rMLST_combined.fasta'))
+    with open(os.path.join(str(tmpdir), 'gene_allele.txt'), 'w') as f:
+        f.write('Fakella:BACT000001_30,BACT000002_25,\n')
+    samples = [{'genus': 'Fakella', 'sample_tmp_dir': str(tmpdir), 'error': None},
+               {'genus': 'Fakella', 'sample_tmp_dir': str(tmpdir), 'error': None},
+               {'genus': 'Fakella:Otherella', 'sample_tmp_dir': str(tmpdir), 'error': None},
+               {'genus': None, 'sample_tmp_dir': None, 'error': subprocess.CalledProcessError(1, 'mash')}]
+    # Assembly mode doesn't need anything indexed, so this only builds the databases.
+    databases = prepare_databases(samples, databases_folder=str(tmpdir), log=os.path.join(str(tmpdir), 'log.txt'),
+                                  use_rmlst=True, fasta=True, assembly_mode=True)
+    assert databases == [os.path.join(str(tmpdir), 'Fakella_db.fasta')]
+    assert [record.id for record in SeqIO.parse(databases[0], 'fasta')] == ['BACT000001_30', 'BACT000002_25']
+
+
+def fake_tools(commands):
+    """
+    Stands in for runner.run, recording every command and writing the files that bbduk, bbmerge, KMA and bbmap would
+    make, so that the pipeline can be run without them installed.
+    """
+    def run(cmd, log=None, stdout_file=None, tail_lines=1000):
+        commands.append(cmd)
+        if log:
+            with open(log, 'a+') as f:
+                f.write(cmd + '\n')
+        args = runner.split_command(cmd)
+        params = dict(arg.split('=', 1) for arg in args[1:] if '=' in arg)
+        if args[0] in ('bbduk.sh', 'bbmerge.sh'):
+            for key in ('out', 'out1', 'out2', 'outu', 'outu2'):
+                if key in params:
+                    shutil.copy('tests/fake_fastqs/test_R1.fastq.gz', params[key])
+        elif args[:2] == ['kma', 'index']:
+            database = args[args.index('-o') + 1]
+            with open(database + '.name', 'w') as f:
+                for record in SeqIO.parse(args[args.index('-i') + 1], 'fasta'):
+                    f.write(record.id + '\n')
+            open(database + '.length.b', 'w').close()
+        elif args[0] == 'kma':
+            with open(args[args.index('-o') + 1] + '.res', 'w') as f:
+                f.write('#Template\tScore\nBACT000001_30\t100\nBACT000002_25\t90\n')
+        elif args[0] == 'bbmap.sh':
+            # Half of the reads each for the pairs and the merged reads, written out of order like bbmap does.
+            parity = 1 if 'merged' in params['in'] else 0
+            with pysam.AlignmentFile('tests/contamination.bam', 'rb') as bam:
+                reads = [read for i, read in enumerate(bam.fetch(until_eof=True)) if i % 2 == parity]
+                with pysam.AlignmentFile(params['out'], 'wb', template=bam) as out:
+                    for read in reversed(reads):
+                        out.write(read)
+        return '', ''
+    return run
+
+
+def use_fake_tools(tmpdir, monkeypatch):
+    """
+    Runs every external program through fake_tools for the rest of a test.
+    :return: List that commands get recorded in.
+    """
+    commands = list()
+    monkeypatch.setattr(runner, 'run', fake_tools(commands))
+    # bbduk's trimming wrapper checks that bbduk.sh is on the PATH before doing anything.
+    fake_bin = os.path.join(str(tmpdir), 'bin')
+    os.makedirs(fake_bin)
+    with open(os.path.join(fake_bin, 'bbduk.sh'), 'w') as f:
+        f.write('#!/bin/sh\nexit 1\n')
+    os.chmod(os.path.join(fake_bin, 'bbduk.sh'), 0o755)
+    monkeypatch.setenv('PATH', fake_bin + os.pathsep + os.environ['PATH'])
+    return commands
+
+
+def test_merged_reads_are_typed_and_mapped(tmpdir, monkeypatch):
+    commands = use_fake_tools(tmpdir, monkeypatch)
+    database = os.path.join(str(tmpdir), 'cgmlst.fasta')
+    shutil.copy('tests/rmlst.fasta', database)
+    sample_tmp_dir = os.path.join(str(tmpdir), 'sample')
+    typing = type_core_genes(pair=['tests/fake_fastqs/test_R1.fastq.gz', 'tests/fake_fastqs/test_R2.fastq.gz'],
+                             genus='Fakella',
+                             sample_tmp_dir=sample_tmp_dir,
+                             output_folder=str(tmpdir),
+                             databases_folder=str(tmpdir),
+                             report_name='sample',
+                             log=None,
+                             cgmlst_db=database,
+                             merge_reads=True)
+    assert typing['merged'] is True
+    bbmerge_cmd = [cmd for cmd in commands if cmd.startswith('bbmerge.sh')][0]
+    assert 'out={}'.format(os.path.join(sample_tmp_dir, 'merged.fastq.gz')) in bbmerge_cmd
+    assert 'outu={}'.format(os.path.join(sample_tmp_dir, 'unmerged_R1.fastq.gz')) in bbmerge_cmd
+    assert 'outu2={}'.format(os.path.join(sample_tmp_dir, 'unmerged_R2.fastq.gz')) in bbmerge_cmd
+    # Unmerged pairs go to KMA as pairs, along with the merged reads as single reads.
+    kma_cmd = [cmd for cmd in commands if cmd.startswith('kma -ipe')][0]
+    assert kma_cmd.startswith('kma -ipe {} {} '.format(os.path.join(sample_tmp_dir, 'unmerged_R1.fastq.gz'),
+                                                       os.path.join(sample_tmp_dir, 'unmerged_R2.fastq.gz')))
+    assert kma_cmd.endswith(' -i {}'.format(os.path.join(sample_tmp_dir, 'merged.fastq.gz')))
+
+    map_to_core_genes(typing, log=None, cgmlst_db=database)
+    bbmap_inputs = [cmd.split()[2] for cmd in commands if cmd.startswith('bbmap.sh')]
+    assert bbmap_inputs == ['in={}'.format(os.path.join(sample_tmp_dir, 'unmerged_R1.fastq.gz')),
+                            'in={}'.format(os.path.join(sample_tmp_dir, 'merged.fastq.gz'))]
+    out_bam = os.path.join(sample_tmp_dir, 'out_2.bam')
+    assert os.path.isfile(out_bam + '.bai')
+    with pysam.AlignmentFile('tests/contamination.bam', 'rb') as bam:
+        total_reads = sum(1 for _ in bam.fetch(until_eof=True))
+    with pysam.AlignmentFile(out_bam, 'rb') as bam:
+        positions = [(read.reference_id if read.reference_id >= 0 else len(bam.references), read.reference_start)
+                     for read in bam.fetch(until_eof=True)]
+    assert len(positions) == total_reads
+    assert positions == sorted(positions)
+
+
+def test_all_genera_get_a_row_each(tmpdir, monkeypatch):
+    commands = use_fake_tools(tmpdir, monkeypatch)
+    database = os.path.join(str(tmpdir), 'cgmlst.fasta')
+    shutil.copy('tests/rmlst.fasta', database)
+    output_folder = os.path.join(str(tmpdir), 'output')
+    os.makedirs(output_folder)
+    find_contamination(pair=['tests/fake_fastqs/test_R1.fastq.gz', 'tests/fake_fastqs/test_R2.fastq.gz'],
+                       output_folder=output_folder,
+                       databases_folder=str(tmpdir),
+                       threads=2,
+                       cgmlst_db=database,
+                       cross_details=True,
+                       all_genera=True,
+                       genus='Fakella:Otherella')
+    with open(os.path.join(output_folder, 'confindr_report.csv')) as f:
+        rows = list(csv.DictReader(f))
+    assert [(row['Sample'], row['Genus']) for row in rows] == [('test', 'Fakella'), ('test', 'Otherella')]
+    assert all(row['ContamStatus'] == 'True' for row in rows)
+    for genus in ['Fakella', 'Otherella']:
+        assert os.path.isfile(os.path.join(output_folder, 'test_{}_contamination.csv'.format(genus)))
+    # Both genera were typed, and each one's log ended up in the main log.
+    typing_commands = [cmd for cmd in commands if cmd.startswith('kma -ipe')]
+    assert len(typing_commands) == 2
+    with open(os.path.join(output_folder, 'confindr_log.txt')) as f:
+        log = f.read()
+    assert all(cmd in log for cmd in typing_commands)
+
+
+def test_samples_analysed_in_parallel(tmpdir, monkeypatch):
+    use_fake_tools(tmpdir, monkeypatch)
+    database = os.path.join(str(tmpdir), 'cgmlst.fasta')
+    shutil.copy('tests/rmlst.fasta', database)
+    output_folder = os.path.join(str(tmpdir), 'output')
+    os.makedirs(output_folder)
+    samples = list()
+    for sample_name in ['first', 'broken', 'second']:
+        pair = list()
+        for direction in ['R1', 'R2']:
+            pair.append(os.path.join(str(tmpdir), '{}_{}.fastq.gz'.format(sample_name, direction)))
+            shutil.copy('tests/fake_fastqs/test_{}.fastq.gz'.format(direction), pair[-1])
+        samples.append({'sample_name': sample_name,
+                        'pair': pair,
+                        'sample_tmp_dir': os.path.join(output_folder, sample_name),
+                        'genus': 'Fakella',
+                        'error': subprocess.CalledProcessError(1, 'mash') if sample_name == 'broken' else None,
+                        'databases': [database]})
+    find_contamination_parallel(samples=samples,
+                                output_folder=output_folder,
+                                databases_folder=str(tmpdir),
+                                parallel_samples=3,
+                                threads=2,
+                                cgmlst_db=database)
+    with open(os.path.join(output_folder, 'confindr_report.csv')) as f:
+        rows = list(csv.DictReader(f))
+    # Reports come out in the same order as the samples went in, whichever finished first.
+    assert [(row['Sample'], row['Genus']) for row in rows] == [('first', 'Fakella'), ('broken', ERROR_GENUS),
+                                                               ('second', 'Fakella')]
+    assert not any(os.path.isdir(sample['sample_tmp_dir']) for sample in samples)
+
+
+def test_tag_reads(tmpdir):
+    reads = os.path.join(str(tmpdir), 'reads.fastq.gz')
+    with gzip.open(reads, 'wt') as f:
+        f.write('@read1 1:N:0\nACGT\n+\nIIII\n@read2 1:N:0\nTTTT\n+\nIIII\n')
+    with open(os.path.join(str(tmpdir), 'tagged.fastq'), 'w') as f:
+        tag_reads(reads, f, tag='3')
+    with open(os.path.join(str(tmpdir), 'tagged.fastq')) as f:
+        lines = f.readlines()
+    assert lines[0] == '@3|read1 1:N:0\n'
+    assert lines[4] == '@3|read2 1:N:0\n'
+    assert lines[1] == 'ACGT\n'
+
+
+def test_split_batch_bam(tmpdir):
+    batch_bam = os.path.join(str(tmpdir), 'batch.bam')
+    total_reads = 0
+    with pysam.AlignmentFile('tests/contamination.bam', 'rb') as bam:
+        with pysam.AlignmentFile(batch_bam, 'wb', template=bam) as out:
+            for read in bam.fetch(until_eof=True):
+                read.query_name = '{}|{}'.format(total_reads % 2, read.query_name)
+                out.write(read)
+                total_reads += 1
+    typings = list()
+    for sample in ['one', 'two']:
+        os.makedirs(os.path.join(str(tmpdir), sample))
+        typings.append({'sample_tmp_dir': os.path.join(str(tmpdir), sample),
+                        'report_name': sample})
+    split_batch_bam([batch_bam], typings)
+    split_reads = 0
+    for i, sample in enumerate(['one', 'two']):
+        with pysam.AlignmentFile(os.path.join(str(tmpdir), sample, 'out_2.bam'), 'rb') as bam:
+            assert bam.header.to_dict()['RG'] == [{'ID': str(i), 'SM': sample}]
+            for read in bam.fetch(until_eof=True):
+                assert read.get_tag('RG') == str(i)
+                assert '|' not in read.query_name
+                split_reads += 1
+    assert split_reads == total_reads
+
+
+def test_canonical_kmers_match_reverse_complement():
+    sequence = b'ACGTTGCAAGGCTTACCGGATACAGTTAGCCATG'
+    reverse_complement = sequence[::-1].translate(bytes.maketrans(b'ACGT', b'TGCA'))
+    assert sorted(kmer_bait.find_canonical_kmers(sequence, k=21)[1]) == \
+        sorted(kmer_bait.find_canonical_kmers(reverse_complement, k=21)[1])
+
+
+def test_canonical_kmers_skip_ambiguous_bases():
+    positions, kmers = kmer_bait.find_canonical_kmers(b'ACGTNACGTACGT', k=4)
+    assert list(positions) == [0, 5, 6, 7, 8, 9]
+    assert len(kmers) == 6
+
+
+def test_packed_alleles_match_fasta(tmpdir):
+    rmlst_file = os.path.join(str(tmpdir), 'rMLST_combined.fasta')
+    shutil.copy('tests/rmlst.fasta', rmlst_file)
+    with open(rmlst_file, 'a') as f:
+        # Ambiguous bases can't be packed, so get stored as they are.
+        f.write('>BACT000099_1\nACGTRYACGT\n')
+    packed_alleles.create_packed_alleles(rmlst_file)
+    assert packed_alleles.has_packed_alleles(rmlst_file)
+    allele_list = [record.id for record in SeqIO.parse(rmlst_file, 'fasta')][::-1] + ['BACT000099_2']
+    packed_file = os.path.join(str(tmpdir), 'packed.fasta')
+    assert packed_alleles.write_packed_alleles(rmlst_file, allele_list, packed_file) == ['BACT000099_2']
+    index = SeqIO.index(rmlst_file, 'fasta')
+    indexed_file = os.path.join(str(tmpdir), 'indexed.fasta')
+    SeqIO.write([index[allele] for allele in allele_list if allele in index], indexed_file, 'fasta')
+    index.close()
+    with open(packed_file) as packed, open(indexed_file) as indexed:
+        assert packed.read() == indexed.read()
+
+
+def test_kmer_bait_reads(tmpdir):
+    allele = str(next(SeqIO.parse('tests/rmlst.fasta', 'fasta')).seq)
+    with gzip.open(os.path.join(str(tmpdir), 'reads_R1.fastq.gz'), 'wt') as f:
+        f.write('@hit\n{}\n+\n{}\n'.format(allele[:100], 'I' * 100))
+        f.write('@miss\n{}\n+\n{}\n'.format('AC' * 50, 'I' * 100))
+        f.write('@mate_hit\n{}\n+\n{}\n'.format('GT' * 50, 'I' * 100))
+    with gzip.open(os.path.join(str(tmpdir), 'reads_R2.fastq.gz'), 'wt') as f:
+        f.write('@hit\n{}\n+\n{}\n'.format('CA' * 50, 'I' * 100))
+        f.write('@miss\n{}\n+\n{}\n'.format('TG' * 50, 'I' * 100))
+        f.write('@mate_hit\n{}\n+\n{}\n'.format(allele[200:300], 'I' * 100))
+    shutil.copyfile('tests/rmlst.fasta', os.path.join(str(tmpdir), 'rmlst.fasta'))
+    baited_reads, baited_bases = kmer_bait.bait_reads(reference=os.path.join(str(tmpdir), 'rmlst.fasta'),
+                                                      forward_in=os.path.join(str(tmpdir), 'reads_R1.fastq.gz'),
+                                                      reverse_in=os.path.join(str(tmpdir), 'reads_R2.fastq.gz'),
+                                                      forward_out=os.path.join(str(tmpdir), 'rmlst_R1.fastq.gz'),
+                                                      reverse_out=os.path.join(str(tmpdir), 'rmlst_R2.fastq.gz'))
+    assert (baited_reads, baited_bases) == (4, 400)
+    assert os.path.isfile(os.path.join(str(tmpdir), 'rmlst_kmers_k27.npy'))
+    with gzip.open(os.path.join(str(tmpdir), 'rmlst_R2.fastq.gz'), 'rt') as f:
+        assert [record.id for record in SeqIO.parse(f, 'fastq')] == ['hit', 'mate_hit']
+
+
+def test_kmer_bait_from_worker_thread_with_read_only_database(tmpdir, monkeypatch):
+    database_folder = os.path.join(str(tmpdir), 'databases')
+    os.makedirs(database_folder)
+    shutil.copyfile('tests/rmlst.fasta', os.path.join(database_folder, 'rmlst.fasta'))
+    allele = str(next(SeqIO.parse('tests/rmlst.fasta', 'fasta')).seq)
+    with gzip.open(os.path.join(str(tmpdir), 'reads.fastq.gz'), 'wt') as f:
+        for i in range(5):
+            f.write('@hit{}\n{}\n+\n{}\n'.format(i, allele[:100], 'I' * 100))
+            f.write('@miss{}\n{}\n+\n{}\n'.format(i, 'AC' * 50, 'I' * 100))
+    save = kmer_bait.np.save
+
+    def read_only_save(filename, array):
+        # Running as root means chmod can't stop anything being written, so pretend the database folder is read-only.
+        if filename.startswith(database_folder):
+            raise PermissionError(13, 'Read-only file system', filename)
+        save(filename, array)
+    monkeypatch.setattr(kmer_bait.np, 'save', read_only_save)
+    monkeypatch.setattr(kmer_bait.multiprocessing, 'Pool', None)
+    p = ThreadPool(processes=1)
+    baited_reads, baited_bases = p.apply(kmer_bait.bait_reads,
+                                         kwds={'reference': os.path.join(database_folder, 'rmlst.fasta'),
+                                               'forward_in': os.path.join(str(tmpdir), 'reads.fastq.gz'),
+                                               'forward_out': os.path.join(str(tmpdir), 'rmlst.fastq.gz'),
+                                               'threads': 2,
+                                               'batch_size': 2})
+    p.close()
+    p.join()
+    assert (baited_reads, baited_bases) == (5, 500)
+    assert glob.glob(os.path.join(database_folder, '*.npy')) == list()
+    assert len(glob.glob(os.path.join(str(tmpdir), 'rmlst_*_kmers_k27.npy'))) == 1
+
+
+def write_fake_paf(paf_file, hits):
+    with open(paf_file, 'w') as f:
+        for allele, contig, start, end, matches in hits:
+            f.write('\t'.join([allele, '1000', '0', '1000', '+', contig, '50000', str(start), str(end),
+                               str(matches), '1000', '60']) + '\n')
+
+
+def test_core_gene_loci(tmpdir):
+    paf_file = os.path.join(str(tmpdir), 'core_genes.paf')
+    write_fake_paf(paf_file, [('BACT000001_1', 'contig1', 100, 1100, 990),
+                              ('BACT000001_2', 'contig1', 100, 1100, 1000),
+                              ('BACT000001_3', 'contig2', 5000, 6000, 950),
+                              ('BACT000002_1', 'contig1', 2000, 3000, 500)])
+    gene_loci = find_core_gene_loci(paf_file)
+    assert len(gene_loci['BACT000001']) == 2
+    assert gene_loci['BACT000001'][0]['allele'] == 'BACT000001_2'
+    assert gene_loci['BACT000001'][0]['differences'] == 0
+    # Identity of 50 percent is too low to count.
+    assert 'BACT000002' not in gene_loci
+
+
+def test_divergent_genes():
+    gene_loci = {'BACT000001': [{'allele': 'BACT000001_1', 'differences': 0},
+                                {'allele': 'BACT000001_4', 'differences': 0}],
+                 'BACT000002': [{'allele': 'BACT000002_1', 'differences': 2},
+                                {'allele': 'BACT000002_1', 'differences': 2}],
+                 'BACT000003': [{'allele': 'BACT000003_1', 'differences': 0}]}
+    assert find_divergent_genes(gene_loci) == ['BACT000001']
+
+
 def test_base_dict_to_string_two_base_descending():
     assert base_dict_to_string({'A': 18, 'C': 3}) == 'A:18;C:3'
 